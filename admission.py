@@ -0,0 +1,468 @@
+"""
+Контроль допуска запросов к маршрутам, которые вызывают модели.
+
+    @bp.route('/chat', methods=['POST'])
+    @admission.limit('chat', providers=('gemini',), prompt_fields=('message',), upload=True)
+    def chat(): ...
+
+Перед вызовом view по порядку проверяются:
+- бюджеты размера: длина текстовых полей JSON (ADMISSION_MAX_PROMPT_CHARS) и размер
+  тела запроса с изображением (ADMISSION_MAX_UPLOAD_BYTES) - 413; тело без Content-Length
+  (chunked) ограничивается тем же лимитом при чтении (request.max_content_length);
+- token bucket на клиента и группу маршрутов (ADMISSION_LIMIT_<GROUP>, например "30/minute")
+  и, если задан, общий на группу (ADMISSION_LIMIT_<GROUP>_GLOBAL) - 429;
+- сброс нагрузки по глубине очереди шлюза моделей в этом процессе
+  (ADMISSION_MAX_QUEUE_<PROVIDER>) - 429;
+- общий для всех воркеров и узлов лимит одновременных запросов к провайдеру
+  (ADMISSION_<PROVIDER>_MAX_CONCURRENT) - 429. Слот держится до конца ответа
+  (для потоковых - до конца тела) и освобождается автоматически через
+  ADMISSION_LEASE_TTL секунд, если воркер упал, не вернув его. Маршрут, который делает
+  несколько вызовов модели параллельно (пакетный анализ), объявляется с hold=False и
+  берет слот на каждый вызов сам - через provider_slot().
+
+Ответ 429 содержит заголовок Retry-After. Клиент - user_id из URL, иначе IP
+(при ADMISSION_TRUST_PROXY=1 - первый адрес X-Forwarded-For).
+
+Состояние хранится в памяти процесса (ADMISSION_BACKEND=memory, по умолчанию)
+(не больше ADMISSION_MEMORY_MAX_KEYS корзин клиентов) или в Redis (ADMISSION_BACKEND=redis,
+REDIS_URL) - тогда лимиты общие для всех воркеров gunicorn и узлов. ADMISSION_BACKEND=off выключает ограничения.
+"""
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import jsonify, make_response, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+_PERIODS = {'s': 1, 'sec': 1, 'second': 1, 'm': 60, 'min': 60, 'minute': 60, 'h': 3600, 'hour': 3600,
+            'd': 86400, 'day': 86400}
+
+
+def parse_limit(value):
+    """'30/minute' -> (30, 0.5): емкость корзины и пополнение в секунду. Пусто или '0' - без лимита."""
+    value = (value or '').strip().lower()
+    if not value or value in ('0', 'off'):
+        return None
+    count, _, period = value.partition('/')
+    count = int(count)
+    seconds = _PERIODS.get(period.strip() or 'second')
+    if seconds is None:
+        raise ValueError(f"Unknown rate limit period in {value!r}")
+    return count, count / seconds
+
+
+# --- Хранилища ---
+
+class MemoryBackend:
+    """
+    Состояние в памяти процесса: лимиты действуют на каждый воркер отдельно.
+
+    Ключи задают клиенты (user_id, IP), поэтому словари не должны расти без предела:
+    раз в sweep_interval секунд удаляются полностью пополнившиеся корзины (они ничем не
+    отличаются от отсутствующих) и пустые наборы слотов; сверх max_keys вытесняются
+    корзины, к которым дольше всего не обращались (клиент получает полную корзину).
+    """
+
+    def __init__(self, max_keys=100000, sweep_interval=60.0):
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self._buckets = OrderedDict() # key -> (tokens, updated_at, full_at), от давних обращений к свежим
+        self._leases = {} # key -> {lease: expires_at}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def _sweep(self, now):
+        """Вызывается под self._lock."""
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        for key in [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]:
+            del self._buckets[key]
+        for key in list(self._leases):
+            leases = self._leases[key]
+            for lease in [lease for lease, expires_at in leases.items() if expires_at <= now]:
+                del leases[lease]
+            if not leases:
+                del self._leases[key]
+
+    def take(self, key, capacity, rate, cost=1):
+        """Возвращает (allowed, retry_after_seconds)."""
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            tokens, updated_at, _ = self._buckets.pop(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return (True, 0.0) if allowed else (False, (cost - tokens) / rate)
+
+    def acquire(self, key, limit, ttl):
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            leases = self._leases.get(key, {})
+            for lease, expires_at in list(leases.items()):
+                if expires_at <= now:
+                    del leases[lease]
+            if len(leases) >= limit:
+                return None
+            lease = uuid.uuid4().hex
+            leases[lease] = now + ttl
+            self._leases[key] = leases
+            return lease
+
+    def release(self, key, lease):
+        with self._lock:
+            leases = self._leases.get(key)
+            if leases is not None:
+                leases.pop(lease, None)
+                if not leases:
+                    del self._leases[key]
+
+    def in_use(self, key):
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for expires_at in self._leases.get(key, {}).values() if expires_at > now)
+
+    def size(self):
+        """(корзин, наборов слотов) - для тестов и отладки."""
+        with self._lock:
+            return len(self._buckets), len(self._leases)
+
+
+# Время берется из Redis (TIME), чтобы расхождение часов узлов не влияло на лимиты
+_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+_ACQUIRE_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(ttl) + 1)
+return 1
+"""
+
+
+class RedisBackend:
+    """Общее состояние в Redis: корзины - хэши, слоты провайдеров - sorted set с временем истечения."""
+
+    def __init__(self, client, prefix='stylesynth:admission:'):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(_TAKE_SCRIPT)
+        self._acquire = client.register_script(_ACQUIRE_SCRIPT)
+
+    def take(self, key, capacity, rate, cost=1):
+        allowed, retry_after = self._take(keys=[self.prefix + 'bucket:' + key], args=[capacity, rate, cost])
+        return bool(int(allowed)), float(retry_after)
+
+    def acquire(self, key, limit, ttl):
+        lease = uuid.uuid4().hex
+        if int(self._acquire(keys=[self.prefix + 'slots:' + key], args=[limit, ttl, lease])):
+            return lease
+        return None
+
+    def release(self, key, lease):
+        self.client.zrem(self.prefix + 'slots:' + key, lease)
+
+    def in_use(self, key):
+        full_key = self.prefix + 'slots:' + key
+        return self.client.zcount(full_key, time.time(), '+inf')
+
+
+def backend_from_env():
+    kind = os.environ.get('ADMISSION_BACKEND', 'memory').lower()
+    if kind == 'off':
+        return None
+    if kind == 'redis':
+        from response_cache import redis_client_from_env
+        return RedisBackend(redis_client_from_env())
+    return MemoryBackend(max_keys=int(os.environ.get('ADMISSION_MEMORY_MAX_KEYS', 100000)))
+
+
+# --- Контроль допуска ---
+
+class Rejected(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    limits / global_limits - {group: (capacity, rate)}, provider_caps - {provider: max одновременных
+    запросов на весь кластер}, queue_limits - {provider: max очередь шлюза в процессе}.
+    gateway - ModelGateway, по которому считается глубина очереди.
+    """
+
+    def __init__(self, backend, limits=None, global_limits=None, provider_caps=None, queue_limits=None,
+                 gateway=None, max_prompt_chars=4000, max_upload_bytes=10 * 1024 * 1024,
+                 lease_ttl=120, shed_retry_after=5, trust_proxy=False):
+        self.backend = backend
+        self.limits = limits or {}
+        self.global_limits = global_limits or {}
+        self.provider_caps = provider_caps or {}
+        self.queue_limits = queue_limits or {}
+        self.gateway = gateway
+        self.max_prompt_chars = max_prompt_chars
+        self.max_upload_bytes = max_upload_bytes
+        self.lease_ttl = lease_ttl
+        self.shed_retry_after = shed_retry_after
+        self.trust_proxy = trust_proxy
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, gateway=None, groups=None):
+        """groups - {group: лимит по умолчанию, например '30/minute'}."""
+        env = os.environ
+        limits, global_limits = {}, {}
+        for group, default in (groups or {}).items():
+            limit = parse_limit(env.get(f"ADMISSION_LIMIT_{group.upper()}", default))
+            if limit:
+                limits[group] = limit
+            global_limit = parse_limit(env.get(f"ADMISSION_LIMIT_{group.upper()}_GLOBAL", ''))
+            if global_limit:
+                global_limits[group] = global_limit
+
+        provider_caps, queue_limits = {}, {}
+        for provider, (cap, queue_limit) in {'gemini': (32, 64), 'replicate': (8, 16)}.items():
+            provider_caps[provider] = int(env.get(f"ADMISSION_{provider.upper()}_MAX_CONCURRENT", cap))
+            queue_limits[provider] = int(env.get(f"ADMISSION_MAX_QUEUE_{provider.upper()}", queue_limit))
+
+        return cls(
+            backend_from_env(),
+            limits=limits,
+            global_limits=global_limits,
+            provider_caps=provider_caps,
+            queue_limits=queue_limits,
+            gateway=gateway,
+            max_prompt_chars=int(env.get('ADMISSION_MAX_PROMPT_CHARS', 4000)),
+            max_upload_bytes=int(env.get('ADMISSION_MAX_UPLOAD_BYTES', 10 * 1024 * 1024)),
+            lease_ttl=float(env.get('ADMISSION_LEASE_TTL', 120)),
+            shed_retry_after=int(env.get('ADMISSION_SHED_RETRY_AFTER', 5)),
+            trust_proxy=env.get('ADMISSION_TRUST_PROXY', '0') == '1',
+        )
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def _count(self, group, outcome):
+        with self._lock:
+            key = (group, outcome)
+            self._stats[key] = self._stats.get(key, 0) + 1
+
+    def stats(self):
+        """{(group, outcome): count} - outcome: admitted, rate_limited, shed, too_large."""
+        with self._lock:
+            return dict(self._stats)
+
+    def client_key(self):
+        user_id = (request.view_args or {}).get('user_id')
+        if user_id is not None:
+            return f"user:{user_id}"
+        if self.trust_proxy and request.access_route:
+            return f"ip:{request.access_route[0]}"
+        return f"ip:{request.remote_addr}"
+
+    def _upload_too_large(self):
+        return Rejected(413, f"Request is too large, maximum is {self.max_upload_bytes} bytes")
+
+    def _check_size(self, prompt_fields, upload):
+        if upload:
+            # Без Content-Length размер заранее неизвестен: werkzeug прервет чтение тела на лимите
+            request.max_content_length = self.max_upload_bytes
+            if request.content_length and request.content_length > self.max_upload_bytes:
+                raise self._upload_too_large()
+        if prompt_fields and request.is_json:
+            data = request.get_json(silent=True)
+            if isinstance(data, dict):
+                for field in prompt_fields:
+                    value = data.get(field)
+                    if isinstance(value, str) and len(value) > self.max_prompt_chars:
+                        raise Rejected(413, f"'{field}' is too long, maximum is {self.max_prompt_chars} characters")
+
+    def _check_rate(self, group):
+        for key, limit in ((f"{group}:{self.client_key()}", self.limits.get(group)),
+                           (f"{group}:*", self.global_limits.get(group))):
+            if limit is None:
+                continue
+            capacity, rate = limit
+            allowed, retry_after = self.backend.take(key, capacity, rate)
+            if not allowed:
+                raise Rejected(429, "Too many requests, please retry later", retry_after)
+
+    def _check_queue(self, providers):
+        if self.gateway is None:
+            return
+        stats = self.gateway.stats()
+        for provider in providers:
+            limit = self.queue_limits.get(provider)
+            queued = stats.get(provider, {}).get('queued', 0)
+            if limit and queued >= limit:
+                raise Rejected(429, f"{provider} is overloaded, please retry later", self.shed_retry_after)
+
+    def _acquire(self, providers):
+        leases = []
+        for provider in providers:
+            cap = self.provider_caps.get(provider)
+            if not cap:
+                continue
+            lease = self.backend.acquire(f"provider:{provider}", cap, self.lease_ttl)
+            if lease is None:
+                self._release(leases)
+                raise Rejected(429, f"{provider} is at capacity, please retry later", self.shed_retry_after)
+            leases.append((f"provider:{provider}", lease))
+        return leases
+
+    def _release(self, leases):
+        for key, lease in leases:
+            try:
+                self.backend.release(key, lease)
+            except Exception as e:
+                print(f"Admission slot release failed: {e}")
+
+    def admit(self, group, providers=(), prompt_fields=(), upload=False):
+        """Проверки допуска; возвращает слоты провайдеров, их нужно вернуть через release()."""
+        try:
+            self._check_size(prompt_fields, upload)
+        except Rejected:
+            self._count(group, 'too_large')
+            raise
+        if not self.enabled:
+            return []
+        try:
+            self._check_rate(group)
+        except Rejected:
+            self._count(group, 'rate_limited')
+            raise
+        try:
+            self._check_queue(providers)
+            leases = self._acquire(providers)
+        except Rejected:
+            self._count(group, 'shed')
+            raise
+        self._count(group, 'admitted')
+        return leases
+
+    def release(self, leases):
+        self._release(leases)
+
+    @contextmanager
+    def provider_slot(self, provider, wait=0.0):
+        """
+        Слот провайдера на один вызов модели. Если слотов нет, ждет до wait секунд
+        (с растущей паузой), затем Rejected(429). Без ограничения для провайдера - ничего не делает.
+        """
+        cap = self.provider_caps.get(provider)
+        if not self.enabled or not cap:
+            yield
+            return
+        key = f"provider:{provider}"
+        deadline = time.monotonic() + wait
+        delay = 0.05
+        lease = None
+        while lease is None:
+            try:
+                lease = self.backend.acquire(key, cap, self.lease_ttl)
+            except Exception as e:
+                print(f"Admission check failed, letting the call through: {e}")
+                break
+            if lease is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Rejected(429, f"{provider} is at capacity, please retry later", self.shed_retry_after)
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 1.0)
+        try:
+            yield
+        finally:
+            if lease is not None:
+                self._release([(key, lease)])
+
+    def limit(self, group, providers=(), prompt_fields=(), upload=False, hold=True):
+        """
+        Декоратор view-функции: см. описание модуля. hold=False - слоты провайдеров только
+        проверяются при допуске и сразу возвращаются; view берет их через provider_slot().
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                try:
+                    leases = self.admit(group, providers, prompt_fields, upload)
+                except Rejected as e:
+                    return rejection_response(e)
+                except Exception as e:
+                    # Недоступное хранилище лимитов не должно останавливать сервис
+                    print(f"Admission check failed, letting the request through: {e}")
+                    leases = []
+                if not hold:
+                    self.release(leases)
+                    leases = []
+                try:
+                    response = view(*args, **kwargs)
+                except RequestEntityTooLarge:
+                    # Тело без Content-Length превысило лимит при чтении формы во view
+                    self.release(leases)
+                    self._count(group, 'too_large')
+                    return rejection_response(self._upload_too_large())
+                except Exception:
+                    self.release(leases)
+                    raise
+                if not leases:
+                    return response
+                response = make_response(response)
+                # Для потоковых ответов слот освобождается, когда сервер дочитал тело
+                response.call_on_close(lambda: self.release(leases))
+                return response
+            return wrapper
+        return decorator
+
+
+def rejection_response(rejected):
+    body = {"error": rejected.message}
+    if rejected.retry_after is not None:
+        body["retry_after"] = max(1, math.ceil(rejected.retry_after))
+    response = jsonify(body)
+    response.status_code = rejected.status
+    if rejected.retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, math.ceil(rejected.retry_after)))
+    return response
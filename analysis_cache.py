@@ -0,0 +1,233 @@
+"""
+Персистентный кэш результатов анализа изображений (Gemini).
+
+Ключ - SHA-256 от байтов изображения внутри пространства имен
+(тип анализа + версия промпта), так что смена промпта автоматически
+"сбрасывает" кэш. Дополнительно можно включить поиск почти-дубликатов
+по перцептивному хэшу (dHash): пересжатая или слегка обрезанная копия
+того же фото тоже попадет в кэш. dHash строится по яркости, поэтому
+почти-дубликат должен совпадать и по грубой цветовой сигнатуре - та же
+вещь другого цвета в кэш не попадает. Кандидаты ищутся по индексу:
+64-битный хэш делится на PHASH_BANDS полос, и запись с расстоянием
+меньше PHASH_BANDS совпадает с искомой хотя бы в одной полосе.
+
+Хранилище - файл SQLite, поэтому кэш переживает рестарты и общий
+для всех воркеров gunicorn на одной машине.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+PHASH_BANDS = 4 # Полосы по 16 бит: почти-дубликаты ищутся на расстоянии до PHASH_BANDS - 1
+NEAR_DUPLICATE_CANDIDATES = 64 # Сколько записей-кандидатов сравнивается на один промах кэша
+
+
+def image_sha256(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def image_dhash(image_bytes, hash_size=8):
+    """
+    Перцептивный dHash: 64 бита (для hash_size=8) в виде hex-строки.
+    Устойчив к пересжатию и изменению размера.
+    """
+    image = Image.open(BytesIO(image_bytes))
+    image.draft('L', (hash_size * 4, hash_size * 4))  # для JPEG декодируем сразу в уменьшенном виде
+    return _dhash(image.convert('L'), hash_size)
+
+
+def image_signature(image_bytes, hash_size=8):
+    """(dHash, цветовая сигнатура) за одно декодирование изображения."""
+    image = Image.open(BytesIO(image_bytes))
+    image.draft('RGB', (hash_size * 4, hash_size * 4))
+    image = image.convert('RGB')
+    return _dhash(image.convert('L'), hash_size), color_signature(image)
+
+
+def color_signature(image, grid=2, levels=8):
+    """
+    Средний цвет клеток сетки grid x grid, каждый канал - в levels уровней ('072...').
+    Пересжатие сдвигает средние на единицы, смена цвета вещи - на десятки.
+    """
+    cells = image.resize((grid, grid), Image.Resampling.BOX)
+    step = 256 // levels
+    return ''.join(str(channel // step) for pixel in cells.getdata() for channel in pixel)
+
+
+def phash_bands(phash):
+    value = int(phash, 16)
+    width = len(phash) * 4 // PHASH_BANDS
+    return [(value >> (width * (PHASH_BANDS - 1 - band))) & ((1 << width) - 1) for band in range(PHASH_BANDS)]
+
+
+def _dhash(image, hash_size):
+    image = image.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+class AnalysisCache:
+    """
+    Кэш "изображение -> текст ответа модели" с TTL и LRU-вытеснением.
+
+    ttl_seconds - время жизни записи (0 - без ограничения).
+    max_entries - максимальное число записей, лишние вытесняются по last_access.
+    phash_distance - максимальное расстояние Хэмминга для почти-дубликатов
+                     (0 - поиск по перцептивному хэшу выключен, больше PHASH_BANDS - 1 не бывает).
+    """
+
+    def __init__(self, path, ttl_seconds=30 * 24 * 3600, max_entries=10000, phash_distance=0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.phash_distance = min(phash_distance, PHASH_BANDS - 1)
+        self._local = threading.local()
+        self._init_schema()
+
+    @classmethod
+    def from_env(cls):
+        """Создает кэш по переменным окружения. Пустой ANALYSIS_CACHE_PATH выключает кэш."""
+        path = os.environ.get('ANALYSIS_CACHE_PATH', 'analysis_cache.sqlite3')
+        if not path:
+            return None
+        return cls(
+            path,
+            ttl_seconds=int(os.environ.get('ANALYSIS_CACHE_TTL', 30 * 24 * 3600)),
+            max_entries=int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', 10000)),
+            phash_distance=int(os.environ.get('ANALYSIS_CACHE_PHASH_DISTANCE', 0)),
+        )
+
+    def _connect(self):
+        # Соединение SQLite нельзя делить между потоками - держим по одному на поток
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS analysis_cache ('
+            ' namespace TEXT NOT NULL,'
+            ' sha256 TEXT NOT NULL,'
+            ' phash TEXT,'
+            ' result TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' last_access REAL NOT NULL,'
+            ' PRIMARY KEY (namespace, sha256))'
+        )
+        # Файлы кэша старой версии: колонки для почти-дубликатов добавляются, старые записи ищутся только по SHA-256
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(analysis_cache)')}
+        for column in ['color'] + [f"band{band}" for band in range(PHASH_BANDS)]:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE analysis_cache ADD COLUMN {column} {'TEXT' if column == 'color' else 'INTEGER'}")
+        conn.execute('DROP INDEX IF EXISTS ix_analysis_cache_phash')
+        for band in range(PHASH_BANDS):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_analysis_cache_band{band} "
+                         f"ON analysis_cache (namespace, color, band{band})")
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_analysis_cache_last_access ON analysis_cache (last_access)')
+
+    def _is_expired(self, created_at, now):
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(self, namespace, image_bytes, sha256=None):
+        """Возвращает закэшированный результат или None."""
+        sha256 = sha256 or image_sha256(image_bytes)
+        conn = self._connect()
+        now = time.time()
+
+        row = conn.execute(
+            'SELECT sha256, result, created_at FROM analysis_cache WHERE namespace = ? AND sha256 = ?',
+            (namespace, sha256)
+        ).fetchone()
+
+        if row is None and self.phash_distance > 0:
+            row = self._find_near_duplicate(conn, namespace, image_bytes)
+
+        if row is None:
+            return None
+
+        key, result, created_at = row
+        if self._is_expired(created_at, now):
+            conn.execute('DELETE FROM analysis_cache WHERE namespace = ? AND sha256 = ?', (namespace, key))
+            return None
+
+        conn.execute(
+            'UPDATE analysis_cache SET last_access = ? WHERE namespace = ? AND sha256 = ?',
+            (now, namespace, key)
+        )
+        return result
+
+    def _near_duplicate_query(self):
+        bands = ' OR '.join(f"band{band} = ?" for band in range(PHASH_BANDS))
+        return ('SELECT sha256, result, created_at, phash FROM analysis_cache'
+                f' WHERE namespace = ? AND color = ? AND ({bands}) LIMIT ?')
+
+    def _find_near_duplicate(self, conn, namespace, image_bytes):
+        try:
+            phash, color = image_signature(image_bytes)
+        except Exception:
+            return None
+        # Только записи того же цвета, совпадающие с хэшем хотя бы в одной полосе (по индексам)
+        best_row, best_distance = None, self.phash_distance + 1
+        for candidate in conn.execute(self._near_duplicate_query(),
+                                      (namespace, color, *phash_bands(phash), NEAR_DUPLICATE_CANDIDATES)):
+            distance = hamming_distance(phash, candidate[3])
+            if distance < best_distance:
+                best_row, best_distance = candidate[:3], distance
+        return best_row
+
+    def set(self, namespace, image_bytes, result, sha256=None):
+        sha256 = sha256 or image_sha256(image_bytes)
+        phash, color, bands = None, None, [None] * PHASH_BANDS
+        if self.phash_distance > 0:
+            try:
+                phash, color = image_signature(image_bytes)
+                bands = phash_bands(phash)
+            except Exception:
+                phash, color, bands = None, None, [None] * PHASH_BANDS
+        now = time.time()
+        conn = self._connect()
+        band_columns = ', '.join(f"band{band}" for band in range(PHASH_BANDS))
+        conn.execute(
+            f'INSERT OR REPLACE INTO analysis_cache (namespace, sha256, phash, color, {band_columns}, result,'
+            f' created_at, last_access) VALUES (?, ?, ?, ?, {", ".join("?" * PHASH_BANDS)}, ?, ?, ?)',
+            (namespace, sha256, phash, color, *bands, result, now, now)
+        )
+        self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        if self.ttl_seconds > 0:
+            conn.execute('DELETE FROM analysis_cache WHERE created_at < ?', (now - self.ttl_seconds,))
+        if self.max_entries > 0:
+            # LRU: оставляем max_entries самых недавно использованных записей
+            conn.execute(
+                'DELETE FROM analysis_cache WHERE rowid IN ('
+                ' SELECT rowid FROM analysis_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def clear(self, namespace=None):
+        conn = self._connect()
+        if namespace is None:
+            conn.execute('DELETE FROM analysis_cache')
+        else:
+            conn.execute('DELETE FROM analysis_cache WHERE namespace = ?', (namespace,))
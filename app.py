@@ -1,32 +1,61 @@
 import os
-import google.generativeai as genai
-import replicate
-import requests
-from PIL import Image
+import atexit
 from io import BytesIO
-from flask import Flask, request, jsonify, render_template
+from flask import (Flask, Blueprint, current_app, request, jsonify, render_template, Response,
+                   stream_with_context, send_file)
 from flask_cors import CORS
 from dotenv import load_dotenv
 import json
+import hashlib
+import mimetypes
+from datetime import datetime, timedelta
 # from flask_cors import CORS # Уже импортирован выше
 import base64 # Добавить, если нет
-# import requests # Уже импортирован выше
 import io # Добавить, если нет
-# from PIL import Image # Уже импортирован выше
+import zipfile
+import threading
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Импортируем необходимые классы из Flask-SQLAlchemy
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, update, event, exists, func, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from admission import AdmissionController, Rejected, rejection_response
+from analysis_cache import AnalysisCache
+from model_gateway import ModelGateway
+from prompts import (GARMENT_PROMPT_VERSION, GARMENT_ANALYSIS_PROMPT, APPEARANCE_PROMPT_VERSION,
+                     APPEARANCE_ANALYSIS_PROMPT, MODEL_TASKS, chat_prompt, outfit_prompt,
+                     chat_session_preamble, chat_summary_prompt)
+from image_pipeline import normalize_image, get_stats as get_image_stats
+from outfit_engine import OutfitEngine
+from garment_classifier import GarmentClassifier, CLASSIFIER_OUTCOMES
+from embeddings import ImageEmbedder, VectorIndex, vector_to_bytes, vector_from_bytes
+from response_cache import ResponseCache
+from storage import ImageStore, LocalStorage, sha256_from_key, chat_image_key
+import chat_sessions
+from chat_sessions import (CHAT_HISTORY_TOKEN_BUDGET, CHAT_SUMMARY_MIN_TOKENS, CHAT_CONTEXT_CACHE_TTL,
+                           CHAT_SESSION_MAX_MESSAGES)
+import metrics
+from metrics import stage
+import migrations
+import query_budget
+from query_budget import query_budget as max_queries
+from streaming import sse_event, ndjson_line, stream_format, stream_headers
+from structured_output import (JSONArrayStreamParser, generate_structured, record_outcome,
+                               GARMENT_SCHEMA, APPEARANCE_SCHEMA, OUTFIT_SCHEMA, OUTFITS_SCHEMA,
+                               get_stats as get_structured_output_stats)
+from jobs import GenerationJobRunner, JobQueueFullError, FINISHED_STATUSES, GENERATION_IN_FLIGHT_SQL, job_to_dict
 
 load_dotenv() # Загрузка переменных окружения должна быть в самом начале
 
-app = Flask(__name__, template_folder='templates')
-CORS(app) # Это включит CORS для всех маршрутов
-
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # Отключаем, чтобы избежать предупреждений
-
-# Инициализируем SQLAlchemy
-db = SQLAlchemy(app)
+# SQLAlchemy и маршруты не привязаны к конкретному приложению - его собирает create_app() в конце файла
+db = SQLAlchemy()
+bp = Blueprint('main', __name__)
 
 # --- Определение моделей базы данных (ТОЛЬКО ОДИН РАЗ) ---
 
@@ -35,8 +64,11 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False) # Это поле было во втором определении, но отсутствовало в первом. Выберите, какое вам нужно.
-    # Отношение к предметам гардероба
-    wardrobe_items = db.relationship('WardrobeItem', backref='owner', lazy=True)
+    # Отношение к предметам гардероба. Неявная ленивая загрузка запрещена (N+1):
+    # вещи загружаются явным запросом или через selectinload(User.wardrobe_items)
+    wardrobe_items = db.relationship('WardrobeItem', backref='owner', lazy='raise_on_sql')
+    # Увеличивается при любом изменении вещей пользователя - входит в ключ кэша ответов
+    wardrobe_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return f'<User {self.username}>' # Используйте f-строку для удобства
@@ -46,33 +78,447 @@ class WardrobeItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     image_url = db.Column(db.String(500)) # Увеличил размер, так как URL могут быть длинными
+    image_key = db.Column(db.String(200), nullable=True) # Ключ оригинала в хранилище (storage.py)
     category = db.Column(db.String(50), nullable=True) # Рубашка, брюки, платье
     color = db.Column(db.String(50), nullable=True)     # Красный, синий, и т.д.
     style = db.Column(db.String(50), nullable=True)      # Повседневный, деловой, вечерний
     item_type = db.Column(db.String(100), nullable=False) # Это поле было во втором определении WardrobeItem
     added_date = db.Column(db.DateTime, default=db.func.current_timestamp()) # Это поле было во втором определении WardrobeItem
+    embedding = db.Column(db.LargeBinary, nullable=True) # Эмбеддинг изображения (float16), см. embeddings.py
+    # Нормализованные атрибуты (категория, цвета, стиль) - для фильтрации по индексам
+    attributes = db.relationship('Attribute', secondary='wardrobe_item_attribute', viewonly=True, lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_wardrobe_item_user_id_id', 'user_id', 'id'), # Keyset-пагинация списка
+        db.Index('ix_wardrobe_item_user_id_category', 'user_id', 'category'),
+        db.Index('ix_wardrobe_item_user_id_style', 'user_id', 'style'),
+        db.Index('ix_wardrobe_item_user_id_added_date', 'user_id', 'added_date'),
+    )
 
     def __repr__(self):
         return f'<WardrobeItem {self.item_type} for User {self.user_id}>' # Используйте f-строку
 
-# --- API Key Setup (проверьте, что они есть в Render Environment Variables) ---
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+@event.listens_for(Session, 'after_flush')
+def _bump_wardrobe_versions(session, flush_context):
+    """Одним UPDATE на пользователя увеличивает wardrobe_version после изменения его вещей."""
+    changed = list(session.new) + list(session.deleted) + [obj for obj in session.dirty if session.is_modified(obj)]
+    user_ids = {obj.user_id for obj in changed if isinstance(obj, WardrobeItem) and obj.user_id is not None}
+    for changed_user_id in user_ids:
+        session.connection().execute(
+            update(User.__table__)
+            .where(User.__table__.c.id == changed_user_id)
+            .values(wardrobe_version=User.__table__.c.wardrobe_version + 1)
+        )
+
+# Словарь атрибутов: kind - 'category', 'color' или 'style', value - нормализованное значение
+ATTRIBUTE_KINDS = ('category', 'color', 'style')
+
+class Attribute(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)
+    value = db.Column(db.String(50), nullable=False)
 
-if not GEMINI_API_KEY:
-    raise ValueError(
-        "GEMINI_API_KEY environment variable not set. Check your .env file or Render.com settings."
-    )
-if not REPLICATE_API_TOKEN:
-    raise ValueError(
-        "REPLICATE_API_TOKEN environment variable not set. Check your .env file or Render.com settings."
+    __table_args__ = (db.UniqueConstraint('kind', 'value', name='uq_attribute_kind_value'),)
+
+    def __repr__(self):
+        return f'<Attribute {self.kind}={self.value}>'
+
+# Связь вещь <-> атрибут. user_id продублирован, чтобы фильтр
+# "вещи пользователя с цветом X" шел по одному составному индексу.
+wardrobe_item_attribute = db.Table(
+    'wardrobe_item_attribute',
+    db.Column('item_id', db.Integer, db.ForeignKey('wardrobe_item.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('attribute_id', db.Integer, db.ForeignKey('attribute.id'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
+    db.Index('ix_wardrobe_item_attribute_user_attribute', 'user_id', 'attribute_id', 'item_id'),
+)
+
+# Результат анализа селфи. Каждый анализ - новая строка (история с версией промпта и временем),
+# текущий профиль пользователя - последняя строка, см. current_appearance_profile_id()
+class AppearanceProfile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    skin_tone = db.Column(db.String(50), nullable=True)
+    appearance_tone = db.Column(db.String(50), nullable=True)
+    analysis = db.Column(db.Text, nullable=True) # Полный ответ модели (JSON)
+    prompt_version = db.Column(db.String(16), nullable=False) # APPEARANCE_PROMPT_VERSION на момент анализа
+    model = db.Column(db.String(100), nullable=True)
+    image_sha256 = db.Column(db.String(64), nullable=True) # Повторная загрузка того же селфи не анализируется
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_appearance_profile_user_id_id', 'user_id', 'id'),)
+
+    def to_dict(self):
+        return {
+            "skin_tone": self.skin_tone,
+            "appearance_tone": self.appearance_tone,
+            "prompt_version": self.prompt_version,
+            "model": self.model,
+            "analyzed_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+    def __repr__(self):
+        return f'<AppearanceProfile {self.id} for User {self.user_id}>'
+
+def current_appearance_profile_id():
+    """Коррелированный подзапрос: id последнего профиля пользователя (индекс user_id, id)."""
+    return select(func.max(AppearanceProfile.id)) \
+        .where(AppearanceProfile.user_id == User.id) \
+        .correlate(User) \
+        .scalar_subquery()
+
+# Сессия чата со стилистом: история на сервере, см. chat_sessions.py
+class ChatSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=True)
+    body_type = db.Column(db.String(100), nullable=False)
+    summary = db.Column(db.Text, nullable=True) # Сводка реплик с id <= summarized_through
+    summarized_through = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    pinned_image_key = db.Column(db.String(200), nullable=True) # Последнее фото разговора
+    context_cache_name = db.Column(db.String(200), nullable=True) # Кэш контекста у провайдера
+    context_cache_key = db.Column(db.String(64), nullable=True)
+    context_cache_expires_at = db.Column(db.DateTime, nullable=True)
+    context_cache_through = db.Column(db.Integer, nullable=True) # Последняя реплика в кэше контекста
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ChatSession {self.id}>'
+
+class ChatMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), db.ForeignKey('chat_session.id', ondelete='CASCADE'), nullable=False)
+    role = db.Column(db.String(8), nullable=False) # user или model
+    text = db.Column(db.Text, nullable=False)
+    image_key = db.Column(db.String(200), nullable=True) # Нормализованное фото в хранилище (storage.py)
+    tokens = db.Column(db.Integer, nullable=False) # Оценка размера реплики в токенах
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_chat_message_session_id_id', 'session_id', 'id'),)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "role": self.role,
+            "text": self.text,
+            "image_id": sha256_from_key(self.image_key) if self.image_key else None,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+    def __repr__(self):
+        return f'<ChatMessage {self.id} in {self.session_id}>'
+
+# Задача генерации изображения (Replicate), выполняется в фоне - см. jobs.py
+class GenerationJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex
+    prompt = db.Column(db.Text, nullable=False)
+    prompt_hash = db.Column(db.String(64), nullable=False) # Для объединения одинаковых промптов
+    status = db.Column(db.String(16), nullable=False) # queued, running, succeeded, failed
+    result_url = db.Column(db.String(500), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_generation_job_prompt_hash_status', 'prompt_hash', 'status'),
+        # Не больше одной задачи в работе на промпт (см. jobs.py)
+        db.Index('uq_generation_job_prompt_hash_in_flight', 'prompt_hash', unique=True,
+                 sqlite_where=text(GENERATION_IN_FLIGHT_SQL), postgresql_where=text(GENERATION_IN_FLIGHT_SQL)),
     )
 
-genai.configure(api_key=GEMINI_API_KEY)
+    def __repr__(self):
+        return f'<GenerationJob {self.id} {self.status}>'
+
+# Все вызовы Gemini/Replicate идут через общий шлюз с ограниченными пулами,
+# таймаутами, повторами и circuit breaker (MODEL_PROVIDER=stub - локальные заглушки, ключи не нужны).
+# SDK и клиенты моделей создаются лениво, при первом вызове (см. model_registry.py).
+# Ключи API (GEMINI_API_KEY, REPLICATE_API_TOKEN) проверяются в create_app().
+model_gateway = ModelGateway.from_env()
+model_gateway.observer = metrics.observe_model_call
+
+# --- Контроль допуска (admission.py) ---
+# Лимиты по умолчанию на клиента (user_id из URL или IP); переопределяются ADMISSION_LIMIT_<GROUP>.
+# С ADMISSION_BACKEND=redis лимиты и слоты провайдеров общие для всех воркеров и узлов.
+ADMISSION_GROUPS = {
+    'chat': '30/minute',
+    'analysis': '60/minute', # /analyze, добавление вещи, анализ селфи
+    'batch': '5/minute',
+    'outfit': '30/minute',
+    'generate': '10/minute',
+}
+admission = AdmissionController.from_env(model_gateway, ADMISSION_GROUPS)
+
+# --- Кэш результатов анализа изображений ---
+# Версии промптов (prompts.py) входят в пространство имен кэша.
+analysis_cache = AnalysisCache.from_env()
+
+
+def _cached_analysis(namespace, image_bytes):
+    if analysis_cache is None:
+        return None
+    try:
+        return analysis_cache.get(namespace, image_bytes)
+    except Exception as e:
+        # Кэш не должен ломать анализ - в худшем случае просто идем в модель
+        print(f"Analysis cache read error: {e}")
+        return None
+
+
+def _store_analysis(namespace, image_bytes, text_response):
+    if analysis_cache is None:
+        return
+    try:
+        json.loads(text_response)  # кэшируем только ответы, которые удалось распарсить
+    except (TypeError, ValueError):
+        return
+    try:
+        analysis_cache.set(namespace, image_bytes, text_response)
+    except Exception as e:
+        print(f"Analysis cache write error: {e}")
+
+# --- Атрибуты вещей ---
+
+def normalize_attribute_value(value):
+    return ' '.join(str(value).split()).lower()[:50]
+
+def _item_attribute_pairs(item):
+    pairs = set()
+    for kind, raw in (('category', item.category), ('style', item.style)):
+        if raw and raw != 'unknown':
+            pairs.add((kind, normalize_attribute_value(raw)))
+    for color in (item.color or '').split(','):
+        if color.strip() and color.strip() != 'unknown':
+            pairs.add(('color', normalize_attribute_value(color)))
+    return pairs
+
+def _get_or_create_attributes(pairs):
+    """Возвращает {(kind, value): attribute_id}, создавая недостающие записи словаря."""
+    ids = {}
+    by_kind = {}
+    for kind, value in pairs:
+        by_kind.setdefault(kind, set()).add(value)
+
+    def load():
+        for kind, values in by_kind.items():
+            for attribute in Attribute.query.filter(Attribute.kind == kind, Attribute.value.in_(values)):
+                ids[(attribute.kind, attribute.value)] = attribute.id
+
+    load()
+    missing = [pair for pair in pairs if pair not in ids]
+    if missing:
+        try:
+            with db.session.begin_nested():
+                db.session.add_all([Attribute(kind=kind, value=value) for kind, value in missing])
+        except IntegrityError:
+            pass # Значение параллельно добавил другой запрос - просто перечитываем
+        load()
+    return ids
+
+def index_item_attributes(items):
+    """
+    Заполняет wardrobe_item_attribute для новых вещей в текущей транзакции.
+    Вещи уже должны быть сохранены (flush), чтобы у них были id.
+    """
+    item_pairs = {item.id: (item.user_id, _item_attribute_pairs(item)) for item in items}
+    all_pairs = set().union(*(pairs for _, pairs in item_pairs.values())) if item_pairs else set()
+    if not all_pairs:
+        return
+    attribute_ids = _get_or_create_attributes(all_pairs)
+    rows = [
+        {"item_id": item_id, "attribute_id": attribute_ids[pair], "user_id": user_id}
+        for item_id, (user_id, pairs) in item_pairs.items()
+        for pair in pairs
+    ]
+    db.session.execute(wardrobe_item_attribute.insert(), rows)
+
+def backfill_item_attributes(batch_size=500):
+    """Индексирует атрибуты вещей, добавленных до появления словаря атрибутов."""
+    indexed = select(wardrobe_item_attribute.c.item_id)
+    last_id = 0
+    while True:
+        # Вещи без распознанных атрибутов в таблицу связей не попадают, поэтому идем курсором по id
+        items = WardrobeItem.query.filter(WardrobeItem.id > last_id, ~WardrobeItem.id.in_(indexed)) \
+            .order_by(WardrobeItem.id).limit(batch_size).all()
+        if not items:
+            return
+        index_item_attributes(items)
+        db.session.commit()
+        last_id = items[-1].id
+
+# --- Кэш ответов модели (/chat, подбор образов) ---
+response_cache = ResponseCache.from_env()
+
+def cached_response(namespace, prompt, context):
+    if response_cache is None or context is None:
+        return None
+    return response_cache.get(namespace, prompt, context)
+
+def cache_response(namespace, prompt, context, value):
+    if response_cache is not None and context is not None:
+        response_cache.set(namespace, prompt, context, value)
+
+# --- Хранилище изображений вещей ---
+image_store = ImageStore.from_env()
+# Префикс ссылок на изображения: по умолчанию отдает сам сервер (/media), можно указать CDN
+MEDIA_URL_PREFIX = os.environ.get('MEDIA_URL_PREFIX', '/media').rstrip('/')
+# Ключи содержат хэш содержимого, поэтому файлы можно кэшировать "навсегда"
+MEDIA_MAX_AGE = int(os.environ.get('MEDIA_MAX_AGE', 365 * 24 * 3600))
+
+def media_url(key):
+    return f"{MEDIA_URL_PREFIX}/{key}"
+
+def item_image_urls(image_key, image_url):
+    """{"image_url", "thumbnail_url", "thumbnails"} вещи. Для старых вещей без файла - исходный image_url."""
+    if not image_key:
+        return {"image_url": image_url, "thumbnail_url": image_url, "thumbnails": {}}
+    thumbnails = {name: media_url(key) for name, key in image_store.thumbnail_keys(image_key).items()}
+    smallest = min(image_store.thumbnail_sizes, key=image_store.thumbnail_sizes.get, default=None)
+    return {
+        "image_url": media_url(image_key),
+        "thumbnail_url": thumbnails.get(smallest, media_url(image_key)),
+        "thumbnails": thumbnails,
+    }
+
+# --- Метрики состояния (снимаются при каждом чтении /metrics) ---
+CIRCUIT_STATES = {'closed': 0, 'half-open': 1, 'open': 2}
+
+metrics.registry.register_collector(
+    'stylesynth_image_pipeline_total', 'Image normalization totals (images, bytes, pixels).', 'counter',
+    lambda: [({"kind": kind}, value) for kind, value in get_image_stats().items()])
+metrics.registry.register_collector(
+    'stylesynth_model_in_flight', 'Model calls currently running per provider.', 'gauge',
+    lambda: [({"provider": name}, info['in_flight']) for name, info in model_gateway.stats().items()])
+metrics.registry.register_collector(
+    'stylesynth_model_queued', 'Model calls waiting for a free provider worker in this process.', 'gauge',
+    lambda: [({"provider": name}, info['queued']) for name, info in model_gateway.stats().items()])
+metrics.registry.register_collector(
+    'stylesynth_model_abandoned', 'Timed out model calls still holding a provider worker.', 'gauge',
+    lambda: [({"provider": name}, info['abandoned']) for name, info in model_gateway.stats().items()])
+metrics.registry.register_collector(
+    'stylesynth_admission_total', 'Admission decisions by route group and outcome.', 'counter',
+    lambda: [({"group": group, "outcome": outcome}, count)
+             for (group, outcome), count in sorted(admission.stats().items())])
+metrics.registry.register_collector(
+    'stylesynth_model_circuit_state', 'Circuit breaker state per provider (0 closed, 1 half-open, 2 open).', 'gauge',
+    lambda: [({"provider": name}, CIRCUIT_STATES.get(info['circuit'], -1))
+             for name, info in model_gateway.stats().items()])
+metrics.registry.register_collector(
+    'stylesynth_structured_output_total', 'Structured model responses by task and parse outcome.', 'counter',
+    lambda: [({"task": task, "outcome": outcome}, count)
+             for task, counts in get_structured_output_stats().items()
+             for outcome, count in counts.items() if outcome != 'failure_rate'])
+metrics.registry.register_collector(
+    'stylesynth_structured_output_failure_rate', 'Share of structured responses that could not be parsed.', 'gauge',
+    lambda: [({"task": task}, counts['failure_rate']) for task, counts in get_structured_output_stats().items()])
+metrics.registry.register_collector(
+    'stylesynth_response_cache', 'Response cache lookups and writes.', 'gauge',
+    lambda: [({"kind": kind}, value) for kind, value in (response_cache.stats() if response_cache else {}).items()])
+
+# --- Локальная классификация вещей (garment_classifier.py) ---
+# Уверенный результат заменяет запрос к Gemini; время батча в пуле процессов - этап classifier.batch
+garment_classifier = GarmentClassifier.from_env(
+    observer=lambda batch_size, seconds: metrics.record_stage('classifier.batch', seconds))
+if garment_classifier is not None:
+    atexit.register(garment_classifier.shutdown) # Воркеры пула не переживают процесс веб-сервера
+
+metrics.registry.register_collector(
+    'stylesynth_garment_classifier_total', 'Local garment classifier outcomes (hit skips the Gemini call).', 'counter',
+    lambda: [({"outcome": outcome}, garment_classifier.stats()[outcome]) for outcome in CLASSIFIER_OUTCOMES]
+    if garment_classifier else [])
+metrics.registry.register_collector(
+    'stylesynth_garment_classifier_hit_rate', 'Share of garment photos analyzed without calling Gemini.', 'gauge',
+    lambda: [({}, garment_classifier.stats()['hit_rate'])] if garment_classifier else [])
+metrics.registry.register_collector(
+    'stylesynth_garment_classifier_batch_size', 'Average number of photos per classifier batch.', 'gauge',
+    lambda: [({}, garment_classifier.stats()['avg_batch_size'])] if garment_classifier else [])
+
+# --- Эмбеддинги и поиск похожих вещей ---
+EMBEDDINGS_ENABLED = os.environ.get('EMBEDDINGS_ENABLED', '1') == '1'
+EMBEDDING_INDEX_PATH = os.environ.get('EMBEDDING_INDEX_PATH', 'wardrobe_embeddings/index')
+# Косинусная близость, начиная с которой новая вещь считается возможным дубликатом
+DUPLICATE_SIMILARITY_THRESHOLD = float(os.environ.get('DUPLICATE_SIMILARITY_THRESHOLD', 0.97))
+
+image_embedder = ImageEmbedder()
+_similarity_index = None
+_similarity_index_lock = threading.Lock()
+
+def _sync_similarity_index(index):
+    """
+    Сверяет вещи в индексе с БД. Вещи, удаленные или добавленные мимо индекса (восстановление
+    БД, сбой между commit и add, удаление на узле с другим файлом индекса), иначе остались бы
+    "призраками" в поиске или не находились бы. При расхождении индекс перестраивается из БД.
+    """
+    # Эмбеддинги другой модели (другой размерности) в индекс не входят
+    indexed = WardrobeItem.embedding.isnot(None) & (func.length(WardrobeItem.embedding) == image_embedder.dim * 2)
+    db_ids = {item_id for item_id, in db.session.query(WardrobeItem.id).filter(indexed)}
+    if db_ids == index.item_ids():
+        return
+    rows = db.session.query(WardrobeItem.id, WardrobeItem.user_id, WardrobeItem.embedding).filter(indexed)
+    index.rebuild((item_id, owner_id, vector_from_bytes(data)) for item_id, owner_id, data in rows)
+    print(f"Similarity index rebuilt from the database: {len(db_ids)} items")
+
+def get_similarity_index():
+    """Индекс создается при первом обращении в процессе и сверяется с БД (_sync_similarity_index)."""
+    global _similarity_index
+    if _similarity_index is None:
+        with _similarity_index_lock:
+            if _similarity_index is None:
+                index = VectorIndex(f"{EMBEDDING_INDEX_PATH}.{image_embedder.name}",
+                                    image_embedder.dim, image_embedder.name)
+                with query_budget.exempt(): # Один раз на процесс - не N+1 маршрута
+                    _sync_similarity_index(index)
+                _similarity_index = index
+    return _similarity_index
+
+def compute_embedding(image_bytes):
+    if not EMBEDDINGS_ENABLED:
+        return None
+    try:
+        with stage('embedding.compute'):
+            return image_embedder.embed_bytes(image_bytes)
+    except Exception as e:
+        print(f"Error computing image embedding: {e}")
+        return None
+
+def find_duplicate(user_id, vector):
+    """Возвращает {"item_id", "similarity"} самой похожей вещи пользователя, если она почти идентична."""
+    if vector is None:
+        return None
+    try:
+        matches = get_similarity_index().search(vector, user_id, k=1)
+    except Exception as e:
+        print(f"Error searching similarity index: {e}")
+        return None
+    if matches and matches[0][1] >= DUPLICATE_SIMILARITY_THRESHOLD:
+        return {"item_id": matches[0][0], "similarity": round(matches[0][1], 4)}
+    return None
+
+def index_item_embeddings(items):
+    """Добавляет эмбеддинги сохраненных вещей в индекс (после commit)."""
+    items = [item for item in items if item.embedding is not None]
+    if not items:
+        return # Без эмбеддингов индекс (и модель, от которой зависит его размерность) не нужен
+    try:
+        index = get_similarity_index()
+        for item in items:
+            index.add(item.id, item.user_id, vector_from_bytes(item.embedding))
+    except Exception as e:
+        print(f"Error updating similarity index: {e}")
+
+def unindex_item_embeddings(item_ids):
+    """Убирает удаленные вещи из индекса (после commit), чтобы они не находились как похожие."""
+    if _similarity_index is None:
+        return # Индекс еще не открыт - при открытии он сверится с БД
+    try:
+        for item_id in item_ids:
+            _similarity_index.remove(item_id)
+    except Exception as e:
+        print(f"Error updating similarity index: {e}")
 
 # --- Маршруты Flask ---
 
-@app.route('/')
+@bp.route('/')
 def index():
     """
     Обслуживает главную HTML-страницу.
@@ -80,23 +526,95 @@ def index():
     """
     return render_template('index.html')
 
-@app.route('/create_db')
-def create_db_tables_route(): # Изменил имя, чтобы не конфликтовало с функцией ниже
+def _media_etag(key):
+    if key.startswith('thumbs/'):
+        return f"{sha256_from_key(key)}-{key.split('/')[1]}"
+    return sha256_from_key(key)
+
+@bp.route('/media/<path:key>', methods=['GET'])
+def serve_media(key):
     """
-    Создает все таблицы базы данных, определенные в моделях SQLAlchemy.
-    Это полезно для инициализации базы данных на Render.
+    Оригиналы и миниатюры из хранилища. Долгий Cache-Control (ключи неизменяемые),
+    ETag / If-None-Match и Range-запросы.
     """
     try:
-        with app.app_context():
-            db.create_all()
-        return "Database tables created successfully!"
-    except Exception as e:
-        return f"Error creating database tables: {e}"
+        if key.startswith('thumbs/'):
+            found = image_store.ensure_thumbnail(key)
+        else:
+            found = key.startswith('originals/') and image_store.backend.exists(key)
+    except ValueError:
+        found = False
+    if not found:
+        return jsonify({"error": "Not found"}), 404
+
+    mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    etag = _media_etag(key)
+    backend = image_store.backend
+    if isinstance(backend, LocalStorage):
+        # send_file сам обрабатывает Range и If-None-Match и отдает файл через file_wrapper
+        response = send_file(backend.local_path(key), mimetype=mimetype, conditional=True,
+                             etag=etag, max_age=MEDIA_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    size = backend.size(key)
+    headers = {'Accept-Ranges': 'bytes',
+               'Cache-Control': f'public, max-age={MEDIA_MAX_AGE}, immutable',
+               'ETag': f'"{etag}"'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, size, 200
+    if request.range:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response(status=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+        (start, stop), status = byte_range, 206
+        headers['Content-Range'] = request.range.to_content_range_header(size)
+    response = Response(stream_with_context(backend.iter_range(key, start, stop)), status=status,
+                        mimetype=mimetype, headers=headers)
+    response.content_length = stop - start
+    return response
 
 # Остальные маршруты (chat, analyze_image_with_gemini, generate_clothing_image и т.д.)
 # Здесь ваша функция chat(), generate_clothing_image() и т.д.
 # ... ваш существующий код для маршрутов /chat, /analyze, /generate, /api/...
-@app.route('/chat', methods=['POST'])
+def _stream_chat_response(parts, fmt, user_message, cache_context, cached):
+    """
+    Потоковый ответ /chat. События: start (сразу, чтобы клиент получил первый байт),
+    token ({"text": ...}) по мере генерации, в конце done ({"response", "image_url"}) или error.
+    Ответ из кэша отдается одним token.
+    """
+    event = sse_event if fmt == 'sse' else ndjson_line
+    mimetype, headers = stream_headers(fmt)
+    image_url = "https://via.placeholder.com/400x300?text=Style+Suggestion"
+
+    def generate():
+        yield event({"status": "started"}, "start")
+        if cached is not None:
+            yield event({"text": cached}, "token")
+            yield event({"response": cached, "image_url": image_url, "cached": True}, "done")
+            return
+        chunks = []
+        try:
+            for text in model_gateway.generate_task_stream('chat', parts):
+                chunks.append(text)
+                yield event({"text": text}, "token")
+            cache_response('chat', user_message, cache_context, ''.join(chunks))
+            yield event({"response": ''.join(chunks), "image_url": image_url, "cached": False}, "done")
+        except Exception as e:
+            print(f"Ошибка при потоковом взаимодействии с Gemini API: {e}")
+            yield event({
+                "error": f"Извините, произошла ошибка при получении рекомендаций от AI: {e}",
+                "response": ''.join(chunks)
+            }, "error")
+
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+@bp.route('/chat', methods=['POST'])
+@admission.limit('chat', providers=('gemini',), prompt_fields=('message', 'body_type'), upload=True)
+@max_queries(0) # История не хранится - только кэш ответов
 def chat():
     data = request.get_json()
     user_message = data.get('message', '')
@@ -108,57 +626,46 @@ def chat():
 
     ai_response_text = "Извините, произошла ошибка или я не смог понять ваш запрос."
     generated_image_url = "https://via.placeholder.com/400x300?text=Error+or+No+Image" # Заглушка по умолчанию
+    # Контекст кэша: тот же вопрос с тем же типом фигуры (и тем же фото) - тот же ответ
+    cache_context = {"body_type": body_type}
+    cached = None
 
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash') # Используем мультимодальную модель
-
         # Собираем части для запроса к Gemini
-        parts = [
-            f"Как AI-стилист, проанализируй следующий запрос и дай рекомендации по стилю и одежде. "
-            f"Учитывай тип телосложения: {body_type}. "
-            "Ответ должен быть кратким и информативным. "
-            "Если предоставлено изображение, используй его для анализа. "
-            "Не генерируй изображение, просто опиши подходящий образ. "
-            "Вот запрос пользователя: '{user_message}'."
-        ]
+        parts = [chat_prompt(body_type, user_message)]
 
         if image_base64:
             try:
                 # Декодируем Base64 в байты изображения
                 image_bytes = base64.b64decode(image_base64)
-                # Определяем MIME-тип. Это критично для Gemini.
-                # В идеале, фронтенд должен передавать тип, но если нет,
-                # можно попробовать определить или просто предположить.
-                # Для этого примера предполагаем, что это JPEG или PNG.
-                # В реальном приложении лучше получать тип с фронтенда.
-                # Например, если ваш JS берет "image/jpeg" или "image/png" из files[0].type
-                
-                # Попробуем определить тип изображения по первым байтам
-                # Это простая эвристика, не надежная для всех случаев!
-                if image_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
-                    mime_type = 'image/png'
-                elif image_bytes.startswith(b'\xff\xd8'):
-                    mime_type = 'image/jpeg'
-                else:
-                    # Если не удалось определить, можно установить тип по умолчанию
-                    # или запросить у пользователя
-                    mime_type = 'image/jpeg' # Предположение по умолчанию
-
-                image_part = {
-                    'mime_type': mime_type,
-                    'data': image_bytes
-                }
+                # Приводим фото к компактному виду: формат определяется по содержимому,
+                # ориентация применяется, EXIF удаляется, длинная сторона - не больше IMAGE_MAX_EDGE
+                with stage('image.normalize'):
+                    image_part = normalize_image(image_bytes).as_part()
                 parts.append(image_part)
+                cache_context["image"] = hashlib.sha256(image_bytes).hexdigest()
             except Exception as e:
                 print(f"Ошибка декодирования или определения типа изображения Base64: {e}")
                 ai_response_text = f"Произошла ошибка при обработке вашего фото: {e}. " \
                                    "Пожалуйста, попробуйте другое фото или отправьте только текст."
                 # Продолжаем без изображения, если произошла ошибка его обработки
                 image_base64 = None # Сбросить, чтобы не пытаться отправить некорректное изображение
+                cache_context = None # Ответ без фото на запрос с фото не кэшируем
+
+        cached = cached_response('chat', user_message, cache_context)
 
-        # Отправляем запрос к Gemini API
-        gemini_response = model.generate_content(parts)
-        ai_response_text = gemini_response.text
+        # Потоковый режим: текст отдается клиенту по мере генерации (SSE или JSON-строки)
+        fmt = stream_format(request, data)
+        if fmt:
+            return _stream_chat_response(parts, fmt, user_message, cache_context, cached)
+
+        if cached is not None:
+            ai_response_text = cached
+        else:
+            # Отправляем запрос к Gemini API
+            # Используем мультимодальную модель
+            ai_response_text = model_gateway.generate_task('chat', parts)
+            cache_response('chat', user_message, cache_context, ai_response_text)
 
         # Gemini-Pro-Vision сам по себе не генерирует изображения, он их анализирует.
         # Если вам нужно сгенерировать изображение на основе текстового ответа,
@@ -174,85 +681,352 @@ def chat():
 
     return jsonify({
         "response": ai_response_text,
-        "image_url": generated_image_url
+        "image_url": generated_image_url,
+        "cached": cached is not None
     })
 
 
-# Функция для анализа изображения с помощью Gemini Pro Vision
-def analyze_image_with_gemini(image_data):
+# --- Сессии чата: история и фото на сервере (chat_sessions.py) ---
+# POST /chat/sessions -> {"session_id"}; реплики - POST /chat/sessions/<id>/messages
+# с {"message", "image" (base64) | "image_id"} или multipart (message + файл image).
+
+def _chat_image_part(key):
+    mime_type = mimetypes.guess_type(key)[0] or 'image/jpeg'
+    return {'mime_type': mime_type, 'data': image_store.backend.read(key)}
+
+def _store_chat_image(image_bytes):
+    """Нормализует фото и сохраняет его по хэшу содержимого; возвращает ключ в хранилище."""
+    with stage('image.normalize'):
+        normalized = normalize_image(image_bytes)
+    key = chat_image_key(hashlib.sha256(normalized.data).hexdigest(), normalized.mime_type)
+    if not image_store.backend.exists(key):
+        image_store.backend.put_bytes(key, normalized.data)
+    return key
+
+def _chat_message_input():
+    """(message, image_bytes, image_id, data) из JSON или multipart."""
+    if request.files or request.form:
+        file = request.files.get('image')
+        image_bytes = file.read() if file and file.filename else None
+        return request.form.get('message', ''), image_bytes, request.form.get('image_id'), request.form
+    data = request.get_json(silent=True) or {}
+    image_bytes = base64.b64decode(data['image']) if data.get('image') else None
+    return data.get('message', ''), image_bytes, data.get('image_id'), data
+
+def _chat_summary_candidates(session, before_id):
+    """
+    Самые старые несжатые реплики до окна, по порядку id. Сводка сдвигает summarized_through
+    до последней из них, поэтому они должны идти подряд от summarized_through - реплики
+    за пределами прочитанных последних CHAT_SESSION_MAX_MESSAGES не пропускаются.
+    """
+    return ChatMessage.query.filter(ChatMessage.session_id == session.id,
+                                    ChatMessage.id > session.summarized_through,
+                                    ChatMessage.id < before_id) \
+        .order_by(ChatMessage.id).limit(CHAT_SESSION_MAX_MESSAGES).all()
+
+@stage('chat.summarize')
+def _summarize_chat(session, older):
+    """Сжимает отброшенные реплики в сводку сессии; при ошибке они просто не попадают в запрос."""
+    try:
+        summary = model_gateway.generate_task(
+            'chat_summary', chat_summary_prompt(session.summary, [(m.role, m.text) for m in older]))
+    except Exception as e:
+        print(f"Chat summary failed for session {session.id}: {e}")
+        return False
+    session.summary = summary.strip()
+    session.summarized_through = older[-1].id
+    return True
+
+def _chat_cache_model():
+    return model_gateway.registry.spec('chat')['model']
+
+# Кэш контекста имеет смысл, только если вступление с окном истории может дорасти до минимума модели
+CHAT_CONTEXT_CACHE_ENABLED = chat_sessions.context_cache_reachable(_chat_cache_model())
+
+def _reuse_chat_context_cache(session, history, preamble_text, current_tokens):
+    """
+    Действующий кэш контекста сессии: (имя, реплики после закэшированных) или None, если кэша нет,
+    он устарел (сводка, модель, срок) или новые реплики уже не помещаются в бюджет истории.
+    """
+    through = session.context_cache_through
+    if not session.context_cache_name or through is None or through <= session.summarized_through:
+        return None
+    if session.context_cache_key != chat_sessions.context_cache_key(_chat_cache_model(), preamble_text, through) \
+            or not session.context_cache_expires_at or session.context_cache_expires_at <= datetime.utcnow():
+        return None
+    tail = [m for m in history if m.id > through]
+    if sum(m.tokens for m in tail) + current_tokens > CHAT_HISTORY_TOKEN_BUDGET:
+        return None
+    return session.context_cache_name, tail
+
+def _create_chat_context_cache(session, preamble_text, contents, tokens, through_id):
+    """
+    Кэширует вступление с окном истории (до реплики through_id), если они не меньше минимума
+    модели. Возвращает имя кэша или None (мало токенов, заглушки, ошибка).
+    """
+    model_name = _chat_cache_model()
+    if not CHAT_CONTEXT_CACHE_ENABLED or through_id is None \
+            or tokens < chat_sessions.context_cache_min_tokens(model_name):
+        return None
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content([
-            "Analyze this image of clothing. Identify the type of garment (e.g., shirt, pants, dress, shoe, jacket), its primary color(s), and its general style (e.g., casual, formal, sporty, elegant). "
-            "Return the answer as a JSON object with keys: 'category', 'colors', 'style'. "
-            "Example: {'category': 'dress', 'colors': ['blue', 'white'], 'style': 'summer casual'}.",
-            image_data
-        ])
-        # Парсим ответ, ожидая JSON
+        name = model_gateway.create_context_cache('chat', contents, CHAT_CONTEXT_CACHE_TTL)
+    except Exception as e:
+        print(f"Context cache creation failed for session {session.id}: {e}")
+        return None
+    if name:
+        session.context_cache_name = name
+        session.context_cache_key = chat_sessions.context_cache_key(model_name, preamble_text, through_id)
+        session.context_cache_through = through_id
+        # Запас в минуту, чтобы не сослаться на кэш, который провайдер уже удалил
+        session.context_cache_expires_at = datetime.utcnow() + timedelta(seconds=max(0, CHAT_CONTEXT_CACHE_TTL - 60))
+    return name
+
+def _save_chat_turn(session, message, image_key, response_text):
+    now = datetime.utcnow()
+    db.session.add(ChatMessage(session_id=session.id, role='user', text=message, image_key=image_key,
+                               tokens=chat_sessions.message_tokens(message, image_key is not None), created_at=now))
+    reply = ChatMessage(session_id=session.id, role='model', text=response_text,
+                        tokens=chat_sessions.message_tokens(response_text), created_at=now)
+    db.session.add(reply)
+    if image_key:
+        session.pinned_image_key = image_key
+    session.updated_at = now
+    db.session.commit()
+    return reply
+
+@bp.route('/chat/sessions', methods=['POST'])
+def create_chat_session():
+    data = request.get_json(silent=True) or {}
+    user_id = data.get('user_id')
+    if user_id is not None and not db.session.query(exists().where(User.id == user_id)).scalar():
+        return jsonify({"error": "User not found"}), 404
+    session = ChatSession(id=uuid.uuid4().hex, user_id=user_id,
+                          body_type=str(data.get('body_type') or 'стандартный')[:100])
+    db.session.add(session)
+    db.session.commit()
+    return jsonify({"session_id": session.id, "body_type": session.body_type}), 201
+
+@bp.route('/chat/sessions/<session_id>', methods=['GET'])
+@max_queries(2)
+def get_chat_session(session_id):
+    session = db.session.get(ChatSession, session_id)
+    if session is None:
+        return jsonify({"error": "Chat session not found"}), 404
+    messages = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.id).all()
+    return jsonify({
+        "session_id": session.id,
+        "body_type": session.body_type,
+        "summary": session.summary,
+        "summarized_through": session.summarized_through,
+        "messages": [message.to_dict() for message in messages],
+    }), 200
+
+@bp.route('/chat/sessions/<session_id>', methods=['DELETE'])
+def delete_chat_session(session_id):
+    session = db.session.get(ChatSession, session_id)
+    if session is None:
+        return jsonify({"error": "Chat session not found"}), 404
+    # Фото остаются в хранилище: ключи по содержимому могут использоваться другими сессиями
+    ChatMessage.query.filter_by(session_id=session_id).delete()
+    db.session.delete(session)
+    db.session.commit()
+    return jsonify({"message": "Chat session deleted"}), 200
+
+@bp.route('/chat/sessions/<session_id>/messages', methods=['POST'])
+@admission.limit('chat', providers=('gemini',), prompt_fields=('message',), upload=True)
+def post_chat_message(session_id):
+    """
+    Реплика в сессии. Ответ: {"response", "message_id", "image_id", "context": {...}};
+    "stream" - как у /chat (SSE или JSON-строки).
+    """
+    try:
+        message, image_bytes, image_id, data = _chat_message_input()
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid image: {e}"}), 400
+
+    session = db.session.get(ChatSession, session_id)
+    if session is None:
+        return jsonify({"error": "Chat session not found"}), 404
+    # Несжатые реплики, новые последними; для окна хватает последних CHAT_SESSION_MAX_MESSAGES
+    history = ChatMessage.query.filter(ChatMessage.session_id == session_id,
+                                       ChatMessage.id > session.summarized_through) \
+        .order_by(ChatMessage.id.desc()).limit(CHAT_SESSION_MAX_MESSAGES).all()[::-1]
+
+    image_key = None
+    if image_bytes:
         try:
-            # Улучшенное удаление ```json и ``` для более надежного парсинга
-            text_response = response.text.strip()
-            if text_response.startswith("```json"):
-                text_response = text_response[len("```json"):].strip()
-            if text_response.endswith("```"):
-                text_response = text_response[:-len("```")].strip()
-            return text_response
-        except ValueError: # Если не удалось удалить маркеры
-            return response.text.strip()
+            image_key = _store_chat_image(image_bytes)
+        except Exception as e:
+            return jsonify({"error": f"Could not process the image: {e}"}), 400
+    elif image_id:
+        known = [m.image_key for m in history if m.image_key] + [session.pinned_image_key]
+        image_key = next((key for key in known if key and sha256_from_key(key) == image_id), None)
+        if image_key is None:
+            return jsonify({"error": "Unknown image_id for this session"}), 404
+    if not message and not image_key:
+        return jsonify({"error": "No message or image provided. Please send a message or an image."}), 400
+    message = message or "Что скажешь об этом фото?"
+
+    # Окно истории по бюджету токенов; отброшенные реплики - в сводку. Пока действует кэш
+    # контекста, окно - реплики после закэшированных, а сводка не нужна
+    current_tokens = chat_sessions.message_tokens(message, image_key is not None)
+    preamble_text = chat_session_preamble(session.body_type, session.summary)
+    preamble_tokens = chat_sessions.estimate_tokens(preamble_text) \
+        + (chat_sessions.IMAGE_TOKENS if session.pinned_image_key else 0)
+    reused = _reuse_chat_context_cache(session, history, preamble_text, current_tokens)
+    summarized = False
+    if reused:
+        cache_name, window = reused
+        older = []
+        cached_tokens = preamble_tokens + sum(m.tokens for m in history if m.id <= session.context_cache_through)
+    else:
+        cache_name, cached_tokens = None, 0
+        older, window = chat_sessions.split_window(history,
+                                                   CHAT_HISTORY_TOKEN_BUDGET - current_tokens - preamble_tokens)
+        if len(history) == CHAT_SESSION_MAX_MESSAGES:
+            # История прочитана не целиком: кандидаты в сводку - от summarized_through, а не из прочитанного
+            before_id = window[0].id if window else history[-1].id + 1
+            older = _chat_summary_candidates(session, before_id)
+        if older and sum(m.tokens for m in older) >= CHAT_SUMMARY_MIN_TOKENS:
+            summarized = _summarize_chat(session, older)
+
+    try:
+        turns = [chat_sessions.turn(m.role, m.text, _chat_image_part(m.image_key) if m.image_key else None)
+                 for m in window]
+        current_turn = chat_sessions.turn('user', message, _chat_image_part(image_key) if image_key else None)
+        if cache_name:
+            contents = turns + [current_turn]
+        else:
+            window_images = {m.image_key for m in window if m.image_key}
+            pinned = session.pinned_image_key if session.pinned_image_key not in window_images | {image_key} else None
+            preamble_text = chat_session_preamble(session.body_type, session.summary)
+            preamble = chat_sessions.preamble_contents(preamble_text, _chat_image_part(pinned) if pinned else None)
+            # Вступление с окном не меняется до следующего пересчета окна - кандидат в кэш контекста
+            stable_tokens = preamble_tokens + sum(m.tokens for m in window)
+            cache_name = _create_chat_context_cache(session, preamble_text, preamble + turns, stable_tokens,
+                                                    window[-1].id if window else None)
+            if cache_name:
+                cached_tokens = stable_tokens
+            contents = [current_turn] if cache_name else preamble + turns + [current_turn]
+    except Exception as e:
+        print(f"Error loading chat session images: {e}")
+        return jsonify({"error": f"Could not load session images: {e}"}), 500
+
+    kwargs = {"cached_content": cache_name} if cache_name else {}
+    context = {
+        "window_messages": len(window),
+        "dropped_messages": len(older),
+        "summarized": summarized,
+        "estimated_tokens": (cached_tokens if reused else preamble_tokens) + sum(m.tokens for m in window)
+        + current_tokens,
+        "context_cache": cache_name is not None,
+        "cached_tokens": cached_tokens,
+    }
+    response_image_id = sha256_from_key(image_key) if image_key else None
+    db.session.commit() # Сводка и кэш контекста сохраняются даже при ошибке модели
+
+    fmt = stream_format(request, data)
+    if fmt:
+        event = sse_event if fmt == 'sse' else ndjson_line
+        mimetype, headers = stream_headers(fmt)
+
+        def generate():
+            yield event({"status": "started", "image_id": response_image_id, "context": context}, "start")
+            chunks = []
+            try:
+                for text in model_gateway.generate_task_stream('chat', contents, **kwargs):
+                    chunks.append(text)
+                    yield event({"text": text}, "token")
+                reply = _save_chat_turn(db.session.get(ChatSession, session_id), message, image_key, ''.join(chunks))
+                yield event({"response": ''.join(chunks), "message_id": reply.id}, "done")
+            except Exception as e:
+                print(f"Ошибка при потоковом взаимодействии с Gemini API: {e}")
+                yield event({
+                    "error": f"Извините, произошла ошибка при получении рекомендаций от AI: {e}",
+                    "response": ''.join(chunks)
+                }, "error")
+
+        return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+    try:
+        response_text = model_gateway.generate_task('chat', contents, **kwargs)
+    except Exception as e:
+        print(f"Ошибка при взаимодействии с Gemini API: {e}")
+        return jsonify({"error": f"Извините, произошла ошибка при получении рекомендаций от AI: {e}"}), 502
+    reply = _save_chat_turn(session, message, image_key, response_text)
+    return jsonify({
+        "session_id": session_id,
+        "response": response_text,
+        "message_id": reply.id,
+        "image_id": response_image_id,
+        "context": context
+    }), 200
+
+
+def _analyze_image(task, namespace, prompt, schema, image_bytes):
+    """
+    Общая часть анализа фото: кэш, нормализация изображения, запрос к модели и разбор
+    ответа по схеме (structured_output). Возвращает JSON-строку; если ответ разобрать
+    не удалось - исходный текст модели, при ошибке вызова - None.
+    """
+    cached = _cached_analysis(namespace, image_bytes)
+    if cached is not None:
+        return cached
+
+    with stage('image.normalize'):
+        image_data = normalize_image(image_bytes).as_part() # Ошибки декодирования пробрасываем в роут
+    result = generate_structured(model_gateway, task, [prompt, image_data], schema)
+    if not result.ok:
+        print(f"Warning: {task} response did not match the schema ({result.error}): {result.text}")
+        return result.text.strip()
+    text_response = json.dumps(result.value, ensure_ascii=False)
+    _store_analysis(namespace, image_bytes, text_response)
+    return text_response
+
+# Функция для анализа изображения с помощью Gemini Pro Vision
+# Принимает байты изображения: повторная загрузка того же фото отдается из кэша без вызова модели.
+@stage('analysis.garment')
+def analyze_image_with_gemini(image_bytes):
+    try:
+        return _analyze_image('garment_analysis', f"garment:{GARMENT_PROMPT_VERSION}",
+                              GARMENT_ANALYSIS_PROMPT, GARMENT_SCHEMA, image_bytes)
     except Exception as e:
         print(f"Error analyzing image with Gemini: {e}")
         return None
 
+# Анализ фото вещи: сначала локальный классификатор, Gemini - только если он не уверен.
+# Формат ответа тот же (JSON-строка), у локального результата есть "source": "local".
+def analyze_garment(image_bytes):
+    if garment_classifier is not None:
+        with stage('classifier.garment'):
+            classification = garment_classifier.classify(image_bytes)
+        if classification is not None and classification.confident:
+            return json.dumps(classification.to_analysis(), ensure_ascii=False)
+    return analyze_image_with_gemini(image_bytes)
+
 # Функция для анализа селфи пользователя для определения цвета кожи/тона внешности
-def analyze_user_appearance(image_data):
+@stage('analysis.appearance')
+def analyze_user_appearance(image_bytes):
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content([
-            "Analyze this portrait image of a person. Identify their primary skin tone (e.g., fair, light, medium, dark), and describe their overall appearance tone (e.g., warm, cool, neutral). "
-            "Return the answer as a JSON object with keys: 'skin_tone', 'appearance_tone'. "
-            "Example: {'skin_tone': 'light', 'appearance_tone': 'cool'}.",
-            image_data
-        ])
-        try:
-            text_response = response.text.strip()
-            if text_response.startswith("```json"):
-                text_response = text_response[len("```json"):].strip()
-            if text_response.endswith("```"):
-                text_response = text_response[:-len("```")].strip()
-            return text_response
-        except ValueError:
-            return response.text.strip()
+        return _analyze_image('appearance_analysis', f"appearance:{APPEARANCE_PROMPT_VERSION}",
+                              APPEARANCE_ANALYSIS_PROMPT, APPEARANCE_SCHEMA, image_bytes)
     except Exception as e:
         print(f"Error analyzing user appearance with Gemini: {e}")
         return None
 
 
 # Функция для генерации изображения одежды (Используем Replicate)
+@stage('image.generate')
 def generate_clothing_image(prompt):
-    output = replicate.run(
-        "stability-ai/stable-diffusion:ac732df830a8c0147c2eed5740b2f7667232142477c8ce6d2aca4e79ae402766",
-        input={"prompt": prompt}
-    )
+    output = model_gateway.run_task('image', {"prompt": prompt})
     if output and isinstance(output, list) and len(output) > 0:
         return output[0]  # Возвращаем URL сгенерированного изображения
     return None
 
 # --- НОВЫЕ РОУТЫ ДЛЯ БАЗЫ ДАННЫХ И ГАРДЕРОБА ---
+# Таблицы создаются и обновляются миграциями (migrations.py): flask --app app db upgrade
 
-# Переименовал, чтобы не было дублирования с create_db выше,
-# хотя оно и так было исправлено на create_db_tables_route
-# @app.route('/create_db')
-# def create_db_tables():
-#     """Создает таблицы в базе данных. Вызывать ОДИН раз после деплоя."""
-#     try:
-#         with app.app_context(): # Используем app_context для работы с БД
-#             db.create_all()
-#         return "Database tables created successfully!"
-#     except Exception as e:
-#         # Важно: В продакшене лучше не возвращать raw exception, а логировать его.
-#         return f"Error creating database tables: {e}", 500
-
-@app.route('/api/user/add', methods=['POST'])
+@bp.route('/api/user/add', methods=['POST'])
 def add_user():
     data = request.json
     username = data.get('username')
@@ -260,17 +1034,34 @@ def add_user():
         return jsonify({"error": "Username is required"}), 400
 
     try:
-        with app.app_context():
-            new_user = User(username=username, email=f"{username}@example.com") # Добавьте email, так как он nullable=False
-            db.session.add(new_user)
-            db.session.commit()
-            return jsonify({"message": "User added successfully", "user_id": new_user.id}), 201
+        new_user = User(username=username, email=f"{username}@example.com") # Добавьте email, так как он nullable=False
+        db.session.add(new_user)
+        db.session.commit()
+        return jsonify({"message": "User added successfully", "user_id": new_user.id}), 201
     except Exception as e:
         # Логируем ошибку для отладки
         print(f"Error adding user: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/wardrobe/add/<int:user_id>', methods=['POST'])
+@stage('json.parse')
+def parse_garment_analysis(analysis_result):
+    """
+    Разбирает ответ analyze_garment (локальный классификатор или Gemini).
+    Возвращает (parsed_analysis, category, color, style); при ошибке - "unknown".
+    """
+    if analysis_result:
+        try:
+            parsed_analysis = json.loads(analysis_result) # Парсим JSON
+            category = parsed_analysis.get('category') or "unknown"
+            color = ','.join(parsed_analysis.get('colors', [])) # Преобразуем список в строку
+            style = parsed_analysis.get('style')
+            return parsed_analysis, category, color, style
+        except (json.JSONDecodeError, AttributeError, TypeError):
+            print(f"Warning: Gemini analysis not in expected JSON format: {analysis_result}")
+    return {}, "unknown", "unknown", "unknown"
+
+@bp.route('/api/wardrobe/add/<int:user_id>', methods=['POST'])
+@admission.limit('analysis', providers=('gemini',), upload=True)
 def add_wardrobe_item(user_id):
     if 'image' not in request.files:
         return jsonify({"error": "No image part in the request"}), 400
@@ -278,146 +1069,507 @@ def add_wardrobe_item(user_id):
     if file.filename == '':
         return jsonify({"error": "No selected image"}), 400
 
-    # Здесь нужно реализовать загрузку изображения на облачное хранилище (например, Cloudinary, AWS S3)
-    # Для простоты примера, мы пока просто "анализируем" и предполагаем URL
-    # В реальном приложении:
-    # 1. Загружаем file на облачное хранилище
-    # 2. Получаем public_url
-    # image_url_from_cloud = "https://example.com/your_uploaded_image.jpg" # ЗАМЕНИТЕ НА РЕАЛЬНЫЙ URL
+    if not db.session.query(exists().where(User.id == user_id)).scalar():
+        return jsonify({"error": "User not found"}), 404
 
-    # Пока что для теста: считываем изображение для анализа
-    image_data = Image.open(BytesIO(file.read()))
+    # Загрузка потоково пишется во временный файл (storage.py); в хранилище оригинал попадает
+    # только вместе со строкой вещи, одинаковые фото хранятся один раз
+    try:
+        with image_store.ingest(file.stream, store=False) as upload:
+            try:
+                # Анализ и эмбеддинг - по уменьшенной копии (IMAGE_MAX_EDGE): оригинал в память не читается
+                with stage('image.normalize'), upload.open() as f:
+                    image_bytes = normalize_image(f).data
+            except Exception as e:
+                return jsonify({"error": f"Cannot decode image: {e}"}), 400
+            try:
+                # Анализ изображения одежды: локальный классификатор, при неуверенности - Gemini
+                # (или кэш, если фото уже анализировали)
+                analysis_result = analyze_garment(image_bytes)
+                parsed_analysis, category, color, style = parse_garment_analysis(analysis_result)
+                embedding = compute_embedding(image_bytes)
+            except Exception as e:
+                print(f"Error processing wardrobe image: {e}")
+                return jsonify({"error": str(e)}), 500
 
-    # Анализ изображения одежды с помощью Gemini
-    analysis_result = analyze_image_with_gemini(image_data)
-    
-    parsed_analysis = {} # Инициализация для случая, если парсинг не удался
-    if analysis_result:
-        try:
-            parsed_analysis = json.loads(analysis_result) # Парсим JSON
-            category = parsed_analysis.get('category')
-            color = ','.join(parsed_analysis.get('colors', [])) # Преобразуем список в строку
-            style = parsed_analysis.get('style')
-        except json.JSONDecodeError:
-            category = "unknown"
-            color = "unknown"
-            style = "unknown"
-            print(f"Warning: Gemini analysis not in expected JSON format: {analysis_result}")
-    else:
-        category = "unknown"
-        color = "unknown"
-        style = "unknown"
+            stored = False
+            try:
+                possible_duplicate = find_duplicate(user_id, embedding)
+                new_item = WardrobeItem(
+                    user_id=user_id,
+                    image_url=media_url(upload.key),
+                    image_key=upload.key,
+                    category=category,
+                    color=color,
+                    style=style,
+                    item_type=category, # Использование category как item_type
+                    embedding=vector_to_bytes(embedding) if embedding is not None else None
+                )
+                db.session.add(new_item)
+                db.session.flush()
+                index_item_attributes([new_item])
+                stored = image_store.save(upload)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                _discard_original(upload.key, stored)
+                print(f"Error adding wardrobe item: {e}")
+                return jsonify({"error": str(e)}), 500
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    index_item_embeddings([new_item])
+    image_store.schedule_thumbnails([upload.key])
+    return jsonify({
+        "message": "Wardrobe item added successfully",
+        "item_id": new_item.id,
+        **item_image_urls(upload.key, new_item.image_url),
+        "analysis": parsed_analysis, # Отправляем клиенту, чтобы он видел
+        "possible_duplicate": possible_duplicate # Похожая вещь уже есть в гардеробе
+    }), 201
+
+def _discard_original(key, stored):
+    """Удаляет оригинал, записанный для несохраненной вещи, если на него не ссылается другая вещь."""
+    if not stored:
+        return
+    try:
+        if not db.session.query(exists().where(WardrobeItem.image_key == key)).scalar():
+            image_store.backend.delete(key)
+    except Exception as e:
+        print(f"Error removing orphaned original {key}: {e}")
+
+# --- Пакетная загрузка гардероба ---
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 200))
+BATCH_MAX_FILE_BYTES = int(os.environ.get('BATCH_MAX_FILE_BYTES', 20 * 1024 * 1024))
+BATCH_ANALYSIS_CONCURRENCY = int(os.environ.get('BATCH_ANALYSIS_CONCURRENCY', 8))
+BATCH_SLOT_WAIT = float(os.environ.get('BATCH_SLOT_WAIT', 30)) # Сколько элемент ждет свободный слот Gemini
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic', '.bmp', '.gif')
+
+def _spool_upload(file, spooled_files):
+    # Копируем загрузку в собственный временный файл: потоковый ответ живет дольше,
+    # чем файлы запроса, а маленькие изображения так и останутся в памяти
+    spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    shutil.copyfileobj(file.stream, spool)
+    spool.seek(0)
+    spooled_files.append(spool)
+    return spool
+
+def _collect_batch_uploads(spooled_files):
+    """
+    Собирает изображения из multipart-полей 'images' и/или zip-архива в поле 'archive'.
+    Возвращает список (filename, loader): байты читаются лениво, уже внутри воркера,
+    чтобы в памяти одновременно было не больше BATCH_ANALYSIS_CONCURRENCY изображений.
+    """
+    uploads = []
+    for file in request.files.getlist('images'):
+        if file.filename:
+            spool = _spool_upload(file, spooled_files)
+            uploads.append((file.filename, spool.read))
+
+    archive = request.files.get('archive')
+    if archive and archive.filename:
+        zf = zipfile.ZipFile(_spool_upload(archive, spooled_files))
+        for info in zf.infolist():
+            name = info.filename
+            if info.is_dir() or name.startswith('__MACOSX/') or not name.lower().endswith(BATCH_IMAGE_EXTENSIONS):
+                continue
+            if info.file_size > BATCH_MAX_FILE_BYTES:
+                uploads.append((name, None)) # Слишком большой файл - сообщим об ошибке по этому элементу
+                continue
+            uploads.append((name, lambda info=info: zf.read(info)))
+    return uploads
+
+@bp.route('/api/wardrobe/add_batch/<int:user_id>', methods=['POST'])
+# Размер файлов ограничивает BATCH_MAX_FILE_BYTES; слот Gemini - на каждый анализ, а не на весь пакет
+@admission.limit('batch', providers=('gemini',), hold=False)
+def add_wardrobe_items_batch(user_id):
+    """
+    Пакетное добавление вещей: много файлов в 'images' (multipart) или zip в 'archive'.
+    Изображения анализируются параллельно (не больше BATCH_ANALYSIS_CONCURRENCY одновременно),
+    прогресс отдается потоком JSON-строк (application/x-ndjson) по мере готовности,
+    а все WardrobeItem сохраняются одной транзакцией в конце.
+    """
+    if not db.session.query(exists().where(User.id == user_id)).scalar():
+        return jsonify({"error": "User not found"}), 404
 
-    mock_image_url = f"https://placehold.co/600x400/png?text=Item_{user_id}_{file.filename}"
+    spooled_files = []
+    def cleanup():
+        for spool in spooled_files:
+            spool.close()
 
     try:
-        with app.app_context():
-            user = User.query.get(user_id)
-            if not user:
-                return jsonify({"error": "User not found"}), 404
-
-            new_item = WardrobeItem(
-                user_id=user_id,
-                image_url=mock_image_url, # Замените на реальный URL с облака!
-                category=category,
-                color=color,
-                style=style,
-                item_type=category # Использование category как item_type
-            )
-            db.session.add(new_item)
+        uploads = _collect_batch_uploads(spooled_files)
+    except zipfile.BadZipFile:
+        cleanup()
+        return jsonify({"error": "Archive is not a valid zip file"}), 400
+    if not uploads or len(uploads) > BATCH_MAX_ITEMS:
+        cleanup()
+        if not uploads:
+            return jsonify({"error": "No images in the request"}), 400
+        return jsonify({"error": f"Too many images, maximum is {BATCH_MAX_ITEMS}"}), 400
+
+    def analyze(index, filename, loader):
+        if loader is None:
+            raise ValueError("File is too large")
+        image_bytes = loader()
+        if len(image_bytes) > BATCH_MAX_FILE_BYTES:
+            raise ValueError("File is too large")
+        with image_store.ingest(BytesIO(image_bytes)) as upload:
+            image_key = upload.key
+        with admission.provider_slot('gemini', wait=BATCH_SLOT_WAIT):
+            parsed = parse_garment_analysis(analyze_garment(image_bytes))
+        return parsed + (compute_embedding(image_bytes), image_key)
+
+    def progress():
+        total = len(uploads)
+        results = {}
+        failed = []
+
+        try:
+            with ThreadPoolExecutor(max_workers=BATCH_ANALYSIS_CONCURRENCY) as executor:
+                futures = {
+                    executor.submit(analyze, index, filename, loader): (index, filename)
+                    for index, (filename, loader) in enumerate(uploads)
+                }
+                for done, future in enumerate(as_completed(futures), start=1):
+                    index, filename = futures[future]
+                    try:
+                        results[index] = future.result()
+                        line = {"index": index, "filename": filename, "status": "analyzed",
+                                "analysis": results[index][0]}
+                    except Exception as e:
+                        print(f"Error analyzing batch item {filename}: {e}")
+                        failed.append({"index": index, "filename": filename, "error": str(e)})
+                        line = {"index": index, "filename": filename, "status": "failed", "error": str(e)}
+                    line["progress"] = {"done": done, "total": total}
+                    yield json.dumps(line) + "\n"
+        finally:
+            cleanup()
+
+        # Все успешно проанализированные вещи - одной транзакцией
+        created = []
+        try:
+            new_items = []
+            duplicates = []
+            for index in sorted(results):
+                _, category, color, style, embedding, image_key = results[index]
+                duplicates.append(find_duplicate(user_id, embedding))
+                new_items.append(WardrobeItem(
+                    user_id=user_id,
+                    image_url=media_url(image_key),
+                    image_key=image_key,
+                    category=category,
+                    color=color,
+                    style=style,
+                    item_type=category,
+                    embedding=vector_to_bytes(embedding) if embedding is not None else None
+                ))
+            db.session.add_all(new_items)
+            db.session.flush()
+            index_item_attributes(new_items)
             db.session.commit()
-            return jsonify({
-                "message": "Wardrobe item added successfully",
-                "item_id": new_item.id,
-                "analysis": parsed_analysis # Отправляем клиенту, чтобы он видел
-            }), 201
-    except Exception as e:
-        print(f"Error adding wardrobe item: {e}")
-        return jsonify({"error": str(e)}), 500
+            index_item_embeddings(new_items)
+            image_store.schedule_thumbnails({item.image_key for item in new_items})
+            created = [{"index": index, "filename": uploads[index][0], "item_id": item.id,
+                        "possible_duplicate": duplicate, **item_image_urls(item.image_key, item.image_url)}
+                       for index, item, duplicate in zip(sorted(results), new_items, duplicates)]
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error saving wardrobe batch: {e}")
+            failed.extend({"index": index, "filename": uploads[index][0], "error": f"Not saved: {e}"}
+                          for index in sorted(results))
+
+        yield json.dumps({
+            "status": "done",
+            "user_id": user_id,
+            "created": created,
+            "failed": sorted(failed, key=lambda item: item["index"]),
+        }) + "\n"
+
+    return Response(stream_with_context(progress()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+WARDROBE_LIST_FIELDS = ('id', 'image_url', 'thumbnail_url', 'thumbnails', 'category', 'color', 'style',
+                        'item_type', 'added_date')
+# Вычисляемые поля строятся из image_key/image_url
+WARDROBE_LIST_URL_FIELDS = ('image_url', 'thumbnail_url', 'thumbnails')
+# По умолчанию список отдает миниатюры, ссылка на оригинал - только по запросу (fields=image_url)
+WARDROBE_LIST_DEFAULT_FIELDS = ('id', 'thumbnail_url', 'thumbnails', 'category', 'color', 'style',
+                                'item_type', 'added_date')
+WARDROBE_LIST_DEFAULT_LIMIT = 100
+WARDROBE_LIST_MAX_LIMIT = 500
+
+def _parse_list_args(args):
+    """Разбирает параметры списка гардероба. Ошибку возвращает строкой."""
+    try:
+        limit = int(args.get('limit', WARDROBE_LIST_DEFAULT_LIMIT))
+        cursor = int(args['cursor']) if args.get('cursor') else None
+    except ValueError:
+        return None, "limit and cursor must be integers"
+    if not 1 <= limit <= WARDROBE_LIST_MAX_LIMIT:
+        return None, f"limit must be between 1 and {WARDROBE_LIST_MAX_LIMIT}"
+
+    fields = [f.strip() for f in args.get('fields', ','.join(WARDROBE_LIST_DEFAULT_FIELDS)).split(',') if f.strip()]
+    unknown = [f for f in fields if f not in WARDROBE_LIST_FIELDS]
+    if unknown:
+        return None, f"Unknown fields: {', '.join(unknown)}"
+    if 'id' not in fields:
+        fields.insert(0, 'id') # id нужен для курсора
+
+    dates = {}
+    for name in ('added_after', 'added_before'):
+        if args.get(name):
+            try:
+                dates[name] = datetime.fromisoformat(args[name])
+            except ValueError:
+                return None, f"{name} must be an ISO 8601 date"
+
+    filters = {}
+    for kind in ATTRIBUTE_KINDS:
+        values = [normalize_attribute_value(v) for v in args.get(kind, '').split(',') if v.strip()]
+        if values:
+            filters[kind] = values
+
+    return {"limit": limit, "cursor": cursor, "fields": fields, "filters": filters, **dates}, None
 
-@app.route('/api/wardrobe/list/<int:user_id>', methods=['GET'])
+@bp.route('/api/wardrobe/list/<int:user_id>', methods=['GET'])
+@max_queries(2)
 def list_wardrobe_items(user_id):
+    """
+    Список гардероба с keyset-пагинацией: ?limit=&cursor=<next_cursor из прошлой страницы>.
+    Фильтры: category, color, style (несколько значений через запятую - любое из них),
+    added_after / added_before (ISO 8601). fields - список возвращаемых полей.
+    Поддерживает ETag / If-None-Match.
+    """
+    params, error = _parse_list_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
     try:
-        with app.app_context():
-            user = User.query.get(user_id)
-            if not user:
-                return jsonify({"error": "User not found"}), 404
-            
-            items = WardrobeItem.query.filter_by(user_id=user_id).all()
-            items_data = [{
-                "id": item.id,
-                "image_url": item.image_url,
-                "category": item.category,
-                "color": item.color,
-                "style": item.style,
-                "item_type": item.item_type # Включаем item_type
-            } for item in items]
-            return jsonify({"user_id": user_id, "wardrobe": items_data}), 200
+        url_fields = [field for field in params["fields"] if field in WARDROBE_LIST_URL_FIELDS]
+        columns = [getattr(WardrobeItem, field) for field in params["fields"] if field not in WARDROBE_LIST_URL_FIELDS]
+        if url_fields:
+            columns += [WardrobeItem.image_key, WardrobeItem.image_url.label('stored_image_url')]
+        query = db.session.query(*columns).filter(WardrobeItem.user_id == user_id)
+        if params["cursor"] is not None:
+            query = query.filter(WardrobeItem.id > params["cursor"])
+        for kind, values in params["filters"].items():
+            matching = select(wardrobe_item_attribute.c.item_id) \
+                .join(Attribute, Attribute.id == wardrobe_item_attribute.c.attribute_id) \
+                .where(wardrobe_item_attribute.c.user_id == user_id,
+                       Attribute.kind == kind,
+                       Attribute.value.in_(values))
+            query = query.filter(WardrobeItem.id.in_(matching))
+        if "added_after" in params:
+            query = query.filter(WardrobeItem.added_date >= params["added_after"])
+        if "added_before" in params:
+            query = query.filter(WardrobeItem.added_date < params["added_before"])
+
+        # Берем на одну строку больше, чтобы понять, есть ли следующая страница
+        rows = query.order_by(WardrobeItem.id).limit(params["limit"] + 1).all()
+        # Существование пользователя проверяем, только если страница пуста - обычно это один запрос
+        if not rows and not db.session.query(exists().where(User.id == user_id)).scalar():
+            return jsonify({"error": "User not found"}), 404
+        has_more = len(rows) > params["limit"]
+        rows = rows[:params["limit"]]
+
+        items_data = []
+        for row in rows:
+            item = row._asdict()
+            if url_fields:
+                urls = item_image_urls(item.pop("image_key"), item.pop("stored_image_url"))
+                item.update({field: urls[field] for field in url_fields})
+            if item.get("added_date") is not None:
+                item["added_date"] = item["added_date"].isoformat()
+            items_data.append(item)
+
+        response = jsonify({
+            "user_id": user_id,
+            "wardrobe": items_data,
+            "next_cursor": rows[-1].id if has_more else None
+        })
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.add_etag()
+        return response.make_conditional(request)
     except Exception as e:
         print(f"Error listing wardrobe items: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/outfit/suggest/<int:user_id>', methods=['POST'])
+@bp.route('/api/wardrobe/item/<int:item_id>', methods=['DELETE'])
+@max_queries(4)
+def delete_wardrobe_item(item_id):
+    item = db.session.get(WardrobeItem, item_id)
+    if item is None:
+        return jsonify({"error": "Item not found"}), 404
+    # Фото остаются в хранилище: ключи по содержимому могут использоваться другими вещами
+    db.session.execute(wardrobe_item_attribute.delete().where(wardrobe_item_attribute.c.item_id == item_id))
+    db.session.delete(item) # wardrobe_version пользователя увеличится в after_flush
+    db.session.commit()
+    unindex_item_embeddings([item_id])
+    return jsonify({"message": "Item deleted", "item_id": item_id}), 200
+
+@bp.route('/api/wardrobe/similar/<int:item_id>', methods=['GET'])
+@max_queries(3)
+def similar_wardrobe_items(item_id):
+    """Вещи того же пользователя, похожие на данную (по эмбеддингу изображения). ?limit= до 50."""
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    try:
+        item = db.session.query(WardrobeItem.id, WardrobeItem.user_id, WardrobeItem.embedding) \
+            .filter_by(id=item_id).first()
+        if not item:
+            return jsonify({"error": "Item not found"}), 404
+        if item.embedding is None or len(item.embedding) != image_embedder.dim * 2:
+            return jsonify({"error": "Item has no image embedding"}), 409
+
+        matches = get_similarity_index().search(
+            vector_from_bytes(item.embedding), item.user_id, k=limit, exclude_ids=[item_id])
+        similarity = dict(matches)
+        rows = db.session.query(WardrobeItem.id, WardrobeItem.image_url, WardrobeItem.image_key,
+                                WardrobeItem.category, WardrobeItem.color, WardrobeItem.style,
+                                WardrobeItem.item_type) \
+            .filter(WardrobeItem.id.in_(list(similarity))).all()
+        items_data = sorted(
+            ({"id": row.id, **item_image_urls(row.image_key, row.image_url), "category": row.category,
+              "color": row.color, "style": row.style, "item_type": row.item_type,
+              "similarity": round(similarity[row.id], 4)} for row in rows),
+            key=lambda data: -data["similarity"]
+        )
+        return jsonify({"item_id": item_id, "similar": items_data}), 200
+    except Exception as e:
+        print(f"Error searching similar items: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# Сколько лучших локально подобранных образов отправлять в LLM
+OUTFIT_CANDIDATES = int(os.environ.get('OUTFIT_CANDIDATES', 6))
+# Если образы собрать не удалось (например, в гардеробе одни футболки) - список вещей, но не больше
+OUTFIT_PROMPT_MAX_ITEMS = int(os.environ.get('OUTFIT_PROMPT_MAX_ITEMS', 60))
+
+def _stream_outfits_response(user_id, gemini_prompt, fmt, event_name, cache_context, cached):
+    """
+    Потоковый ответ suggest_outfit. События: start, outfit ({"index", "outfit"}) для каждого
+    образа сразу после того, как модель закрыла его JSON-объект, в конце done или error.
+    """
+    event = sse_event if fmt == 'sse' else ndjson_line
+    mimetype, headers = stream_headers(fmt)
+
+    def generate():
+        yield event({"status": "started", "user_id": user_id}, "start")
+        if cached is not None:
+            for index, outfit in enumerate(cached):
+                yield event({"index": index, "outfit": outfit}, "outfit")
+            yield event({"user_id": user_id, "suggested_outfits": cached, "cached": True}, "done")
+            return
+        parser = JSONArrayStreamParser(OUTFIT_SCHEMA)
+        outfits = []
+        try:
+            for text in model_gateway.generate_task_stream('outfit', gemini_prompt):
+                for outfit in parser.feed(text):
+                    yield event({"index": len(outfits), "outfit": outfit}, "outfit")
+                    outfits.append(outfit)
+        except Exception as e:
+            print(f"Error streaming outfit suggestions: {e}")
+            yield event({"error": str(e), "suggested_outfits": outfits}, "error")
+            return
+
+        if not outfits:
+            record_outcome('outfit', 'failed')
+            print(f"Warning: Gemini outfit suggestion not in expected JSON format: {parser.full_text}")
+            yield event({"error": "Could not parse Gemini's outfit suggestions. Raw response: " + parser.full_text}, "error")
+            return
+        record_outcome('outfit', 'tolerant' if parser.tolerant or parser.dropped else 'strict')
+        cache_response('outfit', event_name, cache_context, outfits)
+        yield event({"user_id": user_id, "suggested_outfits": outfits, "cached": False}, "done")
+
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+@bp.route('/api/outfit/suggest/<int:user_id>', methods=['POST'])
+@admission.limit('outfit', providers=('gemini',), prompt_fields=('event',))
+@max_queries(2)
 def suggest_outfit(user_id):
+    """
+    Подбор образов. Сначала образы ранжируются локально (outfit_engine),
+    в Gemini уходят только лучшие кандидаты - для выбора и объяснения.
+    {"offline": true} возвращает локальный рейтинг без вызова модели.
+    """
     data = request.json
     event = data.get('event', 'casual') # Тип мероприятия
-    user_appearance_info = data.get('user_appearance_info', {}) # Например, цвет кожи, если анализировали селфи
+    user_appearance_info = data.get('user_appearance_info') or {} # По умолчанию - сохраненный профиль внешности
+    offline = bool(data.get('offline')) or request.args.get('offline') == '1'
+    if offline:
+        try:
+            count = int(data.get('count', 3))
+        except (TypeError, ValueError):
+            return jsonify({"error": "count must be an integer"}), 400
+        count = min(max(count, 1), OUTFIT_CANDIDATES) # Больше кандидатов engine.rank не возвращает
 
     try:
-        with app.app_context():
-            user = User.query.get(user_id)
-            if not user:
-                return jsonify({"error": "User not found"}), 404
-            
-            # Получаем все вещи пользователя из БД
-            user_wardrobe = WardrobeItem.query.filter_by(user_id=user_id).all()
-            if not user_wardrobe:
-                return jsonify({"message": "No items in wardrobe to suggest an outfit."}), 200
-
-            wardrobe_description = ""
-            for item in user_wardrobe:
-                wardrobe_description += f"- {item.category} ({item.color}, {item.style})\n"
-            
-            # Расширенный промпт для Gemini
-            gemini_prompt = (
-                f"You are a professional fashion stylist. A user wants an outfit for a '{event}' event. "
-                f"Their wardrobe contains the following items:\n{wardrobe_description}\n"
-                f"User's appearance: {user_appearance_info.get('skin_tone', 'unknown')} skin tone, {user_appearance_info.get('appearance_tone', 'unknown')} tone. "
-                "Suggest 2-3 complete outfit combinations using ONLY items from this wardrobe. "
-                "For each outfit, list the specific items (e.g., 'blue jeans', 'white t-shirt') and explain why it's a good choice for the event and user's appearance. "
-                "Present the outfits as a list of dictionaries, where each dictionary has 'outfit_name', 'items' (list of strings), and 'reason'."
-                "Example: "
-                "[\n"
-                "  {\n"
-                "    \"outfit_name\": \"Classic Evening\",\n"
-                "    \"items\": [\"black dress\", \"silver heels\"],\n"
-                "    \"reason\": \"Elegant and timeless for an evening event.\"\n"
-                "  },\n"
-                "  {\n"
-                "    \"outfit_name\": \"Casual Day Out\",\n"
-                "    \"items\": [\"blue jeans\", \"white t-shirt\", \"sneakers\"],\n"
-                "    \"reason\": \"Comfortable and stylish for a relaxed day.\"\n"
-                "  }\n"
-                "]"
-            )
-
-            model = genai.GenerativeModel('gemini-pro') # Используем Gemini Pro для текстового анализа
-            gemini_response = model.generate_content(gemini_prompt)
-            
-            suggested_outfits = []
-            try:
-                # Опять же, более надежная очистка и парсинг
-                raw_text = gemini_response.text.strip()
-                if raw_text.startswith("```json"):
-                    raw_text = raw_text[len("```json"):].strip()
-                if raw_text.endswith("```"):
-                    raw_text = raw_text[:-len("```")].strip()
-                suggested_outfits = json.loads(raw_text)
-            except json.JSONDecodeError:
-                suggested_outfits = [{"error": "Could not parse Gemini's outfit suggestions. Raw response: " + gemini_response.text}]
-                print(f"Warning: Gemini outfit suggestion not in expected JSON format: {gemini_response.text}")
+        # Версия гардероба и сохраненный профиль внешности - одним запросом
+        user = db.session.query(User.wardrobe_version, AppearanceProfile.skin_tone,
+                                AppearanceProfile.appearance_tone) \
+            .outerjoin(AppearanceProfile, AppearanceProfile.id == current_appearance_profile_id()) \
+            .filter(User.id == user_id).first()
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        # Селфи анализируется один раз (/api/user/add_appearance); переданное клиентом - приоритетнее
+        stored_appearance = {key: value for key, value in
+                             (("skin_tone", user.skin_tone), ("appearance_tone", user.appearance_tone)) if value}
+        user_appearance_info = {**stored_appearance, **user_appearance_info}
+
+        # Тот же event для неизмененного гардероба и той же внешности - ответ из кэша,
+        # без загрузки гардероба и вызова модели
+        fmt = stream_format(request, data)
+        cache_context = {
+            "user_id": user_id,
+            "wardrobe_version": user.wardrobe_version,
+            "appearance": user_appearance_info,
+        }
+        cached = None if offline else cached_response('outfit', event, cache_context)
+        if cached is not None and not fmt:
+            return jsonify({"user_id": user_id, "suggested_outfits": cached, "cached": True}), 200
+
+        # Получаем вещи пользователя из БД - только поля, нужные для подбора образов
+        user_wardrobe = db.session.query(WardrobeItem.id, WardrobeItem.category, WardrobeItem.color,
+                                         WardrobeItem.style) \
+            .filter_by(user_id=user_id).order_by(WardrobeItem.id).all()
+        if not user_wardrobe:
+            return jsonify({"message": "No items in wardrobe to suggest an outfit."}), 200
+
+        engine = OutfitEngine(user_wardrobe)
+        candidates = engine.rank(event, user_appearance_info.get('appearance_tone'), top_k=OUTFIT_CANDIDATES)
+
+        if offline:
+            return jsonify({"user_id": user_id, "suggested_outfits": candidates[:count], "mode": "offline"}), 200
+
+        candidate_lines = [
+            f"{number}. " + ", ".join(candidate["items"])
+            for number, candidate in enumerate(candidates, start=1)
+        ]
+        # Если образы собрать не удалось - отдаем модели список вещей
+        item_lines = None if candidate_lines else [
+            f"- {item.category} ({item.color}, {item.style})" for item in user_wardrobe[:OUTFIT_PROMPT_MAX_ITEMS]
+        ]
+
+        # Расширенный промпт для Gemini (текст - в prompts.py)
+        gemini_prompt = outfit_prompt(event, user_appearance_info, candidate_lines, item_lines)
 
-            return jsonify({"user_id": user_id, "suggested_outfits": suggested_outfits}), 200
+        # Потоковый режим: каждый образ отправляется, как только модель его дописала
+        if fmt:
+            return _stream_outfits_response(user_id, gemini_prompt, fmt, event, cache_context, cached)
+
+        # Используем Gemini Pro для текстового анализа; ответ разбирается по схеме (structured_output)
+        result = generate_structured(model_gateway, 'outfit', gemini_prompt, OUTFITS_SCHEMA)
+        if result.ok:
+            suggested_outfits = result.value
+            cache_response('outfit', event, cache_context, suggested_outfits)
+        else:
+            suggested_outfits = [{"error": "Could not parse Gemini's outfit suggestions. Raw response: " + result.text}]
+            print(f"Warning: Gemini outfit suggestion not in expected JSON format: {result.text}")
+
+        return jsonify({"user_id": user_id, "suggested_outfits": suggested_outfits, "cached": False}), 200
 
     except Exception as e:
         print(f"Error suggesting outfit: {e}")
@@ -425,24 +1577,95 @@ def suggest_outfit(user_id):
 
 
 # --- Роут для генерации изображения (по желанию) ---
-@app.route('/generate', methods=['POST'])
+# Генерация выполняется в фоне: POST /generate сразу возвращает id задачи,
+# статус и результат - через GET /generate/<job_id> или SSE /generate/<job_id>/events.
+# Очередь создается в create_app() для каждого приложения: get_generation_jobs() берет ее из текущего
+def get_generation_jobs():
+    return current_app.extensions['generation_jobs']
+
+# {"wait": true} держит поток воркера до результата - не дольше этого срока (секунды)
+GENERATION_MAX_WAIT = float(os.environ.get('GENERATION_MAX_WAIT', 30))
+
+@bp.route('/generate', methods=['POST'])
+@admission.limit('generate', prompt_fields=('prompt',)) # Replicate вызывается в фоне - очередь ограничивает max_pending
 def generate_image():
     data = request.json
     prompt = data.get('prompt')
 
     if not prompt:
         return jsonify({"error": "Prompt is required"}), 400
+    wait_timeout = None
+    if data.get('wait'):
+        try:
+            wait_timeout = float(data.get('timeout', GENERATION_MAX_WAIT))
+        except (TypeError, ValueError):
+            wait_timeout = None
+        if wait_timeout is None or wait_timeout != wait_timeout: # nan
+            return jsonify({"error": "timeout must be a number of seconds"}), 400
+        wait_timeout = min(max(wait_timeout, 0.0), GENERATION_MAX_WAIT)
 
-    # Вызываем функцию генерации изображения
-    image_url = generate_clothing_image(prompt)
+    try:
+        job, created = get_generation_jobs().submit(prompt)
+    except JobQueueFullError as e:
+        # Очередь генерации заполнена - сбрасываем нагрузку, клиент повторит позже
+        return rejection_response(Rejected(429, str(e), retry_after=admission.shed_retry_after))
+
+    # Старое поведение для клиентов, которым нужен сразу URL: {"wait": true}; не дождались - 202 со статусом
+    if wait_timeout is not None:
+        job = get_generation_jobs().wait(job.id, timeout=wait_timeout)
+        if job.status == 'succeeded':
+            return jsonify({"image_url": job.result_url, "job_id": job.id}), 200
+        if job.status == 'failed':
+            return jsonify({"error": job.error or "Failed to generate image", "job_id": job.id}), 500
+        return jsonify(job_to_dict(job)), 202
+
+    response = job_to_dict(job)
+    response["deduplicated"] = not created
+    response["status_url"] = f"/generate/{job.id}"
+    return jsonify(response), 202
+
+@bp.route('/generate/<job_id>', methods=['GET'])
+def generate_job_status(job_id):
+    job = get_generation_jobs().get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_to_dict(job)), 200
+
+@bp.route('/generate/<job_id>/events', methods=['GET'])
+def generate_job_events(job_id):
+    """
+    Server-Sent Events: отправляет событие при каждом изменении статуса задачи
+    и закрывает поток, когда задача завершена. Поток занимает поток воркера до конца
+    задачи (см. jobs.py) - для многих подписчиков нужны воркеры gevent.
+    """
+    if not get_generation_jobs().get(job_id):
+        return jsonify({"error": "Job not found"}), 404
+
+    def events():
+        job = get_generation_jobs().get(job_id)
+        db.session.close() # Между событиями соединение возвращается в пул
+        last_status = None
+        while True:
+            if job.status != last_status:
+                last_status = job.status
+                yield f"event: status\ndata: {json.dumps(job_to_dict(job))}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            if job.status in FINISHED_STATUSES:
+                return
+            job = get_generation_jobs().wait(job_id, timeout=15, known_status=last_status)
 
-    if image_url:
-        return jsonify({"image_url": image_url}), 200
-    else:
-        return jsonify({"error": "Failed to generate image"}), 500
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-@app.route('/api/user/add_appearance/<int:user_id>', methods=['POST'])
+@bp.route('/api/user/add_appearance/<int:user_id>', methods=['POST'])
+@admission.limit('analysis', providers=('gemini',), upload=True)
 def add_user_appearance(user_id):
+    """
+    Анализ селфи. Результат сохраняется новой строкой AppearanceProfile и дальше
+    используется подбором образов. Повторная загрузка того же фото при той же версии
+    промпта отдает сохраненный профиль без вызова модели.
+    """
     if 'image' not in request.files:
         return jsonify({"error": "No image part in the request"}), 400
     file = request.files['image']
@@ -450,46 +1673,89 @@ def add_user_appearance(user_id):
         return jsonify({"error": "No selected image"}), 400
 
     try:
-        image_data = Image.open(BytesIO(file.read()))
-        analysis_result = analyze_user_appearance(image_data) # Use the specific function for appearance analysis
+        row = db.session.query(User.id, AppearanceProfile) \
+            .outerjoin(AppearanceProfile, AppearanceProfile.id == current_appearance_profile_id()) \
+            .filter(User.id == user_id).first()
+        if row is None:
+            return jsonify({"error": "User not found"}), 404
+        profile = row.AppearanceProfile
+
+        image_bytes = file.read()
+        image_sha256 = hashlib.sha256(image_bytes).hexdigest()
+        if profile is not None and profile.image_sha256 == image_sha256 \
+                and profile.prompt_version == APPEARANCE_PROMPT_VERSION:
+            return jsonify({
+                "message": "User appearance already analyzed",
+                "user_id": user_id,
+                "analysis": profile.to_dict(),
+                "reused": True
+            }), 200
+
+        analysis_result = analyze_user_appearance(image_bytes) # Use the specific function for appearance analysis
 
         parsed_analysis = {}
         if analysis_result:
             try:
                 parsed_analysis = json.loads(analysis_result)
-                skin_tone = parsed_analysis.get('skin_tone')
-                appearance_tone = parsed_analysis.get('appearance_tone')
             except json.JSONDecodeError:
-                skin_tone = "unknown"
-                appearance_tone = "unknown"
                 print(f"Warning: Gemini appearance analysis not in expected JSON format: {analysis_result}")
-        else:
-            skin_tone = "unknown"
-            appearance_tone = "unknown"
-
-        # Здесь вам нужно будет решить, где хранить эту информацию.
-        # Идеально, добавить поля 'skin_tone' и 'appearance_tone' в модель User.
-        with app.app_context():
-            user = db.session.get(User, user_id) # Используйте db.session.get для получения по PK
-            if user:
-                user.skin_tone = skin_tone # Вам нужно добавить эти поля в модель User
-                user.appearance_tone = appearance_tone # Вам нужно добавить эти поля в модель User
-                db.session.commit()
-            else:
-                return jsonify({"error": "User not found"}), 404
+        skin_tone = parsed_analysis.get('skin_tone')
+        appearance_tone = parsed_analysis.get('appearance_tone')
+        if not skin_tone and not appearance_tone:
+            # Неудачный анализ не затирает предыдущий профиль
+            return jsonify({
+                "message": "Could not analyze user appearance",
+                "user_id": user_id,
+                "analysis": {"skin_tone": "unknown", "appearance_tone": "unknown"},
+                "reused": False
+            }), 200
+
+        profile = AppearanceProfile(
+            user_id=user_id,
+            skin_tone=skin_tone,
+            appearance_tone=appearance_tone,
+            analysis=json.dumps(parsed_analysis, ensure_ascii=False),
+            prompt_version=APPEARANCE_PROMPT_VERSION,
+            model=MODEL_TASKS['appearance_analysis']['model'],
+            image_sha256=image_sha256,
+        )
+        db.session.add(profile)
+        db.session.commit()
 
         return jsonify({
             "message": "User appearance analyzed successfully",
             "user_id": user_id,
-            "analysis": {"skin_tone": skin_tone, "appearance_tone": appearance_tone}
+            "analysis": profile.to_dict(),
+            "reused": False
         }), 200
     except Exception as e:
         print(f"Error analyzing user appearance: {e}")
         return jsonify({"error": str(e)}), 500
 
+@bp.route('/api/user/appearance/<int:user_id>', methods=['GET'])
+@max_queries(1)
+def get_user_appearance(user_id):
+    """Текущий профиль внешности пользователя; ?history=1 - все анализы, новые первыми."""
+    try:
+        if request.args.get('history') == '1':
+            profiles = AppearanceProfile.query.filter_by(user_id=user_id) \
+                .order_by(AppearanceProfile.id.desc()).all()
+            if not profiles:
+                return jsonify({"error": "Appearance profile not found"}), 404
+            return jsonify({"user_id": user_id, "history": [profile.to_dict() for profile in profiles]}), 200
+        profile = AppearanceProfile.query.filter_by(user_id=user_id) \
+            .order_by(AppearanceProfile.id.desc()).first()
+        if profile is None:
+            return jsonify({"error": "Appearance profile not found"}), 404
+        return jsonify({"user_id": user_id, "appearance": profile.to_dict()}), 200
+    except Exception as e:
+        print(f"Error reading user appearance: {e}")
+        return jsonify({"error": str(e)}), 500
+
 
 # Роут для анализа изображения (отдельный, если нужен)
-@app.route('/analyze', methods=['POST'])
+@bp.route('/analyze', methods=['POST'])
+@admission.limit('analysis', providers=('gemini',), upload=True)
 def analyze_image_route():
     if 'image' not in request.files:
         return jsonify({"error": "No image part in the request"}), 400
@@ -498,8 +1764,8 @@ def analyze_image_route():
         return jsonify({"error": "No selected image"}), 400
 
     try:
-        image_data = Image.open(BytesIO(file.read()))
-        analysis_result = analyze_image_with_gemini(image_data) # Use the specific function for clothing analysis
+        image_bytes = file.read()
+        analysis_result = analyze_garment(image_bytes) # Local classifier first, Gemini if it is not confident
         if analysis_result:
             try:
                 parsed_result = json.loads(analysis_result)
@@ -513,6 +1779,100 @@ def analyze_image_route():
         return jsonify({"error": str(e)}), 500
 
 
+# --- Фабрика приложения ---
+
+def database_url_from_env():
+    url = os.environ.get('DATABASE_URL')
+    # Render и Heroku отдают postgres://, а SQLAlchemy 2 понимает только postgresql://
+    if url and url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url):
+    """
+    Настройки пула соединений. pool_pre_ping - проверка соединения перед выдачей из пула
+    (managed Postgres закрывает простаивающие соединения), pool_recycle - пересоздание
+    соединений старше DB_POOL_RECYCLE секунд. Размер пула - на воркер gunicorn.
+    """
+    options = {
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    }
+    if url and not url.startswith('sqlite'):
+        # SQLite работает без сетевого пула, размеры пула для него не задаем
+        options.update({
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        })
+    return options
+
+def create_app(config=None):
+    """
+    Собирает приложение: конфигурация, SQLAlchemy, метрики, маршруты, очередь генерации.
+    Gunicorn: "app:create_app()" или, как раньше, "app:app".
+    Тяжелые SDK (google.generativeai, replicate, torch) здесь не импортируются.
+    """
+    app = Flask(__name__, template_folder='templates')
+    CORS(app) # Это включит CORS для всех маршрутов
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url_from_env()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False # Отключаем, чтобы избежать предупреждений
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    if not model_gateway.is_stub:
+        missing = model_gateway.registry.missing_credentials()
+        if missing:
+            # Приложение запускается, но вызовы соответствующих моделей завершатся ошибкой
+            print(f"Warning: {', '.join(missing)} not set. Check your .env file or Render.com settings, "
+                  "or use MODEL_PROVIDER=stub for local runs.")
+        if not CHAT_CONTEXT_CACHE_ENABLED:
+            print(f"Note: chat context caching is off - {_chat_cache_model()} needs at least "
+                  f"{chat_sessions.context_cache_min_tokens(_chat_cache_model())} cached tokens, "
+                  f"CHAT_HISTORY_TOKEN_BUDGET is {CHAT_HISTORY_TOKEN_BUDGET}.")
+
+    db.init_app(app)
+
+    # Схема БД - миграциями (flask --app app db upgrade); после них индексируются атрибуты старых вещей.
+    # Пока ревизии не применены, запросы получают 503; DB_AUTO_MIGRATE=1 - применить их при запуске.
+    # Проверка регистрируется до счетчика запросов: ее SQL не входит в бюджет маршрута
+    migrations.init_app(app, db, after_upgrade=backfill_item_attributes,
+                        auto_upgrade=os.environ.get('DB_AUTO_MIGRATE', '0') == '1')
+
+    # Метрики: /metrics, время по маршрутам и этапам (см. metrics.py)
+    metrics.init_app(app)
+    with app.app_context():
+        metrics.instrument_sqlalchemy(db.engine, Session)
+        # Бюджет SQL-запросов по маршрутам (@max_queries); QUERY_BUDGET_STRICT=1 - превышение = ошибка
+        query_budget.init_app(app, db.engine)
+
+    app.register_blueprint(bp)
+
+    # Генерация выполняется в фоне: POST /generate сразу возвращает id задачи,
+    # статус и результат - через GET /generate/<job_id> или SSE /generate/<job_id>/events.
+    app.extensions['generation_jobs'] = GenerationJobRunner(
+        app, db, GenerationJob, generate_clothing_image,
+        max_workers=int(os.environ.get('GENERATION_WORKERS', 4)),
+        max_pending=int(os.environ.get('GENERATION_MAX_PENDING', 100)),
+        stale_after=int(os.environ.get('GENERATION_STALE_AFTER', 600)),
+    )
+    return app
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+def __getattr__(name):
+    # "import app; app.app" и "gunicorn app:app" продолжают работать: приложение по умолчанию
+    # создается при первом обращении, а не при импорте модуля
+    global _default_app
+    if name == 'app':
+        with _default_app_lock:
+            if _default_app is None:
+                _default_app = create_app()
+        return _default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # Это условие нужно только для локальной разработки.
 # Gunicorn на Render будет импортировать 'app' напрямую.
 if __name__ == '__main__':
@@ -520,4 +1880,4 @@ if __name__ == '__main__':
     # app.run() с указанием порта из переменных окружения или по умолчанию.
     # Для Render этот блок не нужен для работы.
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
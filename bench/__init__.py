@@ -0,0 +1 @@
+"""Нагрузочный бенчмарк: python -m bench.run --help."""
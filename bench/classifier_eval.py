@@ -0,0 +1,162 @@
+"""
+Проверка локального классификатора вещей (garment_classifier.py) на размеченных фото.
+
+    python -m bench.classifier_eval fixtures/garments                 # пороги 0.5..0.95
+    python -m bench.classifier_eval fixtures/garments --thresholds 0.7,0.8,0.9 --min-accuracy 0.97
+    python -m bench.classifier_eval fixtures/garments --categories jeans,sneakers --output eval.json
+
+В каталоге - фото и labels.csv с колонками file,category,colors (цвета через ";", первый -
+основной; колонку можно оставить пустой). Фото классифицируются в этом процессе тем же кодом,
+что и в воркерах пула (_classify_batch), без вызовов Gemini.
+
+Для каждого порога: доля попаданий (фото, для которых Gemini не вызывался бы) и точность
+категории среди попаданий; отдельно - точность основного цвета. Рекомендуемый порог -
+наименьший, при котором точность не ниже --min-accuracy. Код выхода 1, если при пороге
+GARMENT_CLASSIFIER_THRESHOLD (или --threshold) точность ниже --min-accuracy или модель не загрузилась.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95)
+LABELS_FILE = 'labels.csv'
+
+
+def load_labels(directory):
+    """labels.csv -> [(путь, категория, [цвета])]."""
+    rows = []
+    with open(os.path.join(directory, LABELS_FILE), newline='') as f:
+        for row in csv.DictReader(f):
+            colors = [color.strip() for color in (row.get('colors') or '').split(';') if color.strip()]
+            rows.append((os.path.join(directory, row['file']), (row.get('category') or '').strip(), colors))
+    return rows
+
+
+def classify_files(paths, batch_size=16, torch_threads=1):
+    """Результаты _classify_batch по файлам и ошибка загрузки модели (None - модель работает)."""
+    import garment_classifier
+
+    garment_classifier._init_worker(torch_threads)
+    results = []
+    model_error = None
+    for start in range(0, len(paths), batch_size):
+        images = []
+        for path in paths[start:start + batch_size]:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+        output = garment_classifier._classify_batch(images)
+        model_error = output['model_error']
+        results.extend(output['results'])
+    return results, model_error
+
+
+def evaluate(samples, threshold, categories):
+    """
+    samples - [(категория по разметке, цвета по разметке, результат _classify_batch)].
+    Попадание - то же условие, что у Classification.confident.
+    """
+    hits = correct = 0
+    per_category = {}
+    for label, _, result in samples:
+        category = result.get('category')
+        if 'error' in result or category not in categories or result.get('confidence', 0.0) < threshold:
+            continue
+        hits += 1
+        correct += category == label
+        stats = per_category.setdefault(category, {'hits': 0, 'correct': 0})
+        stats['hits'] += 1
+        stats['correct'] += category == label
+    return {
+        'threshold': threshold,
+        'total': len(samples),
+        'hits': hits,
+        'hit_rate': round(hits / len(samples), 4) if samples else 0.0,
+        'accuracy': round(correct / hits, 4) if hits else None,
+        'per_category': per_category,
+    }
+
+
+def color_accuracy(samples):
+    """Доля фото, у которых основной цвет по разметке есть среди найденных цветов."""
+    labelled = [(colors, result) for _, colors, result in samples if colors and 'error' not in result]
+    if not labelled:
+        return None
+    return round(sum(colors[0] in result['colors'] for colors, result in labelled) / len(labelled), 4)
+
+
+def recommend_threshold(reports, min_accuracy):
+    """Наименьший порог с точностью не ниже min_accuracy (больше всего попаданий) или None."""
+    passing = [report for report in reports if report['hits'] and report['accuracy'] >= min_accuracy]
+    return min((report['threshold'] for report in passing), default=None)
+
+
+def passes(report, min_accuracy):
+    """Без попаданий ошибок нет - порог проходит (но и Gemini не экономится)."""
+    return report['accuracy'] is None or report['accuracy'] >= min_accuracy
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('directory', help=f"Directory with images and {LABELS_FILE}")
+    parser.add_argument('--thresholds', default=','.join(map(str, DEFAULT_THRESHOLDS)))
+    parser.add_argument('--threshold', type=float, default=None,
+                        help="Threshold to check (default: GARMENT_CLASSIFIER_THRESHOLD or 0.8)")
+    parser.add_argument('--categories', default=os.environ.get('GARMENT_CLASSIFIER_CATEGORIES', ''),
+                        help="Categories allowed to skip Gemini (default: GARMENT_CLASSIFIER_CATEGORIES)")
+    parser.add_argument('--min-accuracy', type=float, default=0.95)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--torch-threads', type=int, default=1)
+    parser.add_argument('--output', default='', help="Write the JSON report here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from garment_classifier import parse_categories
+
+    threshold = args.threshold if args.threshold is not None else \
+        float(os.environ.get('GARMENT_CLASSIFIER_THRESHOLD', 0.8))
+    categories = parse_categories(args.categories)
+    thresholds = sorted({float(value) for value in args.thresholds.split(',') if value} | {threshold})
+
+    labels = load_labels(args.directory)
+    results, model_error = classify_files([path for path, _, _ in labels], args.batch_size, args.torch_threads)
+    samples = [(category, colors, result) for (_, category, colors), result in zip(labels, results)]
+    if model_error:
+        print(f"Category model unavailable ({model_error}): only colors are evaluated")
+
+    reports = [evaluate(samples, value, categories) for value in thresholds]
+    report = {
+        'images': len(samples),
+        'categories': list(categories),
+        'model_error': model_error,
+        'color_accuracy': color_accuracy(samples),
+        'thresholds': reports,
+        'recommended_threshold': recommend_threshold(reports, args.min_accuracy),
+    }
+
+    print(f"{'threshold':>9} {'hits':>6} {'hit rate':>9} {'accuracy':>9}")
+    for row in reports:
+        accuracy = '-' if row['accuracy'] is None else f"{row['accuracy']:.3f}"
+        print(f"{row['threshold']:>9.2f} {row['hits']:>6} {row['hit_rate']:>9.3f} {accuracy:>9}")
+    print(f"color accuracy: {report['color_accuracy']}, recommended threshold: {report['recommended_threshold']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if model_error:
+        return 1 # Категории не проверены - включать классификатор по этому прогону нельзя
+    current = next(row for row in reports if row['threshold'] == threshold)
+    if not passes(current, args.min_accuracy):
+        print(f"Threshold {threshold} does not reach accuracy {args.min_accuracy}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+"""
+Профили заглушек моделей для бенчмарка.
+
+Профиль задает задержку, разброс и долю ошибок отдельно для Gemini и Replicate.
+Заглушки - model_gateway.StubProvider с фиксированным seed: ответы зависят только
+от промпта, последовательность задержек и ошибок воспроизводится от запуска к запуску.
+"""
+from model_gateway import StubProvider
+
+# provider -> (latency_ms, jitter_ms, error_rate)
+PROFILES = {
+    # Без задержек: видна собственная стоимость приложения (БД, изображения, JSON)
+    'instant': {'gemini': (0, 0, 0.0), 'replicate': (0, 0, 0.0)},
+    # Типичные задержки: flash ~0.8 с, генерация изображения ~4 с
+    'realistic': {'gemini': (800, 400, 0.0), 'replicate': (4000, 1500, 0.0)},
+    # Медленный провайдер у границы таймаутов
+    'slow': {'gemini': (3000, 1000, 0.0), 'replicate': (12000, 3000, 0.0)},
+    # Временные ошибки: проверка повторов и circuit breaker под нагрузкой
+    'flaky': {'gemini': (200, 100, 0.15), 'replicate': (1000, 500, 0.15)},
+}
+
+
+def install_fake_providers(gateway, profile='instant', seed=0, scale=1.0):
+    """
+    Заменяет провайдеров шлюза заглушками профиля. scale умножает задержки
+    (например, 0.1 - тот же профиль, но в 10 раз быстрее).
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown provider profile {profile!r}, expected one of {', '.join(PROFILES)}")
+    for offset, (name, (latency_ms, jitter_ms, error_rate)) in enumerate(sorted(PROFILES[profile].items())):
+        gateway.providers[name] = StubProvider(
+            name,
+            latency=latency_ms * scale / 1000,
+            jitter=jitter_ms * scale / 1000,
+            error_rate=error_rate,
+            seed=seed + offset,
+        )
+    return PROFILES[profile]
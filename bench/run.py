@@ -0,0 +1,367 @@
+"""
+Нагрузочный бенчмарк маршрутов app.py на заглушках моделей и локальной БД.
+
+    python -m bench.run                                   # все маршруты, профиль instant
+    python -m bench.run --profile realistic --concurrency 16 --requests 400
+    python -m bench.run --routes wardrobe_list,outfit --sizes 10,1000,10000
+    python -m bench.run --save-baseline                   # bench/baselines/<profile>.json
+    python -m bench.run --compare                         # сравнение с базовой линией, код 1 при регрессии
+
+Приложение запускается в процессе (Flask test client, по клиенту на поток), без сети:
+Gemini и Replicate заменены заглушками профиля (bench/fakes.py), БД - SQLite во временном
+каталоге (или --database-url), хранилище изображений и индекс эмбеддингов - там же.
+Кэши анализа и ответов по умолчанию выключены, чтобы измерять путь без попаданий (--caches включает).
+
+Для каждого маршрута: пропускная способность, p50/p95/p99, доля ошибок и пик выделенной
+памяти Python (tracemalloc, отдельный последовательный прогон - чтобы не искажать задержки).
+Базовые линии хранятся в JSON с фиксированным порядком ключей: регрессия видна в git diff.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, 'bench', 'baselines')
+DEFAULT_SIZES = (10, 1000)
+
+
+def configure_environment(workdir, args):
+    """Переменные окружения до импорта app: все состояние бенчмарка - во временном каталоге."""
+    os.environ.update({
+        'MODEL_PROVIDER': 'stub',
+        'DATABASE_URL': args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'STORAGE_BACKEND': 'local',
+        'STORAGE_LOCAL_ROOT': os.path.join(workdir, 'media'),
+        'EMBEDDING_BACKEND': os.environ.get('EMBEDDING_BACKEND', 'histogram'),
+        'EMBEDDING_INDEX_PATH': os.path.join(workdir, 'embeddings', 'index'),
+        'ANALYSIS_CACHE_PATH': os.path.join(workdir, 'analysis_cache.sqlite3') if args.caches else '',
+        'RESPONSE_CACHE_BACKEND': 'memory' if args.caches else 'off',
+        'GENERATION_MAX_PENDING': '1000000',
+        'SLOW_REQUEST_MS': '0',
+        # Лимиты admission.py рассчитаны на живых клиентов - в бенчмарке по умолчанию выключены
+        'ADMISSION_BACKEND': 'memory' if args.admission else 'off',
+        # Локальный классификатор вещей (пул процессов с torch) подменяет заглушку Gemini - по умолчанию выключен
+        'GARMENT_CLASSIFIER_ENABLED': '1' if args.classifier else '0',
+        'DB_AUTO_MIGRATE': '1',
+    })
+    os.makedirs(os.path.join(workdir, 'embeddings'), exist_ok=True)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+# --- Данные ---
+
+def seed_database(A, sizes, seed):
+    """Пользователь на каждый размер гардероба и отдельный пользователь для записи (add/appearance)."""
+    from bench.synthetic import wardrobe_rows
+    import migrations
+
+    db = A.db
+    migrations.upgrade(db.engine, log=lambda message: None)
+    users = {}
+    for size in sizes:
+        user = A.User(username=f"bench_{size}_{seed}", email=f"bench_{size}_{seed}@example.com")
+        db.session.add(user)
+        db.session.flush()
+        rows = wardrobe_rows(user.id, size, seed=seed, embedding_dim=A.image_embedder.dim)
+        first_item_id = None
+        for start in range(0, len(rows), 1000):
+            items = [A.WardrobeItem(**row) for row in rows[start:start + 1000]]
+            db.session.add_all(items)
+            db.session.flush()
+            A.index_item_attributes(items)
+            first_item_id = first_item_id or items[0].id
+        db.session.commit()
+        users[size] = {'user_id': user.id, 'item_id': first_item_id}
+    writer = A.User(username=f"bench_writer_{seed}", email=f"bench_writer_{seed}@example.com")
+    db.session.add(writer)
+    chat_session = A.ChatSession(id=f"bench{seed:027d}", body_type='стандартный')
+    db.session.add(chat_session)
+    db.session.commit()
+    return users, writer.id, chat_session.id
+
+
+class Scenario:
+    def __init__(self, name, call):
+        self.name = name
+        self.call = call # call(client, i) -> Response
+
+
+def build_scenarios(users, writer_id, chat_session_id, images, selfies):
+    def multipart(image):
+        import io
+        return {'image': (io.BytesIO(image), 'photo.jpg')}
+
+    scenarios = [
+        Scenario('chat', lambda c, i: c.post('/chat', json={'message': f"What should I wear to event #{i}?"})),
+        # Реплики одной сессии: история растет, окно и сводка держат запрос в бюджете
+        Scenario('chat_session', lambda c, i: c.post(f'/chat/sessions/{chat_session_id}/messages',
+                                                     json={'message': f"And what about shoes for event #{i}?"})),
+        Scenario('analyze', lambda c, i: c.post('/analyze', data=multipart(images[i % len(images)]),
+                                                content_type='multipart/form-data')),
+        Scenario('wardrobe_add', lambda c, i: c.post(f'/api/wardrobe/add/{writer_id}',
+                                                     data=multipart(images[i % len(images)]),
+                                                     content_type='multipart/form-data')),
+        Scenario('appearance_add', lambda c, i: c.post(f'/api/user/add_appearance/{writer_id}',
+                                                       data=multipart(selfies[i % len(selfies)]),
+                                                       content_type='multipart/form-data')),
+        Scenario('generate', lambda c, i: c.post('/generate', json={'prompt': f"bench outfit render #{i}"})),
+    ]
+    for size, ids in users.items():
+        user_id, item_id = ids['user_id'], ids['item_id']
+        scenarios += [
+            Scenario(f'wardrobe_list[n={size}]', lambda c, i, u=user_id: c.get(f'/api/wardrobe/list/{u}')),
+            Scenario(f'wardrobe_list_filtered[n={size}]',
+                     lambda c, i, u=user_id: c.get(f'/api/wardrobe/list/{u}?category=shirt,jeans&color=blue')),
+            Scenario(f'wardrobe_similar[n={size}]',
+                     lambda c, i, item=item_id: c.get(f'/api/wardrobe/similar/{item}')),
+            Scenario(f'outfit_suggest[n={size}]',
+                     lambda c, i, u=user_id: c.post(f'/api/outfit/suggest/{u}', json={'event': f"event {i}"})),
+            Scenario(f'outfit_suggest_offline[n={size}]',
+                     lambda c, i, u=user_id: c.post(f'/api/outfit/suggest/{u}',
+                                                    json={'event': 'office', 'offline': True})),
+        ]
+    return scenarios
+
+
+# --- Измерения ---
+
+def percentile(sorted_values, fraction):
+    """Ближайший ранг: p99 из 100 значений - 99-е по порядку."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _request(scenario, client, i):
+    started = time.perf_counter()
+    try:
+        response = scenario.call(client, i)
+        response.get_data()
+        response.close()
+        ok = response.status_code < 400
+    except Exception as e:
+        print(f"{scenario.name}: request {i} raised {e!r}")
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+def run_scenario(app, scenario, requests, concurrency, warmup, memory_requests):
+    local = threading.local()
+
+    def one(i):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        return _request(scenario, client, i)
+
+    client = app.test_client()
+    for i in range(warmup):
+        _request(scenario, client, requests + i)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    # Память - отдельным последовательным прогоном: tracemalloc замедляет выделения
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for i in range(memory_requests):
+        _request(scenario, client, requests + warmup + i)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = sorted(seconds * 1000 for seconds, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    return {
+        'requests': requests,
+        'errors': errors,
+        'error_rate': round(errors / requests, 4) if requests else 0.0,
+        'throughput_rps': round(requests / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'max_ms': round(latencies[-1], 2) if latencies else 0.0,
+        'peak_alloc_kb': round(max(0, peak - before) / 1024, 1),
+    }
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux - килобайты, macOS - байты
+    return round(rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024, 1)
+
+
+# --- Базовые линии ---
+
+def baseline_path(profile):
+    return os.path.join(BASELINE_DIR, f"{profile}.json")
+
+
+def save_report(report, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True, ensure_ascii=False)
+        f.write('\n')
+
+
+def compare(report, baseline, tolerance, min_delta_ms):
+    """
+    Регрессия: p95 или пик памяти выросли больше чем на tolerance (и p95 - больше чем на
+    min_delta_ms), пропускная способность упала больше чем на tolerance, доля ошибок выросла на 5 п.п.
+    Возвращает список строк-описаний регрессий.
+    """
+    regressions = []
+    for route, current in sorted(report['routes'].items()):
+        previous = baseline['routes'].get(route)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance) \
+                and current['p95_ms'] - previous['p95_ms'] > min_delta_ms:
+            regressions.append(f"{route}: p95 {previous['p95_ms']} -> {current['p95_ms']} ms")
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{route}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} rps")
+        if previous['peak_alloc_kb'] and current['peak_alloc_kb'] > previous['peak_alloc_kb'] * (1 + tolerance):
+            regressions.append(f"{route}: peak alloc {previous['peak_alloc_kb']} -> {current['peak_alloc_kb']} KB")
+        if current['error_rate'] > previous['error_rate'] + 0.05:
+            regressions.append(f"{route}: error rate {previous['error_rate']} -> {current['error_rate']}")
+    return regressions
+
+
+def print_table(report, baseline=None):
+    header = f"{'route':<36}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'err%':>7}{'alloc KB':>10}"
+    print(header)
+    print('-' * len(header))
+    for route, stats in sorted(report['routes'].items()):
+        line = f"{route:<36}{stats['throughput_rps']:>9}{stats['p50_ms']:>9}{stats['p95_ms']:>9}" \
+               f"{stats['p99_ms']:>9}{stats['error_rate'] * 100:>7.1f}{stats['peak_alloc_kb']:>10}"
+        previous = (baseline or {}).get('routes', {}).get(route)
+        if previous and previous['p95_ms']:
+            line += f"   p95 {(stats['p95_ms'] / previous['p95_ms'] - 1) * 100:+.0f}%"
+        print(line)
+    print(f"max RSS: {report['meta']['max_rss_mb']} MB")
+
+
+# --- CLI ---
+
+def parse_args(argv=None):
+    from bench.fakes import PROFILES
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--profile', default='instant', choices=sorted(PROFILES),
+                        help="Provider latency/error profile (bench/fakes.py)")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="Multiply profile latencies")
+    parser.add_argument('--routes', default='', help="Comma-separated route name prefixes (default: all)")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="Wardrobe sizes to seed, 10..10000 items")
+    parser.add_argument('--requests', type=int, default=100, help="Measured requests per route")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--memory-requests', type=int, default=10,
+                        help="Sequential requests traced with tracemalloc")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--caches', action='store_true', help="Enable analysis and response caches")
+    parser.add_argument('--admission', action='store_true', help="Keep admission control (rate limits) on")
+    parser.add_argument('--classifier', action='store_true', help="Run the local garment classifier before analysis")
+    parser.add_argument('--database-url', default='', help="Use this database instead of a temporary SQLite file")
+    parser.add_argument('--output', default='', help="Write the JSON report here")
+    parser.add_argument('--save-baseline', action='store_true', help="Write bench/baselines/<profile>.json")
+    parser.add_argument('--compare', nargs='?', const='', default=None,
+                        help="Compare with a baseline (default: bench/baselines/<profile>.json)")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Allowed relative regression")
+    parser.add_argument('--min-delta-ms', type=float, default=5.0, help="Ignore smaller p95 increases")
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(',') if size]
+    if any(size < 1 or size > 10000 for size in args.sizes):
+        parser.error("--sizes must be between 1 and 10000")
+    args.routes = [prefix for prefix in args.routes.split(',') if prefix]
+    return args
+
+
+def main(argv=None):
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='stylesynth-bench-')
+    configure_environment(workdir, args)
+    try:
+        import app as A
+        from bench.fakes import install_fake_providers
+        from bench.synthetic import garment_image, selfie_image
+
+        install_fake_providers(A.model_gateway, args.profile, seed=args.seed, scale=args.latency_scale)
+        flask_app = A.create_app()
+        with flask_app.app_context():
+            users, writer_id, chat_session_id = seed_database(A, args.sizes, args.seed)
+        images = [garment_image(args.seed * 1000 + i, size=(640, 800)) for i in range(16)]
+        selfies = [selfie_image(args.seed * 1000 + i) for i in range(4)]
+
+        scenarios = [scenario for scenario in build_scenarios(users, writer_id, chat_session_id, images, selfies)
+                     if not args.routes or any(scenario.name.startswith(prefix) for prefix in args.routes)]
+        routes = {}
+        for scenario in scenarios:
+            print(f"Running {scenario.name} ...", flush=True)
+            routes[scenario.name] = run_scenario(flask_app, scenario, args.requests, args.concurrency,
+                                                 args.warmup, args.memory_requests)
+
+        report = {
+            'meta': {
+                'profile': args.profile,
+                'latency_scale': args.latency_scale,
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'sizes': args.sizes,
+                'seed': args.seed,
+                'caches': args.caches,
+                'admission': args.admission,
+                'classifier': args.classifier,
+                'database': args.database_url.split(':')[0] if args.database_url else 'sqlite',
+                'python': platform.python_version(),
+                'machine': f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPU",
+                'max_rss_mb': max_rss_mb(),
+            },
+            'routes': routes,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare is not None:
+        path = args.compare or baseline_path(args.profile)
+        with open(path, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print()
+    print_table(report, baseline)
+
+    if args.output:
+        save_report(report, args.output)
+    if args.save_baseline:
+        save_report(report, baseline_path(args.profile))
+        print(f"Baseline written to {os.path.relpath(baseline_path(args.profile), ROOT)}")
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nNo regressions against the baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Синтетические данные для бенчмарка: изображения вещей и селфи, гардеробы от 10 до 10k вещей.
+Все генераторы детерминированы (seed), повторный запуск создает те же данные.
+"""
+import io
+import random
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+CATEGORIES = ['shirt', 't-shirt', 'pants', 'jeans', 'skirt', 'dress', 'jacket', 'coat', 'sweater', 'shoe',
+              'sneakers', 'boots']
+COLORS = ['black', 'white', 'blue', 'navy', 'red', 'beige', 'grey', 'green', 'brown', 'pink']
+STYLES = ['casual', 'formal', 'sporty', 'elegant', 'business', 'streetwear']
+
+_PALETTE = {
+    'black': (20, 20, 20), 'white': (240, 240, 240), 'blue': (40, 80, 200), 'navy': (20, 30, 90),
+    'red': (200, 30, 40), 'beige': (220, 200, 160), 'grey': (128, 128, 128), 'green': (40, 140, 60),
+    'brown': (110, 70, 40), 'pink': (240, 150, 180),
+}
+
+
+def garment_image(seed, size=(800, 1000), fmt='JPEG'):
+    """Фото "вещи": светлый фон, силуэт основного цвета и немного шума (чтобы JPEG был реалистичного размера)."""
+    rng = random.Random(seed)
+    color = _PALETTE[rng.choice(COLORS)]
+    width, height = size
+    image = Image.new('RGB', size, (235 + rng.randint(0, 20),) * 3)
+    draw = ImageDraw.Draw(image)
+    left, top = width * rng.uniform(0.15, 0.3), height * rng.uniform(0.1, 0.2)
+    right, bottom = width * rng.uniform(0.7, 0.85), height * rng.uniform(0.8, 0.9)
+    draw.rectangle([left, top, right, bottom], fill=color)
+    draw.ellipse([left - width * 0.1, top, left + width * 0.1, top + height * 0.3], fill=color)
+    draw.ellipse([right - width * 0.1, top, right + width * 0.1, top + height * 0.3], fill=color)
+    noise = np.random.default_rng(seed).integers(-12, 12, (height, width, 3), dtype=np.int16)
+    pixels = np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, fmt, quality=90)
+    return buffer.getvalue()
+
+
+def selfie_image(seed, size=(720, 960)):
+    rng = random.Random(seed)
+    tone = rng.choice([(250, 220, 200), (225, 185, 155), (190, 140, 110), (120, 80, 60)])
+    width, height = size
+    image = Image.new('RGB', size, (90, 110, 140))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse([width * 0.3, height * 0.15, width * 0.7, height * 0.6], fill=tone)
+    draw.rectangle([width * 0.2, height * 0.65, width * 0.8, height], fill=_PALETTE[rng.choice(COLORS)])
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def wardrobe_rows(user_id, count, seed=0, embedding_dim=None):
+    """
+    Строки WardrobeItem для массовой вставки. Эмбеддинги - случайные векторы
+    (для поиска похожих важна только размерность, а не смысл).
+    """
+    rng = random.Random(f"{seed}:{user_id}")
+    vectors = np.random.default_rng(seed + user_id).standard_normal((count, embedding_dim)) \
+        if embedding_dim else None
+    rows = []
+    for number in range(count):
+        category = rng.choice(CATEGORIES)
+        colors = rng.sample(COLORS, rng.choice([1, 1, 1, 2]))
+        rows.append({
+            'user_id': user_id,
+            'image_url': f"https://example.com/bench/{user_id}/{number}.jpg",
+            'category': category,
+            'color': ', '.join(colors),
+            'style': rng.choice(STYLES),
+            'item_type': category,
+            'embedding': vectors[number].astype(np.float16).tobytes() if vectors is not None else None,
+        })
+    return rows
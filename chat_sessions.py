@@ -0,0 +1,111 @@
+"""
+Сессии чата со стилистом: история и фото хранятся на сервере.
+
+Клиент создает сессию, а дальше отправляет только текст реплики; фото загружается
+один раз (нормализованным, см. image_pipeline) и в следующих репликах указывается
+по image_id. Запрос к модели собирается так:
+
+    [вступление: роль стилиста, тип фигуры, сводка ранних реплик, обсуждаемое фото]
+    [последние реплики, сколько помещается в CHAT_HISTORY_TOKEN_BUDGET]
+    [текущая реплика]
+
+Реплики, не поместившиеся в бюджет, отбрасываются из запроса; когда их набирается
+на CHAT_SUMMARY_MIN_TOKENS, модель сжимает их в сводку (задача chat_summary), и
+дальше они в запрос не попадают - только сводка. Токены оцениваются грубо (4 символа
+на токен, фото - IMAGE_TOKENS), без обращения к провайдеру.
+
+Кэш контекста Gemini: когда вступление вместе с окном истории дорастает до минимального
+размера кэша у модели (context_cache_min_tokens), эта неизменная часть кэшируется на стороне
+провайдера до реплики context_cache_through. Следующие реплики передают только более новые
+реплики и текущую, пока они помещаются в CHAT_HISTORY_TOKEN_BUDGET; потом окно строится
+заново (с новой сводкой) и кэшируется снова. Если минимум модели больше бюджета истории,
+кэш недостижим и не используется (context_cache_reachable).
+"""
+import hashlib
+import os
+
+from prompts import CHAT_SESSION_ACK, CHAT_SESSION_IMAGE_NOTE
+
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get('CHAT_HISTORY_TOKEN_BUDGET', 6000))
+CHAT_SUMMARY_MIN_TOKENS = int(os.environ.get('CHAT_SUMMARY_MIN_TOKENS', 1500))
+# 0 - минимум по модели (CONTEXT_CACHE_MIN_TOKENS)
+CHAT_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('CHAT_CONTEXT_CACHE_MIN_TOKENS', 0))
+CHAT_CONTEXT_CACHE_TTL = int(os.environ.get('CHAT_CONTEXT_CACHE_TTL', 3600))
+# Сколько несжатых реплик читать из БД на один запрос (если сводка долго не удается)
+CHAT_SESSION_MAX_MESSAGES = int(os.environ.get('CHAT_SESSION_MAX_MESSAGES', 200))
+
+# Gemini 1.5 считает изображение до 384px как 258 токенов; нормализованное фото
+# (IMAGE_MAX_EDGE) режется на плитки - берем оценку с запасом
+IMAGE_TOKENS = int(os.environ.get('CHAT_IMAGE_TOKENS', 516))
+
+
+# Минимальный размер кэша контекста Gemini по семейству модели; для неизвестных - как у 1.5
+CONTEXT_CACHE_MIN_TOKENS = (
+    ('gemini-2.5-flash', 1024),
+    ('gemini-2.5-pro', 4096),
+    ('gemini-2.0', 4096),
+    ('gemini-1.5', 32768),
+)
+DEFAULT_CONTEXT_CACHE_MIN_TOKENS = 32768
+
+
+def context_cache_min_tokens(model_name):
+    if CHAT_CONTEXT_CACHE_MIN_TOKENS:
+        return CHAT_CONTEXT_CACHE_MIN_TOKENS
+    name = model_name.rsplit('/', 1)[-1]
+    return next((tokens for prefix, tokens in CONTEXT_CACHE_MIN_TOKENS if name.startswith(prefix)),
+                DEFAULT_CONTEXT_CACHE_MIN_TOKENS)
+
+
+def context_cache_reachable(model_name):
+    """Кэшируется вступление с окном истории, а вместе они не больше CHAT_HISTORY_TOKEN_BUDGET."""
+    return context_cache_min_tokens(model_name) <= CHAT_HISTORY_TOKEN_BUDGET
+
+
+def estimate_tokens(text):
+    return (len(text or '') + 3) // 4
+
+
+def message_tokens(text, has_image=False):
+    return estimate_tokens(text) + (IMAGE_TOKENS if has_image else 0)
+
+
+def split_window(messages, budget):
+    """
+    messages - реплики от старых к новым (с атрибутами role, tokens).
+    Возвращает (older, window): window - самые новые реплики, суммарно не больше budget
+    и начинающиеся с реплики пользователя; older - все, что раньше.
+    """
+    used = 0
+    start = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        if used + messages[index].tokens > budget:
+            break
+        used += messages[index].tokens
+        start = index
+    while start < len(messages) and messages[start].role != 'user':
+        start += 1
+    return messages[:start], messages[start:]
+
+
+def preamble_contents(text, image_part=None):
+    """Вступление - первая пара реплик (у Gemini нет отдельной системной реплики в истории)."""
+    parts = [text]
+    if image_part is not None:
+        parts += [CHAT_SESSION_IMAGE_NOTE, image_part]
+    return [{'role': 'user', 'parts': parts}, {'role': 'model', 'parts': [CHAT_SESSION_ACK]}]
+
+
+def turn(role, text, image_part=None):
+    parts = [text] if text else []
+    if image_part is not None:
+        parts.append(image_part)
+    return {'role': role, 'parts': parts}
+
+
+def context_cache_key(model_name, preamble_text, through_id):
+    """
+    Ключ кэша контекста: содержимое кэша определяется вступлением (тип фигуры, сводка) и
+    последней закэшированной репликой - фото вступления выбирается по тем же репликам.
+    """
+    return hashlib.sha256(f"{model_name}\n{through_id}\n{preamble_text}".encode('utf-8')).hexdigest()
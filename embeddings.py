@@ -0,0 +1,279 @@
+"""
+Эмбеддинги изображений вещей и индекс для поиска похожих.
+
+Эмбеддинг считается один раз при добавлении вещи (CPU, torchvision
+MobileNetV3-Small без классификатора, 576 чисел в float16) и хранится
+в WardrobeItem.embedding. Если torch не установлен, используется
+упрощенный эмбеддинг - цветовая гистограмма (NumPy): для поиска дубликатов
+этого достаточно, для "похожих по фасону" - заметно хуже.
+
+VectorIndex - индекс в памяти с хранением в memory-mapped файле:
+добавление и удаление по одному элементу без перестройки, поиск
+ближайших по косинусной близости среди вещей одного пользователя.
+Поиск точный, без ANN - намеренно: гардероб одного пользователя -
+максимум тысячи вещей, и их перебор одним матричным умножением быстрее
+построения графа или кластеров. Строки пользователя отбираются по столбцу
+user_id (16 байт на строку), чужие векторы не читаются.
+"""
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageOps
+
+EMBEDDING_DTYPE = np.float16
+
+
+class _TorchBackend:
+    name = 'mobilenet_v3_small'
+    dim = 576
+
+    def __init__(self):
+        import torch
+        from torchvision import models
+
+        torch.set_num_threads(int(os.environ.get('EMBEDDING_TORCH_THREADS', 1)))
+        weights = models.MobileNet_V3_Small_Weights.DEFAULT
+        model = models.mobilenet_v3_small(weights=weights)
+        model.classifier = torch.nn.Identity() # Нужны признаки после pooling, а не классы ImageNet
+        model.eval()
+        self._torch = torch
+        self._model = model
+        self._transform = weights.transforms()
+
+    def embed(self, images):
+        batch = self._torch.stack([self._transform(image) for image in images])
+        with self._torch.inference_mode():
+            features = self._model(batch)
+        return features.numpy()
+
+
+class _HistogramBackend:
+    name = 'rgb_histogram'
+    dim = 512
+
+    def embed(self, images):
+        vectors = []
+        for image in images:
+            pixels = np.asarray(image.resize((64, 64)), dtype=np.uint8).reshape(-1, 3) // 32 # 8 уровней на канал
+            bins = pixels[:, 0].astype(np.int64) * 64 + pixels[:, 1] * 8 + pixels[:, 2]
+            vectors.append(np.sqrt(np.bincount(bins, minlength=self.dim).astype(np.float32)))
+        return np.stack(vectors)
+
+
+class ImageEmbedder:
+    """Ленивая обертка над моделью: веса грузятся при первом вызове, а не при импорте."""
+
+    def __init__(self, backend=None):
+        self._backend_name = backend or os.environ.get('EMBEDDING_BACKEND', 'auto')
+        self._backend = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self._load_backend()
+        return self._backend
+
+    def _load_backend(self):
+        if self._backend_name in ('auto', _TorchBackend.name):
+            try:
+                return _TorchBackend()
+            except Exception as e:
+                if self._backend_name != 'auto':
+                    raise
+                print(f"Torch embedding backend unavailable ({e}), falling back to color histograms")
+        return _HistogramBackend()
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    @property
+    def dim(self):
+        return self.backend.dim
+
+    def embed_images(self, images):
+        """Батч PIL-изображений -> матрица нормированных эмбеддингов (n x dim, float16)."""
+        images = [image.convert('RGB') for image in images]
+        vectors = np.asarray(self.backend.embed(images), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).astype(EMBEDDING_DTYPE)
+
+    def embed_bytes(self, image_bytes):
+        image = Image.open(BytesIO(image_bytes))
+        image.draft('RGB', (448, 448)) # Модели нужно 224x224 - для JPEG декодируем сразу уменьшенным
+        return self.embed_images([ImageOps.exif_transpose(image)])[0]
+
+
+def vector_to_bytes(vector):
+    return np.asarray(vector, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def vector_from_bytes(data):
+    return np.frombuffer(data, dtype=EMBEDDING_DTYPE)
+
+
+class VectorIndex:
+    """
+    Индекс векторов в memory-mapped файлах:
+      <path>.vectors - матрица capacity x dim (float16),
+      <path>.ids     - пары (item_id, user_id) для каждой строки, item_id=-1 - свободная строка,
+      <path>.json    - заголовок (dim, backend, capacity).
+    Запись защищена файловой блокировкой, а отображение файлов общее (MAP_SHARED),
+    так что индекс можно делить между воркерами gunicorn.
+    """
+
+    def __init__(self, path, dim, backend, initial_capacity=1024):
+        self.path = path
+        self.dim = dim
+        self.backend = backend
+        self._lock = threading.RLock()
+        self._capacity = 0
+        self._vectors = None
+        self._ids = None
+        self._header_mtime = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._file_lock():
+            header = self._read_header()
+            if header is None or header.get('dim') != dim or header.get('backend') != backend:
+                self._create(initial_capacity)
+            self._open()
+
+    # --- Файлы ---
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self.path + '.lock', 'a') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_header(self):
+        try:
+            with open(self.path + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_header(self, capacity):
+        tmp_path = self.path + '.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'dim': self.dim, 'backend': self.backend, 'capacity': capacity}, f)
+        os.replace(tmp_path, self.path + '.json')
+
+    def _create(self, capacity):
+        # Новые файлы пишем рядом и подменяем атомарно: у других воркеров остаются
+        # отображения старых файлов, пока они не заметят новый заголовок
+        np.memmap(self.path + '.vectors.tmp', dtype=EMBEDDING_DTYPE, mode='w+', shape=(capacity, self.dim)).flush()
+        ids = np.memmap(self.path + '.ids.tmp', dtype=np.int64, mode='w+', shape=(capacity, 2))
+        ids[:, 0] = -1
+        ids.flush()
+        del ids
+        os.replace(self.path + '.vectors.tmp', self.path + '.vectors')
+        os.replace(self.path + '.ids.tmp', self.path + '.ids')
+        self._write_header(capacity)
+
+    def _grow(self, capacity):
+        # Расширяем файлы на месте (только увеличение - старые отображения остаются валидными)
+        old = self._capacity
+        with open(self.path + '.vectors', 'r+b') as f:
+            f.truncate(capacity * self.dim * np.dtype(EMBEDDING_DTYPE).itemsize)
+        with open(self.path + '.ids', 'r+b') as f:
+            f.truncate(capacity * 2 * np.dtype(np.int64).itemsize)
+        ids = np.memmap(self.path + '.ids', dtype=np.int64, mode='r+', shape=(capacity, 2))
+        ids[old:, 0] = -1
+        ids.flush()
+        del ids
+        self._write_header(capacity)
+        self._open()
+
+    def _open(self):
+        header = self._read_header()
+        self._capacity = header['capacity']
+        self._vectors = np.memmap(self.path + '.vectors', dtype=EMBEDDING_DTYPE, mode='r+',
+                                  shape=(self._capacity, self.dim))
+        self._ids = np.memmap(self.path + '.ids', dtype=np.int64, mode='r+', shape=(self._capacity, 2))
+        self._header_mtime = os.stat(self.path + '.json').st_mtime_ns
+
+    def _refresh(self):
+        # Заголовок меняется только при пересоздании или расширении файлов - тогда переоткрываем
+        if os.stat(self.path + '.json').st_mtime_ns != self._header_mtime:
+            self._open()
+
+    def _row_of(self, item_id):
+        rows = np.flatnonzero(self._ids[:, 0] == item_id)
+        return int(rows[0]) if len(rows) else None
+
+    # --- Операции ---
+
+    def add(self, item_id, user_id, vector):
+        with self._lock, self._file_lock():
+            self._refresh()
+            row = self._row_of(item_id)
+            if row is None:
+                free = np.flatnonzero(self._ids[:, 0] < 0)
+                if not len(free):
+                    self._grow(self._capacity * 2)
+                    free = np.flatnonzero(self._ids[:, 0] < 0)
+                row = int(free[0])
+            self._vectors[row] = vector
+            self._ids[row] = (item_id, user_id)
+            self._vectors.flush()
+            self._ids.flush()
+
+    def remove(self, item_id):
+        with self._lock, self._file_lock():
+            self._refresh()
+            row = self._row_of(item_id)
+            if row is not None:
+                self._ids[row, 0] = -1
+                self._ids.flush()
+
+    def search(self, vector, user_id, k=10, exclude_ids=()):
+        """Возвращает [(item_id, similarity)] по убыванию близости среди вещей пользователя."""
+        with self._lock:
+            self._refresh()
+            rows = np.flatnonzero((self._ids[:, 1] == user_id) & (self._ids[:, 0] >= 0))
+            if exclude_ids:
+                rows = rows[~np.isin(self._ids[rows, 0], list(exclude_ids))]
+            if not len(rows) or k <= 0:
+                return []
+            scores = self._vectors[rows].astype(np.float32) @ np.asarray(vector, dtype=np.float32)
+            k = min(k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [(int(self._ids[rows[i], 0]), float(scores[i])) for i in top]
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return int((self._ids[:, 0] >= 0).sum())
+
+    def item_ids(self):
+        """Множество item_id в индексе - для сверки с БД."""
+        with self._lock:
+            self._refresh()
+            ids = self._ids[:, 0]
+            return set(ids[ids >= 0].tolist())
+
+    def rebuild(self, entries):
+        """Полная перестройка из (item_id, user_id, vector) - например, из БД."""
+        entries = list(entries)
+        with self._lock, self._file_lock():
+            self._create(max(1024, 1 << max(0, len(entries) - 1).bit_length()))
+            self._open()
+            for row, (item_id, user_id, vector) in enumerate(entries):
+                self._vectors[row] = vector
+                self._ids[row] = (item_id, user_id)
+            self._vectors.flush()
+            self._ids.flush()
@@ -0,0 +1,436 @@
+"""
+Локальная классификация вещей на CPU - быстрый путь перед анализом в Gemini.
+
+Для каждого загруженного фото считается:
+  - категория - torchvision MobileNetV3-Small (те же веса ImageNet, что у embeddings.py):
+    вероятности классов ImageNet, относящихся к одежде (GARMENT_CLASSES), суммируются
+    по категориям гардероба; уверенность - доля вероятности у лучшей категории;
+  - основные цвета - k-means по пикселям уменьшенного фото (NumPy, векторизованно),
+    без однотонного фона; центры кластеров называются ближайшим цветом палитры (в Lab).
+Стиль модель ImageNet не различает, поэтому у локального результата style = null
+(подбор образов считает такую вещь повседневной).
+
+Результат отдается вместо ответа Gemini (в том же формате {"category", "colors", "style"}),
+только если категория входит в GARMENT_CLASSIFIER_CATEGORIES и уверенность не ниже
+GARMENT_CLASSIFIER_THRESHOLD, иначе вызывающий код идет в Gemini. По умолчанию разрешены
+категории, у которых в ImageNet есть собственный класс (джинсы, кроссовки, сумки, ...):
+для рубашек, брюк, шорт и курток его нет, и похожие классы (suit, abaya, lab coat)
+учитываются в распределении только для того, чтобы такие фото не проходили порог.
+
+Классификатор выключен по умолчанию (GARMENT_CLASSIFIER_ENABLED=0): перед включением
+порог и список категорий проверяются на размеченных фото - python -m bench.classifier_eval
+<каталог> печатает долю попаданий и точность для набора порогов.
+
+Модель работает в пуле процессов (spawn, модель грузится один раз в каждом воркере), чтобы
+декодирование и инференс не занимали GIL процессов веб-сервера. Запросы из потоков
+собираются в батчи: пока все воркеры заняты, новые фото копятся в очереди и уходят
+следующим батчем (до GARMENT_CLASSIFIER_BATCH_SIZE). Если torch или веса недоступны,
+классификатор отключается после первого батча - все фото анализирует Gemini.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from io import BytesIO
+from multiprocessing import get_context
+from queue import Empty, Queue
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Класс ImageNet -> категория. Классы, которых нет в списке (фон, люди, мебель),
+# в уверенность не входят - фото "не похоже на вещь" уходит в Gemini.
+GARMENT_CLASSES = {
+    'jersey': 't-shirt',
+    'sweatshirt': 'sweater',
+    'cardigan': 'sweater',
+    'jean': 'jeans',
+    'miniskirt': 'skirt',
+    'sarong': 'skirt',
+    'overskirt': 'skirt',
+    'hoopskirt': 'skirt',
+    'gown': 'dress',
+    'abaya': 'dress',
+    'kimono': 'dress',
+    'suit': 'suit',
+    'trench coat': 'coat',
+    'fur coat': 'coat',
+    'lab coat': 'coat',
+    'cloak': 'coat',
+    'poncho': 'coat',
+    'pajama': 'pajamas',
+    'running shoe': 'sneakers',
+    'Loafer': 'shoe',
+    'clog': 'shoe',
+    'sandal': 'sandals',
+    'cowboy boot': 'boots',
+    'sock': 'socks',
+    'swimming trunks': 'swimwear',
+    'maillot': 'swimwear',
+    'bikini': 'swimwear',
+    'purse': 'bag',
+    'backpack': 'bag',
+    'mailbag': 'bag',
+    'cowboy hat': 'hat',
+    'sombrero': 'hat',
+    'bonnet': 'hat',
+    'Windsor tie': 'tie',
+    'bow tie': 'tie',
+    'stole': 'scarf',
+    'feather boa': 'scarf',
+    'mitten': 'gloves',
+}
+
+# Категории, для которых локальный результат заменяет Gemini (GARMENT_CLASSIFIER_CATEGORIES)
+DEFAULT_LOCAL_CATEGORIES = ('jeans', 'sneakers', 'sandals', 'boots', 'socks', 'bag', 'hat', 'tie')
+
+# Названия цветов - те же, что обычно возвращает Gemini
+COLOR_PALETTE = {
+    'black': (25, 25, 25), 'white': (245, 245, 245), 'grey': (128, 128, 128),
+    'beige': (220, 200, 160), 'brown': (110, 70, 40), 'red': (200, 30, 40),
+    'burgundy': (110, 20, 40), 'pink': (240, 150, 180), 'orange': (240, 130, 30),
+    'yellow': (240, 210, 40), 'green': (40, 140, 60), 'olive': (110, 110, 40),
+    'blue': (40, 80, 200), 'light blue': (140, 180, 230), 'navy': (20, 30, 90),
+    'purple': (120, 50, 150),
+}
+
+COLOR_SAMPLE_EDGE = 64      # k-means по 64x64 = 4096 пикселям
+COLOR_CLUSTERS = 4
+COLOR_MIN_SHARE = 0.15      # Цвет меньше 15% вещи не упоминается
+COLOR_MAX_COLORS = 3
+BACKGROUND_DISTANCE = 20.0  # Пиксели ближе к цвету фона (в Lab) считаются фоном
+COLD_START_WAIT = 0.5       # Сколько ждать результата, пока пул процессов еще не готов
+
+# Исходы classify(): hit - ответ Gemini не нужен, остальные - фото уходит в Gemini
+CLASSIFIER_OUTCOMES = ('hit', 'fallback', 'timeout', 'error', 'disabled')
+
+_worker_model = None
+_worker_error = None
+
+
+# --- Цвета (NumPy) ---
+
+def _rgb_to_lab(rgb):
+    """sRGB (0..255, n x 3) -> CIE Lab (D65)."""
+    rgb = np.asarray(rgb, dtype=np.float32) / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ np.array([[0.4124, 0.2126, 0.0193],
+                             [0.3576, 0.7152, 0.1192],
+                             [0.1805, 0.0722, 0.9505]], dtype=np.float32)
+    xyz /= np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+_PALETTE_NAMES = list(COLOR_PALETTE)
+_PALETTE_LAB = _rgb_to_lab(list(COLOR_PALETTE.values()))
+
+
+def kmeans(points, k, iterations=12, seed=0):
+    """
+    k-means (инициализация k-means++) по матрице n x d. Возвращает (centers, counts);
+    шаг - одно матричное вычисление расстояний n x k, без циклов по точкам.
+    """
+    rng = np.random.default_rng(seed)
+    centers = points[rng.integers(len(points))][None, :]
+    for _ in range(1, min(k, len(points))):
+        distances = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        if distances.sum() == 0:
+            break # Все точки совпадают с центрами - больше кластеров не нужно
+        centers = np.vstack([centers, points[rng.choice(len(points), p=distances / distances.sum())]])
+    for _ in range(iterations):
+        labels = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        counts = np.bincount(labels, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=points[:, dim], minlength=len(centers))
+                         for dim in range(points.shape[1])], axis=1)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.abs(updated - centers).max() < 0.5:
+            centers = updated
+            break
+        centers = updated
+    labels = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+    return centers, np.bincount(labels, minlength=len(centers))
+
+
+def dominant_colors(image, clusters=COLOR_CLUSTERS, min_share=COLOR_MIN_SHARE, max_colors=COLOR_MAX_COLORS):
+    """Названия основных цветов вещи, от самого крупного."""
+    pixels = np.asarray(image.convert('RGB').resize((COLOR_SAMPLE_EDGE, COLOR_SAMPLE_EDGE), Image.BILINEAR))
+    lab = _rgb_to_lab(pixels.reshape(-1, 3)).reshape(COLOR_SAMPLE_EDGE, COLOR_SAMPLE_EDGE, 3)
+
+    # Фон - медиана по краю кадра, если край почти однотонный (вещь на столе/вешалке);
+    # если вещь заходит на край (фото крупным планом), фон не вырезаем
+    points = lab.reshape(-1, 3)
+    border = np.concatenate([lab[0], lab[-1], lab[:, 0], lab[:, -1]])
+    background = np.median(border, axis=0)
+    if (np.linalg.norm(border - background, axis=1) < BACKGROUND_DISTANCE).mean() >= 0.6:
+        foreground = points[np.linalg.norm(points - background, axis=1) >= BACKGROUND_DISTANCE]
+        if len(foreground) >= len(points) * 0.05:
+            points = foreground
+
+    centers, counts = kmeans(points, clusters)
+    names = np.linalg.norm(centers[:, None, :] - _PALETTE_LAB[None, :, :], axis=2).argmin(axis=1)
+    shares = {}
+    for name_index, count in zip(names, counts):
+        name = _PALETTE_NAMES[name_index]
+        shares[name] = shares.get(name, 0) + count / len(points)
+    ranked = sorted(shares.items(), key=lambda kv: -kv[1])
+    colors = [name for name, share in ranked if share >= min_share][:max_colors]
+    return colors or [ranked[0][0]]
+
+
+# --- Воркер пула процессов ---
+
+class _CategoryModel:
+    def __init__(self, torch_threads):
+        import torch
+        from torchvision import models
+
+        torch.set_num_threads(torch_threads)
+        weights = models.MobileNet_V3_Small_Weights.DEFAULT
+        model = models.mobilenet_v3_small(weights=weights)
+        model.eval()
+        self._torch = torch
+        self._model = model
+        self._transform = weights.transforms()
+
+        imagenet = weights.meta['categories']
+        self.categories = sorted(set(GARMENT_CLASSES.values()))
+        # Матрица "класс ImageNet -> категория": сумма вероятностей по категориям - одно умножение
+        self._class_to_category = np.zeros((len(imagenet), len(self.categories)), dtype=np.float32)
+        for index, name in enumerate(imagenet):
+            if name in GARMENT_CLASSES:
+                self._class_to_category[index, self.categories.index(GARMENT_CLASSES[name])] = 1.0
+
+    def predict(self, images):
+        batch = self._torch.stack([self._transform(image) for image in images])
+        with self._torch.inference_mode():
+            probabilities = self._torch.softmax(self._model(batch), dim=1).numpy()
+        scores = probabilities @ self._class_to_category
+        best = scores.argmax(axis=1)
+        return [{'category': self.categories[index], 'confidence': float(row[index])}
+                for row, index in zip(scores, best)]
+
+
+def _init_worker(torch_threads):
+    global _worker_model, _worker_error
+    try:
+        _worker_model = _CategoryModel(torch_threads)
+    except Exception as e:
+        _worker_error = f"{type(e).__name__}: {e}"
+
+
+def _classify_batch(images_bytes):
+    """Выполняется в воркере: список байтов изображений -> список результатов (или {"error"})."""
+    results = [None] * len(images_bytes)
+    images = []
+    for position, data in enumerate(images_bytes):
+        try:
+            image = Image.open(BytesIO(data))
+            image.draft('RGB', (448, 448)) # Модели нужно 224x224 - JPEG декодируем сразу уменьшенным
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            images.append((position, image))
+            results[position] = {'colors': dominant_colors(image)}
+        except Exception as e:
+            results[position] = {'error': f"{type(e).__name__}: {e}"}
+    if _worker_model is None:
+        return {'model_error': _worker_error, 'results': results}
+    if images:
+        for (position, _), prediction in zip(images, _worker_model.predict([image for _, image in images])):
+            results[position].update(prediction)
+    return {'model_error': None, 'results': results}
+
+
+# --- Классификатор в процессе веб-сервера ---
+
+def parse_categories(value):
+    """'jeans, bag' -> ('jeans', 'bag'); пустая строка - DEFAULT_LOCAL_CATEGORIES."""
+    categories = tuple(part.strip() for part in value.split(',') if part.strip())
+    return categories or DEFAULT_LOCAL_CATEGORIES
+
+
+class Classification:
+    def __init__(self, category, colors, confidence, threshold, categories=DEFAULT_LOCAL_CATEGORIES):
+        self.category = category
+        self.colors = colors
+        self.confidence = confidence
+        self.confident = category in categories and confidence >= threshold
+
+    def to_analysis(self):
+        """
+        Тот же формат, что у ответа Gemini (GARMENT_SCHEMA), плюс источник и уверенность.
+        Стиль по фото модель не определяет - null, а не догадка по классу ImageNet.
+        """
+        return {
+            'category': self.category,
+            'colors': self.colors,
+            'style': None,
+            'source': 'local',
+            'confidence': round(self.confidence, 3),
+        }
+
+
+class GarmentClassifier:
+    def __init__(self, threshold=0.8, categories=DEFAULT_LOCAL_CATEGORIES, workers=1, batch_size=8,
+                 batch_wait_ms=5, timeout=5.0, torch_threads=1, observer=None):
+        self.threshold = threshold
+        self.categories = tuple(categories)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.timeout = timeout
+        self.torch_threads = torch_threads
+        self.observer = observer # observer(batch_size, seconds) - время батча в пуле
+        self.disabled_reason = None
+        self._pending = Queue()
+        self._slots = threading.BoundedSemaphore(workers) # Батчей в работе - не больше воркеров
+        self._executor = None
+        self._dispatcher = None
+        self._ready = threading.Event() # Воркер загрузил модель и вернул первый батч
+        self._lock = threading.Lock()
+        self._stats = {'hit': 0, 'fallback': 0, 'timeout': 0, 'error': 0, 'disabled': 0,
+                       'batches': 0, 'batched_images': 0}
+
+    @classmethod
+    def from_env(cls, observer=None):
+        """
+        GARMENT_CLASSIFIER_ENABLED (0 по умолчанию - сразу в Gemini; включать после
+        bench.classifier_eval), GARMENT_CLASSIFIER_THRESHOLD, GARMENT_CLASSIFIER_CATEGORIES (через запятую),
+        GARMENT_CLASSIFIER_WORKERS, GARMENT_CLASSIFIER_BATCH_SIZE, GARMENT_CLASSIFIER_BATCH_WAIT_MS,
+        GARMENT_CLASSIFIER_TIMEOUT (секунды), GARMENT_CLASSIFIER_TORCH_THREADS.
+        """
+        if os.environ.get('GARMENT_CLASSIFIER_ENABLED', '0') != '1':
+            return None
+        return cls(
+            threshold=float(os.environ.get('GARMENT_CLASSIFIER_THRESHOLD', 0.8)),
+            categories=parse_categories(os.environ.get('GARMENT_CLASSIFIER_CATEGORIES', '')),
+            workers=int(os.environ.get('GARMENT_CLASSIFIER_WORKERS', 1)),
+            batch_size=int(os.environ.get('GARMENT_CLASSIFIER_BATCH_SIZE', 8)),
+            batch_wait_ms=float(os.environ.get('GARMENT_CLASSIFIER_BATCH_WAIT_MS', 5)),
+            timeout=float(os.environ.get('GARMENT_CLASSIFIER_TIMEOUT', 5)),
+            torch_threads=int(os.environ.get('GARMENT_CLASSIFIER_TORCH_THREADS', 1)),
+            observer=observer,
+        )
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        decided = sum(stats[outcome] for outcome in CLASSIFIER_OUTCOMES)
+        stats['hit_rate'] = round(stats['hit'] / decided, 4) if decided else 0.0
+        stats['avg_batch_size'] = round(stats['batched_images'] / stats['batches'], 2) if stats['batches'] else 0.0
+        return stats
+
+    def _ensure_started(self):
+        if self._dispatcher is not None:
+            return
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name='garment-classifier', daemon=True)
+                self._dispatcher.start()
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: форк процесса с потоками (gunicorn, пулы моделей) может унаследовать занятые блокировки
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'),
+                                                 initializer=_init_worker, initargs=(self.torch_threads,))
+        return self._executor
+
+    def _discard_executor(self, executor):
+        """Сломанный пул закрывается (процессы и потоки управления), следующий батч создаст новый."""
+        with self._lock:
+            if executor is None or self._executor is not executor:
+                return # Пул уже заменен другим батчем
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _dispatch(self):
+        while True:
+            batch = [self._pending.get()]
+            self._slots.acquire() # Пока воркеры заняты, очередь копится - следующий батч будет больше
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        # Фото, которые уже не ждут (timeout у вызывающего), не классифицируем
+        batch = [(data, waiter) for data, waiter in batch if waiter.set_running_or_notify_cancel()]
+        if not batch:
+            self._slots.release()
+            return
+        started = time.perf_counter()
+        self._count('batches')
+        self._count('batched_images', len(batch))
+
+        def done(future):
+            self._slots.release()
+            if self.observer is not None:
+                self.observer(len(batch), time.perf_counter() - started)
+            try:
+                output = future.result()
+            except Exception as e:
+                # BrokenProcessPool (воркер упал) - пул пересоздается на следующем батче
+                self._discard_executor(executor)
+                for _, waiter in batch:
+                    waiter.set_exception(e)
+                return
+            if output['model_error'] and self.disabled_reason is None:
+                self.disabled_reason = output['model_error']
+                print(f"Garment classifier unavailable ({self.disabled_reason}), using Gemini for all images")
+            self._ready.set()
+            for (_, waiter), result in zip(batch, output['results']):
+                waiter.set_result(result)
+
+        executor = None
+        try:
+            executor = self._get_executor()
+            executor.submit(_classify_batch, [data for data, _ in batch]).add_done_callback(done)
+        except Exception as e:
+            self._discard_executor(executor)
+            self._slots.release()
+            for _, waiter in batch:
+                waiter.set_exception(e)
+
+    def classify(self, image_bytes):
+        """
+        Classification (confident=True - ответ Gemini не нужен) или None, если классификатор
+        недоступен, не успел за timeout или не смог прочитать фото.
+        """
+        if self.disabled_reason is not None:
+            self._count('disabled')
+            return None
+        self._ensure_started()
+        waiter = Future()
+        self._pending.put((image_bytes, waiter))
+        # Пока воркер запускается и грузит torch (секунды), фото не ждут его и уходят в Gemini
+        timeout = self.timeout if self._ready.is_set() else min(self.timeout, COLD_START_WAIT)
+        try:
+            result = waiter.result(timeout=timeout)
+        except FutureTimeoutError:
+            waiter.cancel()
+            self._count('timeout')
+            return None
+        except Exception as e:
+            print(f"Garment classifier failed: {e}")
+            self._count('error')
+            return None
+        if 'error' in result:
+            self._count('error')
+            return None
+        classification = Classification(result.get('category'), result['colors'],
+                                        result.get('confidence', 0.0), self.threshold, self.categories)
+        self._count('hit' if classification.confident else 'fallback')
+        return classification
+
+    def shutdown(self):
+        """Останавливает пул процессов (atexit в app.py)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
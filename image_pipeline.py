@@ -0,0 +1,155 @@
+"""
+Нормализация изображений перед отправкой в модели.
+
+Фото с телефона (12 Мп, несколько мегабайт) не нужны Gemini в исходном
+разрешении. Здесь изображение:
+- определяется по содержимому (PIL), а не по первым байтам или расширению;
+- для JPEG декодируется сразу в уменьшенном виде (Image.draft);
+- поворачивается по EXIF Orientation, после чего EXIF отбрасывается;
+- уменьшается до IMAGE_MAX_EDGE по длинной стороне;
+- пережимается в компактный формат (JPEG, либо PNG/WEBP при прозрачности).
+
+Счетчики экономии байтов и пикселей доступны через get_stats().
+"""
+import os
+import threading
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', 1024))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+
+# Защита от "декомпрессионных бомб": больше 50 Мп не декодируем
+Image.MAX_IMAGE_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))
+
+MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif',
+    'BMP': 'image/bmp',
+    'TIFF': 'image/tiff',
+    'MPO': 'image/jpeg',
+}
+
+
+class NormalizedImage:
+    def __init__(self, data, mime_type, width, height, original_format, original_size, original_bytes):
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+        self.original_format = original_format
+        self.original_size = original_size # (width, height) до уменьшения
+        self.original_bytes = original_bytes
+
+    def as_part(self):
+        """Часть запроса для Gemini: {'mime_type': ..., 'data': ...}."""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+    def to_pil(self):
+        return Image.open(BytesIO(self.data))
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.pixels_in = 0
+        self.pixels_out = 0
+
+    def record(self, bytes_in, bytes_out, pixels_in, pixels_out):
+        with self._lock:
+            self.images += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.pixels_in += pixels_in
+            self.pixels_out += pixels_out
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'images': self.images,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'bytes_saved': self.bytes_in - self.bytes_out,
+                'pixels_in': self.pixels_in,
+                'pixels_out': self.pixels_out,
+                'pixels_saved': self.pixels_in - self.pixels_out,
+            }
+
+
+_stats = _Stats()
+
+
+def get_stats():
+    return _stats.snapshot()
+
+
+def sniff_mime_type(image_bytes):
+    """Определяет MIME-тип по содержимому. Возвращает None, если это не изображение."""
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            return MIME_TYPES.get(image.format)
+    except Exception:
+        return None
+
+
+def _has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def normalize_image(source, max_edge=None, quality=None):
+    """
+    Нормализует изображение. source - байты или файлоподобный объект (читается потоково
+    самим PIL, целиком в память не копируется). Возвращает NormalizedImage.
+    Некорректное изображение - PIL.UnidentifiedImageError (как и Image.open).
+    """
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    quality = quality or IMAGE_JPEG_QUALITY
+
+    if isinstance(source, (bytes, bytearray)):
+        original_bytes = len(source)
+        stream = BytesIO(source)
+    else:
+        stream = source
+        start = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        original_bytes = stream.tell() - start
+        stream.seek(start)
+
+    image = Image.open(stream)
+    original_format = image.format
+    original_size = image.size
+
+    # EXIF-поворот меняет местами стороны, поэтому draft считаем по длинной стороне
+    if original_format in ('JPEG', 'MPO'):
+        scale = max(original_size) / max_edge
+        if scale >= 2:
+            # JPEG умеет декодироваться сразу в 1/2, 1/4, 1/8 - это в разы быстрее полного декода
+            image.draft('RGB', (max(1, int(original_size[0] / scale)), max(1, int(original_size[1] / scale))))
+
+    image = ImageOps.exif_transpose(image) # Применяем ориентацию (и убираем тег Orientation)
+
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    output = BytesIO()
+    if _has_alpha(image):
+        image = image.convert('RGBA')
+        image.save(output, format='WEBP', quality=quality, method=4)
+        mime_type = 'image/webp'
+    else:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        # EXIF и прочие метаданные не передаем в save - они отбрасываются
+        image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+        mime_type = 'image/jpeg'
+
+    data = output.getvalue()
+    _stats.record(original_bytes, len(data), original_size[0] * original_size[1], image.size[0] * image.size[1])
+    return NormalizedImage(data, mime_type, image.size[0], image.size[1],
+                           original_format, original_size, original_bytes)
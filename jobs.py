@@ -0,0 +1,239 @@
+"""
+Фоновые задачи генерации изображений.
+
+POST /generate больше не держит HTTP-запрос открытым на все время работы
+диффузионной модели: задача записывается в БД и выполняется в пуле потоков,
+а клиент опрашивает статус по id (или подписывается на SSE).
+
+Состояние задач хранится в базе, поэтому статус доступен из любого воркера
+gunicorn, а одинаковые промпты, которые уже в работе, объединяются в одну задачу:
+частичный уникальный индекс по prompt_hash для задач в работе не дает двум
+параллельным запросам создать две задачи. Задачи, оставшиеся в работе после
+перезапуска воркера, завершаются как failed при чтении (старше stale_after).
+
+wait() (SSE /generate/<id>/events и POST /generate с "wait") будится переходами задач
+этого процесса сразу, а задачи других воркеров видит опросом БД раз в несколько секунд.
+Ожидающий запрос все равно занимает поток воркера на время ожидания: при многих
+подписчиках SSE gunicorn нужно запускать с асинхронными воркерами (gevent) или
+с запасом потоков (--threads).
+"""
+import hashlib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+IN_FLIGHT_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED)
+# Условие частичного уникального индекса по prompt_hash (модель и миграция 0006)
+GENERATION_IN_FLIGHT_SQL = "status IN ('queued', 'running')"
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+def normalize_prompt(prompt):
+    return ' '.join(prompt.split())
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(normalize_prompt(prompt).encode('utf-8')).hexdigest()
+
+
+class GenerationJobRunner:
+    """
+    Выполняет задачи генерации в ограниченном пуле потоков.
+
+    job_model - модель SQLAlchemy с полями id, prompt, prompt_hash, status,
+    result_url, error, created_at, started_at, finished_at.
+    func(prompt) -> url - собственно генерация (generate_clothing_image).
+    stale_after - через сколько секунд задача в очереди (от created_at) или в работе
+    (от started_at) считается потерянной (например, воркер перезапустили): при чтении
+    или повторной постановке она завершается как failed, а воркер, если она все же
+    до него дойдет, ее пропускает.
+    """
+
+    def __init__(self, app, db, job_model, func, max_workers=4, max_pending=100, stale_after=600):
+        self.app = app
+        self.db = db
+        self.job_model = job_model
+        self.func = func
+        self.max_pending = max_pending
+        self.stale_after = stale_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='generation-job')
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition() # Будит wait() при переходе любой задачи этого процесса
+        self._version = 0
+
+    def submit(self, prompt):
+        """
+        Ставит генерацию в очередь. Возвращает (job, created): если такой же промпт
+        уже генерируется, возвращается существующая задача и created=False.
+        """
+        Job = self.job_model
+        key = prompt_hash(prompt)
+        self._expire_stale(Job.prompt_hash == key)
+        existing = self._in_flight(key)
+        if existing:
+            return existing, False
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFullError("Too many generation jobs in progress, try again later")
+            self._pending += 1
+
+        try:
+            job = Job(
+                id=uuid.uuid4().hex,
+                prompt=normalize_prompt(prompt),
+                prompt_hash=key,
+                status=JOB_QUEUED,
+                created_at=datetime.utcnow(),
+            )
+            self.db.session.add(job)
+            self.db.session.commit()
+        except IntegrityError:
+            # Тот же промпт параллельно поставил другой запрос - отдаем его задачу
+            self._release()
+            self.db.session.rollback()
+            existing = self._in_flight(key)
+            if existing is None:
+                raise
+            return existing, False
+        except Exception:
+            self._release()
+            self.db.session.rollback()
+            raise
+
+        try:
+            self._executor.submit(self._run, job.id, job.prompt)
+        except Exception as e:
+            # Пул остановлен (завершение процесса) - задача не выполнится, не оставляем ее в работе
+            self._release()
+            self._transition(job.id, JOB_QUEUED, status=JOB_FAILED, error=str(e), finished_at=datetime.utcnow())
+            raise
+        return job, True
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def _notify(self):
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    def _in_flight(self, key):
+        Job = self.job_model
+        return Job.query.filter(Job.prompt_hash == key, Job.status.in_(IN_FLIGHT_STATUSES)) \
+            .order_by(Job.created_at.desc()).first()
+
+    def _stale_condition(self):
+        Job = self.job_model
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        return or_(and_(Job.status == JOB_QUEUED, Job.created_at < cutoff),
+                   and_(Job.status == JOB_RUNNING, Job.started_at < cutoff))
+
+    def _expire_stale(self, *criteria):
+        """Завершает как failed задачи, которые слишком долго в работе (воркер перезапустили)."""
+        count = self.job_model.query.filter(*criteria, self._stale_condition()).update({
+            'status': JOB_FAILED,
+            'error': "Generation was interrupted, please try again",
+            'finished_at': datetime.utcnow(),
+        }, synchronize_session=False)
+        if count:
+            print(f"Marked {count} stale generation job(s) as failed")
+            self.db.session.commit()
+            self._notify()
+        return count
+
+    def _transition(self, job_id, from_status, **fields):
+        """Меняет задачу, только если она все еще в статусе from_status; возвращает True при успехе."""
+        count = self.job_model.query.filter_by(id=job_id, status=from_status) \
+            .update(fields, synchronize_session=False)
+        self.db.session.commit()
+        if count:
+            self._notify()
+        return count == 1
+
+    def _run(self, job_id, prompt):
+        try:
+            with self.app.app_context():
+                if not self._transition(job_id, JOB_QUEUED, status=JOB_RUNNING, started_at=datetime.utcnow()):
+                    return # Задачу уже завершили как зависшую (слишком долго ждала в очереди)
+                try:
+                    result_url = self.func(prompt)
+                except Exception as e:
+                    print(f"Generation job {job_id} failed: {e}")
+                    self._transition(job_id, JOB_RUNNING, status=JOB_FAILED, error=str(e),
+                                     finished_at=datetime.utcnow())
+                    return
+                if result_url:
+                    self._transition(job_id, JOB_RUNNING, status=JOB_SUCCEEDED, result_url=result_url,
+                                     finished_at=datetime.utcnow())
+                else:
+                    self._transition(job_id, JOB_RUNNING, status=JOB_FAILED, error="Failed to generate image",
+                                     finished_at=datetime.utcnow())
+        except Exception as e:
+            print(f"Error updating generation job {job_id}: {e}")
+        finally:
+            self._release()
+
+    def get(self, job_id):
+        """Задача по id; зависшая задача (старше stale_after) сначала завершается как failed."""
+        Job = self.job_model
+        job = self.db.session.get(Job, job_id)
+        if job is not None and self._is_stale(job) and self._expire_stale(Job.id == job_id):
+            self.db.session.refresh(job)
+        return job
+
+    def _is_stale(self, job):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        if job.status == JOB_QUEUED:
+            return job.created_at < cutoff
+        return job.status == JOB_RUNNING and job.started_at is not None and job.started_at < cutoff
+
+    def wait(self, job_id, timeout, known_status=None, poll_interval=5.0):
+        """
+        Ждет, пока задача завершится или ее статус станет отличным от known_status;
+        по таймауту возвращает текущее состояние. Задачу перечитывает из БД после перехода
+        любой задачи этого процесса или раз в poll_interval секунд (задачи других воркеров).
+        Между проверками сессия закрывается - соединение не держится из пула.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._changed:
+                version = self._version
+            self.db.session.expire_all()
+            job = self.get(job_id)
+            self.db.session.close() # Загруженные поля задачи остаются доступны
+            if job is None or job.status in FINISHED_STATUSES or time.monotonic() >= deadline:
+                return job
+            if known_status is not None and job.status != known_status:
+                return job
+            with self._changed:
+                if self._version == version:
+                    self._changed.wait(min(poll_interval, max(0.0, deadline - time.monotonic())))
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "image_url": job.result_url,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
@@ -0,0 +1,319 @@
+"""
+Метрики и разбивка времени запроса по этапам.
+
+- stage('gemini.garment') - контекстный менеджер/декоратор: время этапа попадает
+  в гистограмму stylesynth_stage_duration_seconds{stage} и в трассу текущего запроса.
+- init_app(app) - гистограмма stylesynth_http_request_duration_seconds{route,method,status}
+  (для потоковых ответов - до конца отдачи тела), маршрут /metrics в текстовом формате
+  Prometheus и сэмплер медленных запросов: при SLOW_REQUEST_MS > 0 запрос дольше
+  порога печатается одной JSON-строкой с разбивкой по этапам, последние такие запросы
+  доступны на /metrics/slow. Запросы записываются по шаблону маршрута (/api/wardrobe/list/<int:user_id>),
+  без id из URL. /metrics и /metrics/slow отдаются только с заголовком
+  "Authorization: Bearer <METRICS_TOKEN>"; без METRICS_TOKEN - 404, если не задан
+  METRICS_PUBLIC=1 (сеть, закрытая от клиентов).
+- instrument_sqlalchemy(engine) - время SQL-запросов (db.query) и commit (db.commit).
+- observe_model_call - наблюдатель для ModelGateway: гистограмма по провайдеру и исходу.
+
+Сторонняя библиотека не нужна: формат вывода совместим с Prometheus.
+"""
+import hmac
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from flask import Response, g, has_request_context, jsonify, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+SLOW_REQUEST_KEEP = int(os.environ.get('SLOW_REQUEST_KEEP', 50))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', '0') == '1'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # labels -> [счетчики по корзинам..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {round(series[-1], 6)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, name, help_text, metric_type, collect):
+        """collect() -> [(labels_dict, value)]; вызывается при каждом чтении /metrics."""
+        with self._lock:
+            self._collectors.append((name, help_text, metric_type, collect))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        for metric in metrics:
+            lines.extend(metric.render())
+        for name, help_text, metric_type, collect in collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                print(f"Metrics collector {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    'stylesynth_http_request_duration_seconds', 'HTTP request duration by route.', ('route', 'method', 'status'))
+stage_duration = registry.histogram(
+    'stylesynth_stage_duration_seconds', 'Duration of request stages (model calls, image decode, DB).', ('stage',))
+model_call_duration = registry.histogram(
+    'stylesynth_model_call_duration_seconds', 'Model provider call duration by outcome.',
+    ('provider', 'method', 'outcome'))
+slow_requests_total = registry.counter(
+    'stylesynth_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.', ('route',))
+
+
+# --- Трасса запроса ---
+
+class RequestTrace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {} # stage -> [count, seconds]
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def breakdown(self):
+        with self._lock:
+            return {name: {"count": count, "ms": round(seconds * 1000, 2)}
+                    for name, (count, seconds) in sorted(self.stages.items(), key=lambda kv: -kv[1][1])}
+
+
+def current_trace():
+    if has_request_context():
+        return g.get('_metrics_trace')
+    return None
+
+
+def record_stage(name, seconds, trace=None):
+    stage_duration.observe(seconds, stage=name)
+    trace = trace or current_trace()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+class stage:
+    """
+    Замер этапа:
+        with stage('image.normalize'): ...
+    или декоратор @stage('gemini.garment').
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._trace = current_trace()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_stage(self.name, time.perf_counter() - self._started, self._trace)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def observe_model_call(provider, method, outcome, seconds):
+    """Наблюдатель ModelGateway: каждая попытка вызова провайдера."""
+    model_call_duration.observe(seconds, provider=provider, method=method, outcome=outcome)
+    record_stage(f"model.{provider}.{method}", seconds)
+
+
+# --- SQLAlchemy ---
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_metrics_query_start')
+    if starts:
+        record_stage('db.query', time.perf_counter() - starts.pop())
+
+
+def _before_commit(session):
+    session.info['_metrics_commit_start'] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop('_metrics_commit_start', None)
+    if started is not None:
+        record_stage('db.commit', time.perf_counter() - started)
+
+
+def instrument_sqlalchemy(engine, session_class):
+    """Повторный вызов (например, create_app() в тестах) обработчики не дублирует."""
+    from sqlalchemy import event
+
+    for target, name, listener in (
+        (engine, 'before_cursor_execute', _before_cursor_execute),
+        (engine, 'after_cursor_execute', _after_cursor_execute),
+        (session_class, 'before_commit', _before_commit),
+        (session_class, 'after_commit', _after_commit),
+    ):
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+
+# --- Flask ---
+
+def _check_metrics_access():
+    """None - доступ есть, иначе ответ с ошибкой."""
+    if not METRICS_TOKEN:
+        return None if METRICS_PUBLIC else (jsonify({"error": "Not found"}), 404)
+    supplied = request.headers.get('Authorization', '')
+    if hmac.compare_digest(supplied.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return None
+    return jsonify({"error": "Unauthorized"}), 401, {'WWW-Authenticate': 'Bearer'}
+
+
+_slow_requests = deque(maxlen=SLOW_REQUEST_KEEP)
+
+
+def _finish_request(trace, route, method, status):
+    seconds = time.perf_counter() - trace.started
+    http_request_duration.observe(seconds, route=route, method=method, status=status)
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        slow_requests_total.inc(route=route)
+        sample = {
+            "route": route,
+            "method": method,
+            "status": status,
+            "duration_ms": round(seconds * 1000, 2),
+            "stages": trace.breakdown(),
+            "at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        _slow_requests.append(sample)
+        print(f"Slow request: {json.dumps(sample, ensure_ascii=False)}")
+
+
+def init_app(app):
+    @app.before_request
+    def _start_trace():
+        g._metrics_trace = RequestTrace()
+
+    @app.after_request
+    def _observe_request(response):
+        trace = g.get('_metrics_trace')
+        if trace is None or request.endpoint in ('metrics', 'slow_requests'):
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        args = (trace, route, request.method, str(response.status_code))
+        # Запрос считается завершенным, когда сервер закрыл ответ - для потоковых ответов это конец тела
+        response.call_on_close(lambda: _finish_request(*args))
+        return response
+
+    @app.route('/metrics', methods=['GET'], endpoint='metrics')
+    def metrics():
+        denied = _check_metrics_access()
+        if denied:
+            return denied
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/metrics/slow', methods=['GET'], endpoint='slow_requests')
+    def slow_requests():
+        denied = _check_metrics_access()
+        if denied:
+            return denied
+        return jsonify({"threshold_ms": SLOW_REQUEST_MS, "requests": list(_slow_requests)})
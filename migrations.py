@@ -0,0 +1,385 @@
+"""
+Миграции схемы БД - вместо create_all() через /create_db.
+
+    flask --app app db upgrade     # применить новые миграции
+    flask --app app db current     # примененные ревизии
+    flask --app app db history     # все ревизии
+
+Ревизии применяются по порядку, каждая - в своей транзакции, а номер
+примененной ревизии записывается в таблицу schema_migrations. Таблицы в
+ревизиях описаны отдельно от моделей app.py ("замороженная" схема на момент
+ревизии), как в Alembic. Новая ревизия - функция с @revision('000N', '...')
+в конце файла; уже примененные ревизии не меняются.
+
+Операции ревизий пропускают уже существующие таблицы, столбцы и индексы:
+базы, созданные раньше через /create_db (в том числе без столбцов,
+добавленных после их создания), приводятся к текущей схеме первым же upgrade.
+
+Модели app.py опережают схему, пока миграции не применены (новые столбцы), поэтому
+приложение проверяет ревизии при запуске: с DB_AUTO_MIGRATE=1 применяет их само
+(под блокировкой - воркеры gunicorn стартуют одновременно), иначе пишет, какие ревизии
+не применены, и отвечает 503 на запросы, пока схема не догонит код.
+"""
+import time
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer, LargeBinary, MetaData, PrimaryKeyConstraint,
+                        String, Table, Text, UniqueConstraint, inspect, text)
+
+_REVISIONS = []
+
+SCHEMA_RECHECK_SECONDS = 5.0 # Как часто запросы перепроверяют отстающую схему
+MIGRATION_LOCK_KEY = 0x5751_4d49 # pg_advisory_lock: одна миграция на кластер воркеров
+
+
+def revision(number, description):
+    def decorator(upgrade):
+        _REVISIONS.append((number, description, upgrade))
+        return upgrade
+    return decorator
+
+
+def revisions():
+    return [(number, description) for number, description, _ in _REVISIONS]
+
+
+class Operations:
+    """Минимальный аналог alembic.op поверх соединения SQLAlchemy."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.metadata = MetaData()
+
+    def _inspector(self):
+        # Инспектор кэширует схему - создаем заново после каждого DDL
+        return inspect(self.conn)
+
+    def _quote(self, name):
+        return self.conn.dialect.identifier_preparer.quote(name)
+
+    def has_table(self, name):
+        return self._inspector().has_table(name)
+
+    def has_column(self, table, name):
+        return name in {column['name'] for column in self._inspector().get_columns(table)}
+
+    def has_index(self, table, name):
+        return name in {index['name'] for index in self._inspector().get_indexes(table)}
+
+    def table(self, name, *columns):
+        """Описание таблицы на момент ревизии; внешние ключи ссылаются на таблицы этой же ревизии."""
+        return Table(name, self.metadata, *columns)
+
+    def create_table(self, table):
+        if not self.has_table(table.name):
+            table.create(self.conn)
+            return
+        # Таблица уже есть (создана create_all) - досоздаем ее индексы
+        for index in table.indexes:
+            self.create_index(index)
+
+    def add_column(self, table, column, server_default=None):
+        """
+        ALTER TABLE ... ADD COLUMN. Столбец NOT NULL добавляется только со server_default,
+        иначе существующие строки его не получат.
+        """
+        if self.has_column(table, column.name):
+            return
+        ddl = f"ALTER TABLE {self._quote(table)} ADD COLUMN {self._quote(column.name)} " \
+              f"{column.type.compile(dialect=self.conn.dialect)}"
+        if server_default is not None:
+            ddl += f" DEFAULT {server_default}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+        self.conn.execute(text(ddl))
+
+    def create_index(self, index):
+        if not self.has_index(index.table.name, index.name):
+            index.create(self.conn)
+
+
+def _ensure_version_table(conn):
+    metadata = MetaData()
+    table = Table(
+        'schema_migrations', metadata,
+        Column('version', String(32), primary_key=True),
+        Column('description', String(200), nullable=False),
+        Column('applied_at', DateTime, nullable=False),
+    )
+    table.create(conn, checkfirst=True)
+    return table
+
+
+def applied_revisions(engine):
+    with engine.begin() as conn:
+        table = _ensure_version_table(conn)
+        return [row.version for row in conn.execute(table.select().order_by(table.c.version))]
+
+
+def pending_revisions(engine):
+    applied = set(applied_revisions(engine))
+    return [(number, description) for number, description, _ in _REVISIONS if number not in applied]
+
+
+def upgrade(engine, log=print):
+    """Применяет все непримененные ревизии; возвращает их номера."""
+    applied = set(applied_revisions(engine))
+    done = []
+    for number, description, upgrade_revision in _REVISIONS:
+        if number in applied:
+            continue
+        with engine.begin() as conn:
+            table = _ensure_version_table(conn)
+            upgrade_revision(Operations(conn))
+            conn.execute(table.insert().values(version=number, description=description,
+                                               applied_at=datetime.utcnow()))
+        log(f"Applied migration {number}: {description}")
+        done.append(number)
+    return done
+
+
+def _upgrade_locked(engine, log):
+    """
+    upgrade() при запуске приложения. В PostgreSQL - под advisory lock; в остальных БД
+    ошибка параллельного upgrade не страшна, если после нее ревизий не осталось.
+    """
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            try:
+                return upgrade(engine, log)
+            finally:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+    try:
+        return upgrade(engine, log)
+    except Exception:
+        if pending_revisions(engine):
+            raise
+        return []
+
+
+def _guard_schema(app, db, after_upgrade, auto_upgrade):
+    """Проверка ревизий при запуске и 503 на запросы, пока схема отстает от моделей."""
+    from flask import jsonify
+
+    state = {'pending': None, 'checked_at': time.monotonic()}
+
+    def describe(pending):
+        return ', '.join(f"{number} ({description})" for number, description in pending)
+
+    with app.app_context():
+        try:
+            if auto_upgrade and pending_revisions(db.engine):
+                _upgrade_locked(db.engine, log=print)
+                if after_upgrade is not None:
+                    after_upgrade()
+            state['pending'] = pending_revisions(db.engine)
+        except Exception as e:
+            print(f"Error checking database migrations: {e}")
+    if state['pending']:
+        print(f"Error: database schema is behind the code, pending migrations: {describe(state['pending'])}. "
+              "Run 'flask --app app db upgrade' or set DB_AUTO_MIGRATE=1.")
+
+    @app.before_request
+    def require_current_schema():
+        if state['pending'] == []:
+            return None
+        now = time.monotonic()
+        if now - state['checked_at'] >= SCHEMA_RECHECK_SECONDS:
+            state['checked_at'] = now
+            try:
+                state['pending'] = pending_revisions(db.engine)
+            except Exception as e:
+                print(f"Error checking database migrations: {e}")
+        if not state['pending']:
+            return None # Схема догнала код (или БД недоступна - тогда ошибку вернет сам запрос)
+        return jsonify({"error": "Database schema is out of date, run the pending migrations",
+                        "pending_migrations": [number for number, _ in state['pending']]}), 503
+
+
+def init_app(app, db, after_upgrade=None, auto_upgrade=False):
+    """
+    Команды flask db upgrade/current/history и проверка схемы при запуске (см. описание модуля).
+    after_upgrade() - перенос данных после схемы; auto_upgrade - применить ревизии при запуске.
+    """
+    import click
+    from flask.cli import AppGroup
+
+    group = AppGroup('db', help='Database schema migrations.')
+
+    @group.command('upgrade')
+    def upgrade_command():
+        done = upgrade(db.engine, log=click.echo)
+        if after_upgrade is not None:
+            after_upgrade()
+        click.echo(f"Database is up to date ({len(done)} migration(s) applied).")
+
+    @group.command('current')
+    def current_command():
+        applied = applied_revisions(db.engine)
+        click.echo(applied[-1] if applied else 'empty')
+        for number, description in pending_revisions(db.engine):
+            click.echo(f"pending: {number} {description}")
+
+    @group.command('history')
+    def history_command():
+        applied = set(applied_revisions(db.engine))
+        for number, description in revisions():
+            click.echo(f"{number} {'applied' if number in applied else 'pending'}  {description}")
+
+    app.cli.add_command(group)
+    _guard_schema(app, db, after_upgrade, auto_upgrade)
+
+
+# --- Ревизии ---
+
+@revision('0001', 'users and wardrobe items')
+def _initial(op):
+    op.create_table(op.table(
+        'user',
+        Column('id', Integer, primary_key=True),
+        Column('username', String(80), unique=True, nullable=False),
+        Column('email', String(120), unique=True, nullable=False),
+    ))
+    op.create_table(op.table(
+        'wardrobe_item',
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+        Column('image_url', String(500)),
+        Column('category', String(50)),
+        Column('color', String(50)),
+        Column('style', String(50)),
+        Column('item_type', String(100), nullable=False),
+        Column('added_date', DateTime),
+    ))
+
+
+@revision('0002', 'wardrobe version, embeddings, storage keys, attribute index and generation jobs')
+def _wardrobe_indexes_and_jobs(op):
+    # Все, что до миграций добавлялось в модели, но не в уже созданные через /create_db таблицы
+    op.add_column('user', Column('wardrobe_version', Integer, nullable=False), server_default='0')
+    op.add_column('wardrobe_item', Column('embedding', LargeBinary))
+    op.add_column('wardrobe_item', Column('image_key', String(200)))
+
+    user = op.table('user', Column('id', Integer, primary_key=True))
+    wardrobe_item = op.table(
+        'wardrobe_item',
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer),
+        Column('category', String(50)),
+        Column('style', String(50)),
+        Column('added_date', DateTime),
+    )
+    for index in (
+        Index('ix_wardrobe_item_user_id_id', wardrobe_item.c.user_id, wardrobe_item.c.id),
+        Index('ix_wardrobe_item_user_id_category', wardrobe_item.c.user_id, wardrobe_item.c.category),
+        Index('ix_wardrobe_item_user_id_style', wardrobe_item.c.user_id, wardrobe_item.c.style),
+        Index('ix_wardrobe_item_user_id_added_date', wardrobe_item.c.user_id, wardrobe_item.c.added_date),
+    ):
+        op.create_index(index)
+
+    op.create_table(op.table(
+        'attribute',
+        Column('id', Integer, primary_key=True),
+        Column('kind', String(16), nullable=False),
+        Column('value', String(50), nullable=False),
+        UniqueConstraint('kind', 'value', name='uq_attribute_kind_value'),
+    ))
+    op.create_table(op.table(
+        'wardrobe_item_attribute',
+        Column('item_id', Integer, ForeignKey(wardrobe_item.c.id, ondelete='CASCADE')),
+        Column('attribute_id', Integer, ForeignKey('attribute.id')),
+        Column('user_id', Integer, ForeignKey(user.c.id), nullable=False),
+        PrimaryKeyConstraint('item_id', 'attribute_id'),
+        Index('ix_wardrobe_item_attribute_user_attribute', 'user_id', 'attribute_id', 'item_id'),
+    ))
+
+    op.create_table(op.table(
+        'generation_job',
+        Column('id', String(32), primary_key=True),
+        Column('prompt', Text, nullable=False),
+        Column('prompt_hash', String(64), nullable=False),
+        Column('status', String(16), nullable=False),
+        Column('result_url', String(500)),
+        Column('error', Text),
+        Column('created_at', DateTime, nullable=False),
+        Column('started_at', DateTime),
+        Column('finished_at', DateTime),
+        Index('ix_generation_job_prompt_hash_status', 'prompt_hash', 'status'),
+    ))
+
+
+@revision('0003', 'appearance profiles')
+def _appearance_profiles(op):
+    user = op.table('user', Column('id', Integer, primary_key=True))
+    op.create_table(op.table(
+        'appearance_profile',
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer, ForeignKey(user.c.id, ondelete='CASCADE'), nullable=False),
+        Column('skin_tone', String(50)),
+        Column('appearance_tone', String(50)),
+        Column('analysis', Text),
+        Column('prompt_version', String(16), nullable=False),
+        Column('model', String(100)),
+        Column('image_sha256', String(64)),
+        Column('created_at', DateTime, nullable=False),
+        Index('ix_appearance_profile_user_id_id', 'user_id', 'id'),
+    ))
+
+
+@revision('0004', 'chat sessions')
+def _chat_sessions(op):
+    user = op.table('user', Column('id', Integer, primary_key=True))
+    chat_session = op.table(
+        'chat_session',
+        Column('id', String(32), primary_key=True),
+        Column('user_id', Integer, ForeignKey(user.c.id, ondelete='CASCADE')),
+        Column('body_type', String(100), nullable=False),
+        Column('summary', Text),
+        Column('summarized_through', Integer, nullable=False, server_default='0'),
+        Column('pinned_image_key', String(200)),
+        Column('context_cache_name', String(200)),
+        Column('context_cache_key', String(64)),
+        Column('context_cache_expires_at', DateTime),
+        Column('created_at', DateTime, nullable=False),
+        Column('updated_at', DateTime, nullable=False),
+    )
+    op.create_table(chat_session)
+    op.create_table(op.table(
+        'chat_message',
+        Column('id', Integer, primary_key=True),
+        Column('session_id', String(32), ForeignKey(chat_session.c.id, ondelete='CASCADE'), nullable=False),
+        Column('role', String(8), nullable=False),
+        Column('text', Text, nullable=False),
+        Column('image_key', String(200)),
+        Column('tokens', Integer, nullable=False),
+        Column('created_at', DateTime, nullable=False),
+        Index('ix_chat_message_session_id_id', 'session_id', 'id'),
+    ))
+
+
+@revision('0005', 'chat context cache checkpoint')
+def _chat_context_cache_through(op):
+    op.add_column('chat_session', Column('context_cache_through', Integer))
+
+
+@revision('0006', 'one in-flight generation job per prompt')
+def _generation_job_in_flight_unique(op):
+    # Дубликаты, созданные до индекса, завершаем - в работе остается самая новая задача промпта
+    op.conn.execute(text(
+        "UPDATE generation_job SET status = 'failed', error = 'Superseded by a newer job for the same prompt', "
+        "finished_at = CURRENT_TIMESTAMP "
+        "WHERE status IN ('queued', 'running') AND EXISTS ("
+        "SELECT 1 FROM generation_job newer WHERE newer.prompt_hash = generation_job.prompt_hash "
+        "AND newer.status IN ('queued', 'running') AND (newer.created_at > generation_job.created_at "
+        "OR (newer.created_at = generation_job.created_at AND newer.id > generation_job.id)))"
+    ))
+    generation_job = op.table(
+        'generation_job',
+        Column('id', String(32), primary_key=True),
+        Column('prompt_hash', String(64)),
+        Column('status', String(16)),
+    )
+    in_flight = text("status IN ('queued', 'running')")
+    op.create_index(Index('uq_generation_job_prompt_hash_in_flight', generation_job.c.prompt_hash, unique=True,
+                          sqlite_where=in_flight, postgresql_where=in_flight))
@@ -0,0 +1,575 @@
+"""
+Единый шлюз для вызовов внешних моделей (Gemini, Replicate).
+
+Все вызовы идут через ограниченные пулы потоков - по одному на провайдера,
+поэтому несколько медленных генераций не занимают все воркеры gunicorn.
+Для каждого провайдера настраиваются:
+- лимит одновременных вызовов (размер пула);
+- таймаут одного вызова и общий срок на вызов вместе с повторами;
+- повторы с экспоненциальной задержкой и джиттером для временных ошибок; попытка,
+  которая уже выполнялась и не уложилась в таймаут, не повторяется: ее поток пула
+  остается занятым ("брошенный" вызов), и повтор только занял бы еще один. Если брошенные
+  вызовы заняли весь пул, новые вызовы сразу получают ModelOverloadedError;
+- circuit breaker: после серии ошибок провайдер временно "отключается",
+  и вызовы сразу завершаются ошибкой, не дожидаясь таймаутов.
+
+Без сети вместо настоящих SDK можно подключить локальные заглушки
+(MODEL_PROVIDER=stub) - они нужны для нагрузочных тестов и работают без ключей API.
+
+Клиенты моделей берутся из ModelRegistry (model_registry.py) и создаются один раз на воркер;
+generate_task/generate_task_stream/run_replicate выбирают модель по задаче (prompts.MODEL_TASKS).
+create_context_cache - кэш общей части запросов на стороне Gemini (используется сессиями чата).
+"""
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from model_registry import ModelRegistry
+from prompts import MODEL_TASKS
+
+
+class ModelCallError(Exception):
+    """Базовая ошибка вызова модели через шлюз."""
+
+
+class ModelTimeoutError(ModelCallError):
+    pass
+
+
+class CircuitOpenError(ModelCallError):
+    pass
+
+
+class ModelOverloadedError(ModelCallError):
+    """Все потоки пула провайдера заняты брошенными (истекшими) вызовами."""
+
+
+class CircuitBreaker:
+    """
+    Простой circuit breaker: closed -> open после failure_threshold ошибок подряд,
+    через reset_timeout секунд пропускает один пробный вызов (half-open).
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """Пробный вызов отменен без результата - следующий вызов снова может стать пробным."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+# --- Провайдеры ---
+
+class GeminiProvider:
+    name = 'gemini'
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def _model(self, model_name, generation_config, cached_content):
+        if cached_content:
+            return self.registry.gemini_cached_model(cached_content, generation_config)
+        return self.registry.gemini_model(model_name, generation_config)
+
+    def generate(self, model_name, contents, generation_config=None, cached_content=None, **kwargs):
+        model = self._model(model_name, generation_config, cached_content)
+        response = model.generate_content(contents, **kwargs)
+        return response.text
+
+    def generate_stream(self, model_name, contents, generation_config=None, cached_content=None, **kwargs):
+        model = self._model(model_name, generation_config, cached_content)
+        for chunk in model.generate_content(contents, stream=True, **kwargs):
+            try:
+                text = chunk.text
+            except ValueError:
+                continue # Служебный кусок без текста (например, только finish_reason)
+            if text:
+                yield text
+
+    def create_cache(self, model_name, contents, ttl_seconds):
+        return self.registry.create_gemini_cache(model_name, contents, ttl_seconds)
+
+    def is_retryable(self, exc):
+        try:
+            from google.api_core import exceptions as gexc
+        except ImportError:
+            return False
+        return isinstance(exc, (
+            gexc.TooManyRequests,
+            gexc.ResourceExhausted,
+            gexc.ServiceUnavailable,
+            gexc.DeadlineExceeded,
+            gexc.InternalServerError,
+        ))
+
+
+class ReplicateProvider:
+    name = 'replicate'
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def run(self, model_ref, model_input):
+        return self.registry.replicate_client().run(model_ref, input=model_input)
+
+    def is_retryable(self, exc):
+        try:
+            import httpx
+            from replicate.exceptions import ReplicateError
+        except ImportError:
+            return False
+        if isinstance(exc, httpx.TransportError):
+            return True
+        status = getattr(exc, 'status', None)
+        return isinstance(exc, ReplicateError) and status is not None and (status == 429 or status >= 500)
+
+
+class StubProviderError(Exception):
+    """Искусственная ошибка заглушки (считается временной)."""
+
+
+def _text_parts(contents):
+    """Текстовые части запроса, включая реплики истории ({'role', 'parts'})."""
+    for part in contents if isinstance(contents, list) else [contents]:
+        if isinstance(part, str):
+            yield part
+        elif isinstance(part, dict) and 'parts' in part:
+            yield from _text_parts(part['parts'])
+
+
+class StubProvider:
+    """
+    Детерминированная заглушка для Gemini и Replicate без сети.
+
+    latency - средняя задержка вызова в секундах, jitter - разброс,
+    error_rate - доля вызовов, завершающихся StubProviderError.
+    """
+
+    def __init__(self, name, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _simulate(self):
+        with self._lock:
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise StubProviderError(f"Stub {self.name} provider failure")
+
+    def generate(self, model_name, contents, **kwargs):
+        self._simulate()
+        prompt = ' '.join(_text_parts(contents))
+        digest = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 16)
+        if "'category', 'colors', 'style'" in prompt:
+            categories = ['shirt', 'pants', 'dress', 'shoe', 'jacket']
+            colors = ['black', 'white', 'blue', 'red', 'beige']
+            styles = ['casual', 'formal', 'sporty', 'elegant']
+            return json.dumps({
+                'category': categories[digest % len(categories)],
+                'colors': [colors[digest % len(colors)]],
+                'style': styles[digest % len(styles)],
+            })
+        if "'skin_tone', 'appearance_tone'" in prompt:
+            return json.dumps({'skin_tone': 'medium', 'appearance_tone': 'neutral'})
+        if "'outfit_name'" in prompt:
+            return json.dumps([{
+                'outfit_name': 'Stub Outfit',
+                'items': ['white t-shirt', 'blue jeans'],
+                'reason': 'Stub provider response.',
+            }])
+        return f"Stub response from {model_name}."
+
+    def generate_stream(self, model_name, contents, **kwargs):
+        text = self.generate(model_name, contents, **kwargs)
+        for start in range(0, len(text), 16):
+            yield text[start:start + 16]
+
+    def run(self, model_ref, model_input):
+        self._simulate()
+        digest = hashlib.sha256(json.dumps(model_input, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        return [f"https://placehold.co/512x512/png?text=stub_{digest}"]
+
+    def is_retryable(self, exc):
+        return isinstance(exc, StubProviderError)
+
+
+# --- Шлюз ---
+
+class ModelGateway:
+    """
+    Выполняет вызовы провайдеров в ограниченных пулах потоков.
+
+    limits - {provider: max одновременных вызовов},
+    timeouts - {provider: таймаут одной попытки в секундах},
+    total_timeouts - {provider: срок на все попытки вместе с паузами между ними}.
+    Без таймаута (None) попытка ждет ответа сколько угодно.
+    """
+
+    def __init__(self, providers, limits=None, timeouts=None, max_retries=2,
+                 backoff_base=0.5, backoff_max=8.0, failure_threshold=5, reset_timeout=30.0, registry=None,
+                 total_timeouts=None):
+        self.providers = {provider.name: provider for provider in providers}
+        self.registry = registry or ModelRegistry(MODEL_TASKS)
+        limits = limits or {}
+        self.timeouts = timeouts or {}
+        self.total_timeouts = total_timeouts or {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._pool_sizes = {name: limits.get(name, 8) for name in self.providers}
+        self._executors = {
+            name: ThreadPoolExecutor(max_workers=self._pool_sizes[name], thread_name_prefix=f"model-{name}")
+            for name in self.providers
+        }
+        self._breakers = {
+            name: CircuitBreaker(failure_threshold, reset_timeout) for name in self.providers
+        }
+        self._in_flight = {name: 0 for name in self.providers}
+        self._queued = {name: 0 for name in self.providers} # Ждут свободного потока пула
+        self._abandoned = {name: 0 for name in self.providers} # Истекли, но еще занимают поток пула
+        self._lock = threading.Lock()
+        # observer(provider, method, outcome, seconds) вызывается после каждой попытки (метрики)
+        self.observer = None
+
+    @property
+    def is_stub(self):
+        return all(isinstance(provider, StubProvider) for provider in self.providers.values())
+
+    @classmethod
+    def from_env(cls):
+        """
+        MODEL_PROVIDER=stub подключает заглушки (задержка STUB_LATENCY_MS, доля ошибок STUB_ERROR_RATE).
+        Лимиты и таймауты: MODEL_GATEWAY_<PROVIDER>_CONCURRENCY / MODEL_GATEWAY_<PROVIDER>_TIMEOUT
+        (одна попытка) / MODEL_GATEWAY_<PROVIDER>_TOTAL_TIMEOUT (все попытки, по умолчанию 1.5 таймаута).
+        """
+        registry = ModelRegistry.from_env(MODEL_TASKS)
+        if os.environ.get('MODEL_PROVIDER', '').lower() == 'stub':
+            latency = float(os.environ.get('STUB_LATENCY_MS', 0)) / 1000
+            error_rate = float(os.environ.get('STUB_ERROR_RATE', 0))
+            providers = [
+                StubProvider('gemini', latency=latency, error_rate=error_rate),
+                StubProvider('replicate', latency=latency, error_rate=error_rate),
+            ]
+        else:
+            providers = [GeminiProvider(registry), ReplicateProvider(registry)]
+
+        defaults = {'gemini': (16, 60), 'replicate': (4, 300)}
+        limits, timeouts, total_timeouts = {}, {}, {}
+        for name, (limit, timeout) in defaults.items():
+            limits[name] = int(os.environ.get(f"MODEL_GATEWAY_{name.upper()}_CONCURRENCY", limit))
+            timeouts[name] = float(os.environ.get(f"MODEL_GATEWAY_{name.upper()}_TIMEOUT", timeout))
+            total_timeouts[name] = float(os.environ.get(f"MODEL_GATEWAY_{name.upper()}_TOTAL_TIMEOUT",
+                                                        timeouts[name] * 1.5))
+
+        return cls(
+            providers,
+            limits=limits,
+            timeouts=timeouts,
+            total_timeouts=total_timeouts,
+            max_retries=int(os.environ.get('MODEL_GATEWAY_MAX_RETRIES', 2)),
+            failure_threshold=int(os.environ.get('MODEL_GATEWAY_BREAKER_THRESHOLD', 5)),
+            reset_timeout=float(os.environ.get('MODEL_GATEWAY_BREAKER_RESET', 30)),
+            registry=registry,
+        )
+
+    def _observe(self, provider_name, method, outcome, started):
+        if self.observer is not None:
+            try:
+                self.observer(provider_name, method, outcome, time.perf_counter() - started)
+            except Exception as e:
+                print(f"Model gateway observer failed: {e}")
+
+    def _backoff(self, attempt):
+        # "Full jitter": случайная задержка от 0 до экспоненциального предела
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _deadline(self, provider_name, total_timeout):
+        total_timeout = total_timeout or self.total_timeouts.get(provider_name)
+        return None if total_timeout is None else time.monotonic() + total_timeout
+
+    @staticmethod
+    def _attempt_timeout(timeout, deadline):
+        """Сколько ждать попытку: ее таймаут, но не дольше общего срока; None - без ограничения."""
+        if deadline is None:
+            return timeout
+        remaining = max(0.0, deadline - time.monotonic())
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def _retry_delay(self, attempt, deadline):
+        """Пауза перед повтором или None, если повторов больше нет или пауза не уложится в срок."""
+        if attempt >= self.max_retries:
+            return None
+        delay = self._backoff(attempt)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _check_capacity(self, provider_name):
+        with self._lock:
+            abandoned = self._abandoned[provider_name]
+        if abandoned >= self._pool_sizes[provider_name]:
+            raise ModelOverloadedError(f"{provider_name} is overloaded: all {abandoned} workers are stuck "
+                                       f"in timed out calls")
+
+    def _abandon(self, provider_name, future):
+        """Истекший вызов продолжает занимать поток пула, пока провайдер не ответит."""
+        with self._lock:
+            self._abandoned[provider_name] += 1
+
+        def finished(_):
+            with self._lock:
+                self._abandoned[provider_name] -= 1
+        future.add_done_callback(finished)
+
+    def _submit(self, provider_name, func, args, kwargs):
+        with self._lock:
+            self._queued[provider_name] += 1
+        return self._executors[provider_name].submit(self._run, provider_name, func, args, kwargs)
+
+    def _run(self, provider_name, func, args, kwargs):
+        with self._lock:
+            self._queued[provider_name] -= 1
+            self._in_flight[provider_name] += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight[provider_name] -= 1
+
+    def call(self, provider_name, method, *args, timeout=None, total_timeout=None, **kwargs):
+        """
+        Синхронно выполняет метод провайдера с таймаутом, повторами и circuit breaker.
+        timeout - на попытку, total_timeout - на все попытки (по умолчанию - из настроек провайдера).
+        """
+        provider = self.providers[provider_name]
+        breaker = self._breakers[provider_name]
+        timeout = timeout or self.timeouts.get(provider_name)
+        deadline = self._deadline(provider_name, total_timeout)
+
+        attempt = 0
+        while True:
+            self._check_capacity(provider_name)
+            if not breaker.allow():
+                raise CircuitOpenError(f"{provider_name} is temporarily unavailable (circuit open)")
+
+            started = time.perf_counter()
+            future = self._submit(provider_name, getattr(provider, method), args, kwargs)
+            try:
+                result = future.result(timeout=self._attempt_timeout(timeout, deadline))
+            except FutureTimeoutError:
+                if future.cancel(): # Вызов так и не начался - из очереди его убрали
+                    with self._lock:
+                        self._queued[provider_name] -= 1
+                    retryable = True
+                else:
+                    self._abandon(provider_name, future)
+                    retryable = False # Повтор занял бы еще один поток, пока этот висит
+                self._observe(provider_name, method, 'timeout', started)
+                error = ModelTimeoutError(
+                    f"{provider_name}.{method} timed out after {time.perf_counter() - started:.1f}s")
+                if not retryable:
+                    breaker.record_failure()
+                    raise error
+            except Exception as e:
+                self._observe(provider_name, method, 'error', started)
+                error = e
+                retryable = provider.is_retryable(e)
+            else:
+                self._observe(provider_name, method, 'ok', started)
+                breaker.record_success()
+                return result
+
+            if not retryable:
+                # Ошибка запроса (например, некорректный ввод), а не провайдера - breaker не трогаем,
+                # только освобождаем пробный вызов half-open
+                breaker.release_probe()
+                raise error
+            breaker.record_failure()
+            delay = self._retry_delay(attempt, deadline)
+            if delay is None:
+                raise error
+            time.sleep(delay)
+            attempt += 1
+
+    def stream(self, provider_name, method, *args, timeout=None, total_timeout=None, **kwargs):
+        """
+        Генератор частей ответа потокового метода провайдера. Сам вызов идет в пуле провайдера,
+        части передаются через очередь. Повтор возможен только до получения первой части;
+        timeout - на весь ответ одной попытки, total_timeout - на все попытки вместе.
+        Если потребитель перестал читать (клиент отключился), генерация прерывается на следующей части.
+        """
+        provider = self.providers[provider_name]
+        breaker = self._breakers[provider_name]
+        timeout = timeout or self.timeouts.get(provider_name)
+        deadline = self._deadline(provider_name, total_timeout)
+
+        attempt = 0
+        while True:
+            self._check_capacity(provider_name)
+            if not breaker.allow():
+                raise CircuitOpenError(f"{provider_name} is temporarily unavailable (circuit open)")
+
+            chunks = queue.Queue()
+            cancelled = threading.Event()
+
+            def produce():
+                try:
+                    for chunk in getattr(provider, method)(*args, **kwargs):
+                        if cancelled.is_set():
+                            return
+                        chunks.put(('chunk', chunk))
+                    chunks.put(('done', None))
+                except Exception as e:
+                    chunks.put(('error', e))
+
+            started = time.perf_counter()
+            future = self._submit(provider_name, produce, (), {})
+            wait = self._attempt_timeout(timeout, deadline)
+            attempt_deadline = None if wait is None else time.monotonic() + wait
+            received = False
+            try:
+                while True:
+                    try:
+                        kind, value = chunks.get(
+                            timeout=None if attempt_deadline is None else max(0.0, attempt_deadline - time.monotonic()))
+                    except queue.Empty:
+                        raise ModelTimeoutError(
+                            f"{provider_name}.{method} timed out after {time.perf_counter() - started:.1f}s")
+                    if kind == 'chunk':
+                        received = True
+                        yield value
+                    elif kind == 'done':
+                        self._observe(provider_name, method, 'ok', started)
+                        breaker.record_success()
+                        return
+                    else:
+                        raise value
+            except GeneratorExit:
+                # Отключился клиент, а не провайдер - ошибкой провайдера не считаем
+                cancelled.set()
+                self._observe(provider_name, method, 'cancelled', started)
+                if received:
+                    breaker.record_success()
+                else:
+                    breaker.release_probe()
+                raise
+            except Exception as e:
+                cancelled.set()
+                timed_out = isinstance(e, ModelTimeoutError)
+                self._observe(provider_name, method, 'timeout' if timed_out else 'error', started)
+                stuck = False
+                if timed_out and not future.cancel():
+                    # Генерация уже шла и зависла - поток занят до ответа провайдера, повтор не делаем
+                    stuck = not future.done()
+                    self._abandon(provider_name, future)
+                elif timed_out:
+                    with self._lock:
+                        self._queued[provider_name] -= 1
+                retryable = timed_out or provider.is_retryable(e)
+                if not retryable:
+                    breaker.release_probe()
+                    raise
+                breaker.record_failure()
+                delay = None if received or stuck else self._retry_delay(attempt, deadline)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    def generate(self, model_name, contents, **kwargs):
+        """Текстовый/мультимодальный запрос к Gemini, возвращает текст ответа."""
+        return self.call('gemini', 'generate', model_name, contents, **kwargs)
+
+    def generate_stream(self, model_name, contents, **kwargs):
+        """Потоковый запрос к Gemini: генератор кусков текста по мере их генерации."""
+        return self.stream('gemini', 'generate_stream', model_name, contents, **kwargs)
+
+    def generate_task(self, task, contents, **kwargs):
+        """Запрос к модели задачи из prompts.MODEL_TASKS (модель и generation_config берутся оттуда)."""
+        spec = self.registry.spec(task)
+        kwargs.setdefault('generation_config', spec.get('generation_config'))
+        return self.call(spec['provider'], 'generate', spec['model'], contents, **kwargs)
+
+    def generate_task_stream(self, task, contents, **kwargs):
+        spec = self.registry.spec(task)
+        kwargs.setdefault('generation_config', spec.get('generation_config'))
+        return self.stream(spec['provider'], 'generate_stream', spec['model'], contents, **kwargs)
+
+    def create_context_cache(self, task, contents, ttl_seconds):
+        """
+        Кэш общей части запросов задачи на стороне провайдера (Gemini context caching).
+        Возвращает имя кэша для generate_task(..., cached_content=имя) или None, если провайдер
+        кэширование не поддерживает (заглушки).
+        """
+        spec = self.registry.spec(task)
+        if not hasattr(self.providers[spec['provider']], 'create_cache'):
+            return None
+        return self.call(spec['provider'], 'create_cache', spec['model'], contents, ttl_seconds)
+
+    def run_replicate(self, model_ref, model_input):
+        return self.call('replicate', 'run', model_ref, model_input)
+
+    def run_task(self, task, model_input):
+        spec = self.registry.spec(task)
+        return self.call(spec['provider'], 'run', spec['model'], model_input)
+
+    def stats(self):
+        with self._lock:
+            in_flight = dict(self._in_flight)
+            queued = dict(self._queued)
+            abandoned = dict(self._abandoned)
+        return {
+            name: {'in_flight': in_flight[name], 'queued': queued[name], 'abandoned': abandoned[name],
+                   'circuit': self._breakers[name].state}
+            for name in self.providers
+        }
@@ -0,0 +1,121 @@
+"""
+Реестр клиентов моделей.
+
+Клиент каждой модели (genai.GenerativeModel с конкретным generation_config,
+клиент Replicate) создается один раз на процесс при первом обращении
+и дальше переиспользуется всеми запросами воркера. SDK импортируются
+здесь же, лениво: воркер, который не вызывает модели (или работает с
+заглушками MODEL_PROVIDER=stub), их вообще не загружает и не требует ключей.
+"""
+import datetime
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# Сколько моделей поверх кэшей контекста Gemini держать (по одной на активную сессию чата)
+MAX_CACHED_CONTENT_MODELS = 256
+
+
+class MissingCredentialsError(Exception):
+    """Ключ API провайдера не задан."""
+
+
+class ModelRegistry:
+    def __init__(self, tasks, gemini_api_key=None, replicate_api_token=None):
+        self.tasks = tasks
+        self.gemini_api_key = gemini_api_key
+        self.replicate_api_token = replicate_api_token
+        self._gemini_models = {}
+        self._cached_content_models = OrderedDict()
+        self._gemini_configured = False
+        self._replicate_client = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, tasks):
+        return cls(tasks, gemini_api_key=os.environ.get('GEMINI_API_KEY'),
+                   replicate_api_token=os.environ.get('REPLICATE_API_TOKEN'))
+
+    def spec(self, task):
+        """{'provider', 'model', 'generation_config'} задачи из prompts.MODEL_TASKS."""
+        return self.tasks[task]
+
+    def missing_credentials(self):
+        missing = []
+        if not self.gemini_api_key:
+            missing.append('GEMINI_API_KEY')
+        if not self.replicate_api_token:
+            missing.append('REPLICATE_API_TOKEN')
+        return missing
+
+    def _genai(self):
+        """google.generativeai, настроенный ключом API. Вызывать под self._lock."""
+        import google.generativeai as genai
+        if not self._gemini_configured:
+            if not self.gemini_api_key:
+                raise MissingCredentialsError("GEMINI_API_KEY environment variable not set")
+            genai.configure(api_key=self.gemini_api_key)
+            self._gemini_configured = True
+        return genai
+
+    def gemini_model(self, model_name, generation_config=None):
+        key = (model_name, json.dumps(generation_config, sort_keys=True))
+        model = self._gemini_models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._gemini_models.get(key)
+            if model is None:
+                genai = self._genai()
+                model = genai.GenerativeModel(model_name, generation_config=generation_config)
+                self._gemini_models[key] = model
+        return model
+
+    def create_gemini_cache(self, model_name, contents, ttl_seconds):
+        """
+        Кэш контекста Gemini (context caching) с общей частью запросов; возвращает имя кэша.
+        Нужна версия модели с поддержкой кэширования (например, gemini-1.5-flash-002).
+        """
+        with self._lock:
+            genai = self._genai()
+        from google.generativeai import caching
+        model = model_name if model_name.startswith('models/') else f"models/{model_name}"
+        cache = caching.CachedContent.create(model=model, contents=contents,
+                                             ttl=datetime.timedelta(seconds=ttl_seconds))
+        return cache.name
+
+    def gemini_cached_model(self, cache_name, generation_config=None):
+        key = (cache_name, json.dumps(generation_config, sort_keys=True))
+        with self._lock:
+            model = self._cached_content_models.get(key)
+            if model is not None:
+                self._cached_content_models.move_to_end(key)
+                return model
+            genai = self._genai()
+        from google.generativeai import caching
+        model = genai.GenerativeModel.from_cached_content(
+            cached_content=caching.CachedContent.get(cache_name), generation_config=generation_config)
+        with self._lock:
+            self._cached_content_models[key] = model
+            while len(self._cached_content_models) > MAX_CACHED_CONTENT_MODELS:
+                self._cached_content_models.popitem(last=False)
+        return model
+
+    def replicate_client(self):
+        if self._replicate_client is None:
+            with self._lock:
+                if self._replicate_client is None:
+                    if not self.replicate_api_token:
+                        raise MissingCredentialsError("REPLICATE_API_TOKEN environment variable not set")
+                    import replicate
+                    self._replicate_client = replicate.Client(api_token=self.replicate_api_token)
+        return self._replicate_client
+
+    def stats(self):
+        with self._lock:
+            return {
+                'gemini_models': sorted(name for name, _ in self._gemini_models),
+                'replicate_client': self._replicate_client is not None,
+                'cached_content_models': len(self._cached_content_models),
+            }
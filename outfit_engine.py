@@ -0,0 +1,332 @@
+"""
+Локальный подбор образов из гардероба.
+
+Вместо того чтобы отправлять в LLM весь гардероб, перебираем допустимые
+комбинации (верх + низ + обувь или платье + обувь, плюс верхняя одежда)
+и оцениваем их матрицами совместимости NumPy:
+- гармония цветов (нейтральные, аналогичные, комплементарные оттенки);
+- совместимость стилей между собой;
+- соответствие стиля мероприятию;
+- (опционально) соответствие цветов тону внешности.
+
+В LLM уходят только лучшие top-K кандидатов, а в офлайн-режиме
+ранжированные образы возвращаются без вызова модели вообще.
+"""
+import numpy as np
+
+# --- Слоты ---
+
+TOP, BOTTOM, ONE_PIECE, SHOES, OUTERWEAR = 'top', 'bottom', 'one_piece', 'shoes', 'outerwear'
+
+SLOT_KEYWORDS = (
+    # Порядок важен: "t-shirt dress" - это платье, "shirt jacket" - верхняя одежда,
+    # "bootcut jeans" - низ, а не обувь
+    (ONE_PIECE, ('dress', 'jumpsuit', 'overall', 'romper', 'платье', 'комбинезон')),
+    (OUTERWEAR, ('jacket', 'coat', 'blazer', 'cardigan', 'parka', 'trench', 'vest', 'пиджак', 'куртка', 'пальто')),
+    (BOTTOM, ('pants', 'jeans', 'trousers', 'skirt', 'shorts', 'leggings', 'chinos', 'joggers', 'брюки', 'джинсы',
+              'юбка', 'шорты')),
+    (SHOES, ('shoe', 'sneaker', 'boot', 'heel', 'sandal', 'loafer', 'trainer', 'flat', 'pump', 'обувь', 'кроссовки',
+             'ботинки', 'туфли')),
+    (TOP, ('shirt', 'blouse', 'sweater', 'top', 'hoodie', 'polo', 'tank', 'tee', 'jumper', 'pullover', 'sweatshirt',
+           'turtleneck', 'рубашка', 'футболка', 'блузка', 'свитер')),
+)
+
+# --- Цвета ---
+
+COLOR_FAMILIES = ('black', 'white', 'gray', 'beige', 'brown', 'navy', 'blue', 'red', 'pink', 'orange', 'yellow',
+                  'green', 'purple')
+NEUTRAL_COLORS = ('black', 'white', 'gray', 'beige', 'navy')
+
+COLOR_SYNONYMS = {
+    'grey': 'gray', 'silver': 'gray', 'charcoal': 'gray', 'cream': 'beige', 'ivory': 'beige', 'khaki': 'beige',
+    'tan': 'beige', 'camel': 'brown', 'chocolate': 'brown', 'denim': 'blue', 'light blue': 'blue',
+    'sky': 'blue', 'teal': 'blue', 'turquoise': 'blue', 'burgundy': 'red', 'maroon': 'red', 'wine': 'red',
+    'coral': 'orange', 'rust': 'orange', 'mustard': 'yellow', 'gold': 'yellow', 'olive': 'green', 'mint': 'green',
+    'lavender': 'purple', 'violet': 'purple', 'lilac': 'purple', 'fuchsia': 'pink', 'magenta': 'pink',
+    'черный': 'black', 'белый': 'white', 'серый': 'gray', 'бежевый': 'beige', 'коричневый': 'brown',
+    'синий': 'navy', 'голубой': 'blue', 'красный': 'red', 'розовый': 'pink', 'оранжевый': 'orange',
+    'желтый': 'yellow', 'зеленый': 'green', 'фиолетовый': 'purple',
+}
+
+# Оттенок (градусы) для хроматических цветов
+COLOR_HUES = {'brown': 30, 'red': 0, 'pink': 340, 'orange': 30, 'yellow': 55, 'green': 120, 'blue': 210,
+              'purple': 280}
+WARM_COLORS = ('beige', 'brown', 'red', 'orange', 'yellow', 'green')
+COOL_COLORS = ('gray', 'navy', 'blue', 'pink', 'purple', 'white')
+
+
+def _build_color_harmony():
+    n = len(COLOR_FAMILIES)
+    harmony = np.zeros((n, n), dtype=np.float32)
+    for i, a in enumerate(COLOR_FAMILIES):
+        for j, b in enumerate(COLOR_FAMILIES):
+            if a == b:
+                harmony[i, j] = 0.75 # Монохром - аккуратно, но скучновато
+            elif a in NEUTRAL_COLORS and b in NEUTRAL_COLORS:
+                harmony[i, j] = 0.9
+            elif a in NEUTRAL_COLORS or b in NEUTRAL_COLORS:
+                harmony[i, j] = 0.85
+            else:
+                diff = abs(COLOR_HUES[a] - COLOR_HUES[b]) % 360
+                diff = min(diff, 360 - diff)
+                if diff <= 40:
+                    harmony[i, j] = 0.7 # Аналогичные
+                elif diff >= 150:
+                    harmony[i, j] = 0.65 # Комплементарные
+                elif 100 <= diff <= 140:
+                    harmony[i, j] = 0.5 # Триада
+                else:
+                    harmony[i, j] = 0.3
+    return harmony
+
+
+COLOR_HARMONY = _build_color_harmony()
+
+# --- Стили и мероприятия ---
+
+STYLES = ('casual', 'formal', 'business', 'sporty', 'elegant', 'street', 'bohemian')
+STYLE_KEYWORDS = {
+    'casual': ('casual', 'everyday', 'relaxed', 'summer', 'повседнев'),
+    'formal': ('formal', 'classic', 'evening', 'вечерн', 'классич'),
+    'business': ('business', 'office', 'smart', 'деловой', 'офис'),
+    'sporty': ('sport', 'athletic', 'active', 'gym', 'спорт'),
+    'elegant': ('elegant', 'chic', 'glamour', 'romantic', 'элегант'),
+    'street': ('street', 'urban', 'grunge', 'punk', 'улич'),
+    'bohemian': ('boho', 'bohemian', 'hippie', 'бохо'),
+}
+
+STYLE_COMPAT = np.array([
+    # casual formal business sporty elegant street bohemian
+    [1.0, 0.3, 0.5, 0.7, 0.4, 0.8, 0.7],  # casual
+    [0.3, 1.0, 0.8, 0.1, 0.9, 0.2, 0.2],  # formal
+    [0.5, 0.8, 1.0, 0.2, 0.7, 0.3, 0.3],  # business
+    [0.7, 0.1, 0.2, 1.0, 0.1, 0.7, 0.3],  # sporty
+    [0.4, 0.9, 0.7, 0.1, 1.0, 0.3, 0.5],  # elegant
+    [0.8, 0.2, 0.3, 0.7, 0.3, 1.0, 0.5],  # street
+    [0.7, 0.2, 0.3, 0.3, 0.5, 0.5, 1.0],  # bohemian
+], dtype=np.float32)
+
+EVENTS = ('casual', 'work', 'party', 'wedding', 'date', 'sport', 'interview', 'beach')
+EVENT_KEYWORDS = {
+    'work': ('work', 'office', 'business', 'meeting', 'работ', 'офис'),
+    'party': ('party', 'club', 'evening', 'вечерин', 'клуб'),
+    'wedding': ('wedding', 'gala', 'ceremony', 'formal', 'свадьб', 'торжеств'),
+    'date': ('date', 'dinner', 'restaurant', 'свидан', 'ужин', 'ресторан'),
+    'sport': ('sport', 'gym', 'run', 'hike', 'workout', 'спорт', 'трениров'),
+    'interview': ('interview', 'собеседован'),
+    'beach': ('beach', 'vacation', 'resort', 'пляж', 'отпуск'),
+}
+
+EVENT_STYLE = np.array([
+    # casual formal business sporty elegant street bohemian
+    [1.0, 0.3, 0.5, 0.7, 0.5, 0.9, 0.8],  # casual
+    [0.4, 0.8, 1.0, 0.1, 0.7, 0.2, 0.3],  # work
+    [0.5, 0.7, 0.3, 0.2, 1.0, 0.8, 0.6],  # party
+    [0.1, 1.0, 0.6, 0.0, 1.0, 0.1, 0.4],  # wedding
+    [0.6, 0.7, 0.4, 0.2, 1.0, 0.6, 0.7],  # date
+    [0.5, 0.0, 0.0, 1.0, 0.0, 0.5, 0.1],  # sport
+    [0.2, 0.9, 1.0, 0.0, 0.7, 0.1, 0.1],  # interview
+    [0.9, 0.1, 0.1, 0.6, 0.4, 0.6, 1.0],  # beach
+], dtype=np.float32)
+
+# Веса компонент итоговой оценки
+WEIGHT_EVENT = 0.45
+WEIGHT_COLOR = 0.25
+WEIGHT_STYLE = 0.2
+WEIGHT_APPEARANCE = 0.1
+
+# Предел перебора: если комбинаций больше, слоты заранее обрезаются по соответствию мероприятию
+MAX_COMBINATIONS = 200_000
+MAX_ITEMS_PER_SLOT = 40
+
+
+def _match_keywords(text, table):
+    text = (text or '').lower()
+    for key, keywords in table:
+        if any(keyword in text for keyword in keywords):
+            return key
+    return None
+
+
+def item_slot(category):
+    return _match_keywords(category, SLOT_KEYWORDS)
+
+
+def style_index(style):
+    key = _match_keywords(style, STYLE_KEYWORDS.items())
+    return STYLES.index(key or 'casual')
+
+
+def event_index(event):
+    text = (event or '').lower()
+    if text in EVENTS:
+        return EVENTS.index(text)
+    key = _match_keywords(text, EVENT_KEYWORDS.items())
+    return EVENTS.index(key or 'casual')
+
+
+def color_vector(color):
+    """Мульти-hot по COLOR_FAMILIES, нормированный на сумму 1 (без цветов - равномерный нейтральный)."""
+    vector = np.zeros(len(COLOR_FAMILIES), dtype=np.float32)
+    for raw in (color or '').split(','):
+        name = raw.strip().lower()
+        if not name:
+            continue
+        name = COLOR_SYNONYMS.get(name, name)
+        family = next((f for f in COLOR_FAMILIES if f == name or f in name.split()), None)
+        if family is None:
+            family = next((COLOR_SYNONYMS[s] for s in COLOR_SYNONYMS if s in name), None)
+        if family is not None:
+            vector[COLOR_FAMILIES.index(family)] = 1.0
+    if not vector.any():
+        for family in NEUTRAL_COLORS:
+            vector[COLOR_FAMILIES.index(family)] = 1.0
+    return vector / vector.sum()
+
+
+def appearance_color_bonus(appearance_tone):
+    """Бонус цветов для тона внешности: теплым - теплые, холодным - холодные оттенки."""
+    tone = (appearance_tone or '').lower()
+    bonus = np.full(len(COLOR_FAMILIES), 0.5, dtype=np.float32)
+    preferred = WARM_COLORS if 'warm' in tone else COOL_COLORS if 'cool' in tone else ()
+    for family in preferred:
+        bonus[COLOR_FAMILIES.index(family)] = 1.0
+    for family in NEUTRAL_COLORS:
+        bonus[COLOR_FAMILIES.index(family)] = max(bonus[COLOR_FAMILIES.index(family)], 0.8)
+    return bonus
+
+
+def _describe(item):
+    parts = [p for p in ((item.color or '').replace(',', ' '), item.category) if p and p != 'unknown']
+    return ' '.join(parts) or f"item {item.id}"
+
+
+class OutfitEngine:
+    """
+    Ранжирует образы для набора вещей. items - объекты с атрибутами id, category, color, style
+    (WardrobeItem или строки запроса).
+    """
+
+    def __init__(self, items):
+        self.items = [item for item in items if item_slot(item.category)]
+        self.slots = np.array([item_slot(item.category) for item in self.items])
+        n = len(self.items)
+        self.colors = np.stack([color_vector(item.color) for item in self.items]) if n else \
+            np.zeros((0, len(COLOR_FAMILIES)), dtype=np.float32)
+        self.styles = np.array([style_index(item.style) for item in self.items], dtype=np.int64)
+
+        # Попарные матрицы совместимости вещей (n x n) - считаются один раз
+        self.color_pair = self.colors @ COLOR_HARMONY @ self.colors.T
+        self.style_pair = STYLE_COMPAT[self.styles[:, None], self.styles[None, :]] if n else \
+            np.zeros((0, 0), dtype=np.float32)
+
+    def _slot_indices(self, slot, item_scores):
+        # Индексы слота по убыванию оценки: при обрезке перебора остаются лучшие вещи
+        indices = np.flatnonzero(self.slots == slot)
+        return indices[np.argsort(-item_scores[indices], kind='stable')[:MAX_ITEMS_PER_SLOT]]
+
+    def _score_combinations(self, groups, item_scores):
+        """
+        groups - список массивов индексов по слотам. Возвращает (combos, scores),
+        где combos - матрица (число комбинаций x число слотов).
+        """
+        grids = np.meshgrid(*groups, indexing='ij')
+        combos = np.stack([g.ravel() for g in grids], axis=1)
+        if combos.size == 0:
+            return combos, np.zeros(0, dtype=np.float32)
+
+        k = combos.shape[1]
+        item_part = item_scores[combos].mean(axis=1)
+        color_part = np.zeros(len(combos), dtype=np.float32)
+        style_part = np.zeros(len(combos), dtype=np.float32)
+        pairs = 0
+        for a in range(k):
+            for b in range(a + 1, k):
+                color_part += self.color_pair[combos[:, a], combos[:, b]]
+                style_part += self.style_pair[combos[:, a], combos[:, b]]
+                pairs += 1
+        if pairs:
+            color_part /= pairs
+            style_part /= pairs
+        # Гармония цветов нормируется на максимум матрицы, чтобы шкала была 0..1
+        scores = item_part + WEIGHT_COLOR * color_part / COLOR_HARMONY.max() + WEIGHT_STYLE * style_part
+        return combos, scores
+
+    def rank(self, event='casual', appearance_tone=None, top_k=5, max_shared_items=1, max_item_uses=2):
+        """
+        Возвращает до top_k лучших образов: список словарей с outfit_name, items, item_ids,
+        score и reason. Похожие образы (делят больше max_shared_items вещей) отбрасываются,
+        и одна вещь входит не больше чем в max_item_uses образов.
+        """
+        if not self.items:
+            return []
+
+        event_i = event_index(event)
+        event_scores = EVENT_STYLE[event_i, self.styles]
+        appearance_scores = self.colors @ appearance_color_bonus(appearance_tone)
+        item_scores = (WEIGHT_EVENT * event_scores + WEIGHT_APPEARANCE * appearance_scores).astype(np.float32)
+
+        tops, bottoms = self._slot_indices(TOP, item_scores), self._slot_indices(BOTTOM, item_scores)
+        dresses, shoes = self._slot_indices(ONE_PIECE, item_scores), self._slot_indices(SHOES, item_scores)
+        outerwear = self._slot_indices(OUTERWEAR, item_scores)
+
+        layouts = []
+        if len(tops) and len(bottoms):
+            layouts.append([tops, bottoms] + ([shoes] if len(shoes) else []))
+        if len(dresses):
+            layouts.append([dresses] + ([shoes] if len(shoes) else []))
+
+        all_combos, all_scores = [], []
+        for groups in layouts:
+            # Обрезаем самые большие слоты, пока перебор не станет приемлемым
+            while np.prod([len(g) for g in groups]) > MAX_COMBINATIONS:
+                largest = max(range(len(groups)), key=lambda i: len(groups[i]))
+                groups[largest] = groups[largest][:max(1, len(groups[largest]) // 2)]
+            combos, scores = self._score_combinations(groups, item_scores)
+            all_combos.extend(combos.tolist())
+            all_scores.append(scores)
+        if not all_combos:
+            return []
+        scores = np.concatenate(all_scores)
+
+        outfits = []
+        uses = {}
+        for index in np.argsort(-scores, kind='stable'):
+            combo = all_combos[index]
+            if any(uses.get(i, 0) >= max_item_uses for i in combo):
+                continue
+            if any(len(set(combo) & set(chosen)) > max_shared_items for chosen, _ in outfits):
+                continue
+            outfits.append((combo, float(scores[index])))
+            for i in combo:
+                uses[i] = uses.get(i, 0) + 1
+            if len(outfits) >= top_k:
+                break
+
+        return [self._to_outfit(combo, score, event_i, outerwear, item_scores) for combo, score in outfits]
+
+    def _best_outerwear(self, combo, outerwear, item_scores):
+        if not len(outerwear):
+            return None
+        fit = item_scores[outerwear] + WEIGHT_COLOR * self.color_pair[np.ix_(outerwear, combo)].mean(axis=1) \
+            + WEIGHT_STYLE * self.style_pair[np.ix_(outerwear, combo)].mean(axis=1)
+        best = int(np.argmax(fit))
+        # Верхнюю одежду добавляем, только если она не портит образ
+        return int(outerwear[best]) if self.style_pair[outerwear[best], combo].min() >= 0.5 else None
+
+    def _to_outfit(self, combo, score, event_i, outerwear, item_scores):
+        combo = list(combo)
+        extra = self._best_outerwear(combo, outerwear, item_scores)
+        if extra is not None:
+            combo.append(extra)
+        items = [self.items[i] for i in combo]
+        dominant_style = STYLES[int(np.bincount(self.styles[combo]).argmax())]
+        colors = sorted({COLOR_FAMILIES[int(np.argmax(self.colors[i]))] for i in combo})
+        return {
+            "outfit_name": f"{dominant_style.capitalize()} {EVENTS[event_i]} look",
+            "items": [_describe(item) for item in items],
+            "item_ids": [item.id for item in items],
+            "score": round(score, 3),
+            "reason": f"{dominant_style.capitalize()} pieces suited for a {EVENTS[event_i]} event; "
+                      f"the palette ({', '.join(colors)}) is harmonious.",
+        }
@@ -0,0 +1,157 @@
+"""
+Промпты и настройки моделей в одном месте.
+
+MODEL_TASKS - какая модель и с какими параметрами генерации (generation_config)
+обслуживает каждую задачу. Имена моделей можно переопределить переменными окружения.
+
+При изменении текста промпта анализа увеличьте его версию: версия входит
+в пространство имен кэша анализа, и старые результаты перестанут использоваться.
+"""
+import os
+
+# --- Анализ фото вещи ---
+GARMENT_PROMPT_VERSION = 'v1'
+GARMENT_ANALYSIS_PROMPT = (
+    "Analyze this image of clothing. Identify the type of garment (e.g., shirt, pants, dress, shoe, jacket), its primary color(s), and its general style (e.g., casual, formal, sporty, elegant). "
+    "Return the answer as a JSON object with keys: 'category', 'colors', 'style'. "
+    "Example: {'category': 'dress', 'colors': ['blue', 'white'], 'style': 'summer casual'}."
+)
+
+# --- Анализ селфи ---
+APPEARANCE_PROMPT_VERSION = 'v1'
+APPEARANCE_ANALYSIS_PROMPT = (
+    "Analyze this portrait image of a person. Identify their primary skin tone (e.g., fair, light, medium, dark), and describe their overall appearance tone (e.g., warm, cool, neutral). "
+    "Return the answer as a JSON object with keys: 'skin_tone', 'appearance_tone'. "
+    "Example: {'skin_tone': 'light', 'appearance_tone': 'cool'}."
+)
+
+# --- Чат со стилистом ---
+CHAT_PROMPT = (
+    "Как AI-стилист, проанализируй следующий запрос и дай рекомендации по стилю и одежде. "
+    "Учитывай тип телосложения: {body_type}. "
+    "Ответ должен быть кратким и информативным. "
+    "Если предоставлено изображение, используй его для анализа. "
+    "Не генерируй изображение, просто опиши подходящий образ. "
+    "Вот запрос пользователя: '{user_message}'."
+)
+
+# --- Сессии чата (chat_sessions.py) ---
+# Первая реплика сессии: роль стилиста, тип фигуры и сводка ранних реплик; дальше - история диалога
+CHAT_SESSION_PROMPT = (
+    "Как AI-стилист, веди диалог с пользователем и давай рекомендации по стилю и одежде. "
+    "Учитывай тип телосложения: {body_type}. "
+    "Ответы должны быть краткими и информативными. "
+    "Если в разговоре есть фото, используй его для анализа. "
+    "Не генерируй изображение, просто опиши подходящий образ."
+)
+CHAT_SESSION_SUMMARY_SECTION = "\nКраткое содержание предыдущей части разговора: {summary}"
+CHAT_SESSION_IMAGE_NOTE = "\nФото, которое обсуждается в разговоре:"
+CHAT_SESSION_ACK = "Понял, продолжаем разговор."
+CHAT_SUMMARY_PROMPT = (
+    "Сожми начало разговора пользователя с AI-стилистом в краткую сводку (не больше 120 слов). "
+    "Сохрани факты о пользователе (телосложение, предпочтения, упомянутые вещи и фото), "
+    "его вопросы и данные рекомендации. Ответь только текстом сводки.\n"
+    "Предыдущая сводка: {summary}\n"
+    "Реплики:\n{turns}"
+)
+
+
+def chat_session_preamble(body_type, summary=None):
+    text = CHAT_SESSION_PROMPT.format(body_type=body_type)
+    if summary:
+        text += CHAT_SESSION_SUMMARY_SECTION.format(summary=summary)
+    return text
+
+
+def chat_summary_prompt(summary, turns):
+    """turns - [(role, text)], role - 'user' или 'model'."""
+    lines = "\n".join(f"{'Пользователь' if role == 'user' else 'Стилист'}: {text}" for role, text in turns)
+    return CHAT_SUMMARY_PROMPT.format(summary=summary or "нет", turns=lines)
+
+
+# --- Подбор образов ---
+OUTFIT_CANDIDATES_SECTION = (
+    "These candidate outfits were pre-selected from their wardrobe:\n"
+    "{lines}\n"
+    "Choose the best 2-3 of these candidates and use ONLY the items listed above. "
+)
+OUTFIT_ITEMS_SECTION = (
+    "Their wardrobe contains the following items:\n"
+    "{lines}\n"
+    "Suggest 2-3 complete outfit combinations using ONLY items from this wardrobe. "
+)
+OUTFIT_PROMPT = (
+    "You are a professional fashion stylist. A user wants an outfit for a '{event}' event. "
+    "{wardrobe_section}\n"
+    "User's appearance: {skin_tone} skin tone, {appearance_tone} tone. "
+    "For each outfit, list the specific items (e.g., 'blue jeans', 'white t-shirt') and explain why it's a good choice for the event and user's appearance. "
+    "Present the outfits as a list of dictionaries, where each dictionary has 'outfit_name', 'items' (list of strings), and 'reason'."
+    "Example: "
+    "[\n"
+    "  {{\n"
+    "    \"outfit_name\": \"Classic Evening\",\n"
+    "    \"items\": [\"black dress\", \"silver heels\"],\n"
+    "    \"reason\": \"Elegant and timeless for an evening event.\"\n"
+    "  }},\n"
+    "  {{\n"
+    "    \"outfit_name\": \"Casual Day Out\",\n"
+    "    \"items\": [\"blue jeans\", \"white t-shirt\", \"sneakers\"],\n"
+    "    \"reason\": \"Comfortable and stylish for a relaxed day.\"\n"
+    "  }}\n"
+    "]"
+)
+
+
+def chat_prompt(body_type, user_message):
+    return CHAT_PROMPT.format(body_type=body_type, user_message=user_message)
+
+
+def outfit_prompt(event, appearance, candidate_lines=None, item_lines=None):
+    """candidate_lines - локально подобранные образы; если их нет, item_lines - список вещей."""
+    if candidate_lines:
+        wardrobe_section = OUTFIT_CANDIDATES_SECTION.format(lines="\n".join(candidate_lines))
+    else:
+        wardrobe_section = OUTFIT_ITEMS_SECTION.format(lines="\n".join(item_lines or []))
+    return OUTFIT_PROMPT.format(
+        event=event,
+        wardrobe_section=wardrobe_section,
+        skin_tone=appearance.get('skin_tone', 'unknown'),
+        appearance_tone=appearance.get('appearance_tone', 'unknown'),
+    )
+
+
+# --- Модели по задачам ---
+# generation_config передается в genai.GenerativeModel как есть (None - настройки модели по умолчанию)
+MODEL_TASKS = {
+    'garment_analysis': {
+        'provider': 'gemini',
+        'model': os.environ.get('GEMINI_VISION_MODEL', 'gemini-1.5-flash'),
+        'generation_config': None,
+    },
+    'appearance_analysis': {
+        'provider': 'gemini',
+        'model': os.environ.get('GEMINI_VISION_MODEL', 'gemini-1.5-flash'),
+        'generation_config': None,
+    },
+    'chat': {
+        'provider': 'gemini',
+        'model': os.environ.get('GEMINI_CHAT_MODEL', 'gemini-1.5-flash'),
+        'generation_config': None,
+    },
+    'chat_summary': {
+        'provider': 'gemini',
+        'model': os.environ.get('GEMINI_CHAT_MODEL', 'gemini-1.5-flash'),
+        'generation_config': None,
+    },
+    'outfit': {
+        'provider': 'gemini',
+        'model': os.environ.get('GEMINI_OUTFIT_MODEL', 'gemini-pro'),
+        'generation_config': None,
+    },
+    'image': {
+        'provider': 'replicate',
+        'model': os.environ.get(
+            'REPLICATE_IMAGE_MODEL',
+            "stability-ai/stable-diffusion:ac732df830a8c0147c2eed5740b2f7667232142477c8ce6d2aca4e79ae402766"),
+    },
+}
@@ -0,0 +1,129 @@
+"""
+Бюджет SQL-запросов на запрос HTTP - защита от N+1.
+
+    @bp.route(...)
+    @query_budget(2)
+    def list_wardrobe_items(user_id): ...
+
+init_app(app, engine) считает запросы каждого HTTP-запроса. Превышение бюджета
+печатается в лог вместе со списком выполненных запросов, а при
+QUERY_BUDGET_STRICT=1 (CI, локальные прогоны на SQLite/Postgres) запрос
+завершается ошибкой QueryBudgetExceeded - регрессия сразу видна как 500.
+В строгом режиме число запросов также отдается в заголовке X-Query-Count.
+
+Потоковые ответы (stream_with_context) выполняют часть запросов уже после
+after_request, пока отдается тело: для них бюджет проверяется при закрытии
+ответа, а в строгом режиме QueryBudgetExceeded выбрасывается из close().
+Тесты - tests/test_query_budget.py (все маршруты с @query_budget на SQLite).
+
+Для скриптов и тестов без Flask - count_queries(engine) / assert_max_queries(engine, n).
+Разовая работа процесса внутри запроса (например, сверка индекса при первом обращении)
+выполняется в exempt() и в бюджет маршрута не входит.
+"""
+import os
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT', '0') == '1'
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(max_queries):
+    """Декоратор view-функции: не больше max_queries SQL-запросов за запрос."""
+    def decorator(view):
+        view._query_budget = max_queries
+        return view
+    return decorator
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(' '.join(statement.split())[:200])
+
+
+@contextmanager
+def count_queries(engine):
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+@contextmanager
+def assert_max_queries(engine, max_queries):
+    with count_queries(engine) as counter:
+        yield counter
+    if counter.count > max_queries:
+        raise QueryBudgetExceeded(_describe(counter, max_queries))
+
+
+def _describe(counter, max_queries):
+    return f"{counter.count} queries, budget {max_queries}:\n" + '\n'.join(
+        f"  {number}. {statement}" for number, statement in enumerate(counter.statements, start=1))
+
+
+@contextmanager
+def exempt():
+    """Запросы внутри блока не считаются в бюджет текущего HTTP-запроса."""
+    counter = g.pop('_query_counter', None) if has_request_context() else None
+    try:
+        yield
+    finally:
+        if counter is not None:
+            g._query_counter = counter
+
+
+def _count_request_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        counter = g.get('_query_counter')
+        if counter is not None:
+            counter(conn, cursor, statement, parameters, context, executemany)
+
+
+def init_app(app, engine, strict=None):
+    strict = QUERY_BUDGET_STRICT if strict is None else strict
+    if not event.contains(engine, 'before_cursor_execute', _count_request_query):
+        event.listen(engine, 'before_cursor_execute', _count_request_query)
+
+    @app.before_request
+    def _start_query_counter():
+        g._query_counter = QueryCounter()
+
+    def check(counter, budget, label):
+        if budget is not None and counter.count > budget:
+            message = f"Query budget exceeded for {label}: {_describe(counter, budget)}"
+            print(message)
+            if strict:
+                raise QueryBudgetExceeded(message)
+
+    @app.after_request
+    def _check_query_budget(response):
+        counter = g.get('_query_counter')
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, '_query_budget', None)
+        if counter is None:
+            return response
+        label = f"{request.method} {request.path}"
+        if response.is_streamed:
+            # Генератор тела еще не выполнялся - его запросы попадут в тот же счетчик
+            # (stream_with_context сохраняет контекст запроса), проверяем после отдачи
+            response.call_on_close(lambda: check(counter, budget, label))
+            return response
+        if strict:
+            response.headers['X-Query-Count'] = str(counter.count)
+        check(counter, budget, label)
+        return response
@@ -0,0 +1,227 @@
+"""
+Кэш ответов модели для /chat и подбора образов.
+
+Ключ = пространство имен (chat / outfit) + нормализованный текст запроса
++ контекст (тип фигуры, данные внешности, хэш фото, версия гардероба).
+Версия гардероба увеличивается при каждом изменении WardrobeItem, поэтому
+после добавления вещи старые подборки образов автоматически не используются.
+
+Кроме точного совпадения можно включить поиск "почти такого же" запроса
+(RESPONSE_CACHE_SIMILARITY, например 0.9): тексты сравниваются по косинусной
+близости хэшированных символьных n-грамм - локально, без вызова модели.
+
+Хранилище подключаемое: LRU в памяти процесса, Redis (REDIS_URL) или
+FakeRedis - локальная замена Redis для тестов.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# --- Хранилища ---
+
+class MemoryBackend:
+    """LRU в памяти процесса с TTL."""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class FakeRedis:
+    """Минимальная замена клиента redis (get/set с ex/delete) для тестов и локального запуска."""
+
+    def __init__(self):
+        self._backend = MemoryBackend(max_entries=1_000_000)
+
+    def get(self, key):
+        return self._backend.get(key)
+
+    def set(self, key, value, ex=None):
+        self._backend.set(key, value.encode('utf-8') if isinstance(value, str) else value, ex)
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self._backend.delete(key)
+        return len(keys)
+
+
+class RedisBackend:
+    """Хранилище в Redis (или совместимом сервере): значения - строки JSON."""
+
+    def __init__(self, client, prefix='stylesynth:response:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def redis_client_from_env():
+    """Клиент Redis по REDIS_URL; пакет redis импортируется только если он нужен."""
+    import redis
+    return redis.Redis.from_url(os.environ['REDIS_URL'])
+
+
+# --- Нормализация и "эмбеддинги" текста ---
+
+_PUNCTUATION = re.compile(r"[^\w\s]+", re.UNICODE)
+
+
+def normalize_prompt(text):
+    text = _PUNCTUATION.sub(' ', (text or '').lower())
+    return ' '.join(text.split())
+
+
+def text_vector(text, dim=512, n=3):
+    """Хэшированные символьные n-граммы, нормированные по L2."""
+    vector = np.zeros(dim, dtype=np.float32)
+    padded = f" {text} "
+    for i in range(max(1, len(padded) - n + 1)):
+        gram = padded[i:i + n]
+        vector[int.from_bytes(hashlib.blake2b(gram.encode('utf-8'), digest_size=4).digest(), 'little') % dim] += 1
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+# --- Кэш ---
+
+class ResponseCache:
+    """
+    ttl - время жизни ответа в секундах,
+    similarity_threshold - порог близости для неточного совпадения (None - только точное),
+    max_similar_candidates - сколько последних запросов одного контекста сравнивать.
+    """
+
+    def __init__(self, backend, ttl=3600, similarity_threshold=None, max_similar_candidates=200):
+        self.backend = backend
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.max_similar_candidates = max_similar_candidates
+        self._lock = threading.Lock()
+        self._stats = {'hits_exact': 0, 'hits_similar': 0, 'misses': 0, 'sets': 0, 'errors': 0}
+
+    @classmethod
+    def from_env(cls):
+        """
+        RESPONSE_CACHE_BACKEND: memory (по умолчанию), redis, fake или off.
+        RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY (0 - только точное совпадение).
+        """
+        kind = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory').lower()
+        if kind == 'off':
+            return None
+        if kind == 'redis':
+            backend = RedisBackend(redis_client_from_env())
+        elif kind == 'fake':
+            backend = RedisBackend(FakeRedis())
+        else:
+            backend = MemoryBackend(int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 2048)))
+        similarity = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', 0))
+        return cls(
+            backend,
+            ttl=int(os.environ.get('RESPONSE_CACHE_TTL', 3600)),
+            similarity_threshold=similarity or None,
+        )
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits_exact'] + stats['hits_similar'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits_exact'] + stats['hits_similar']) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _keys(self, namespace, prompt, context):
+        scope = f"{namespace}:{_digest(context)}"
+        return scope, f"{scope}:{_digest(normalize_prompt(prompt))}"
+
+    def get(self, namespace, prompt, context):
+        """Возвращает закэшированный ответ или None."""
+        try:
+            scope, key = self._keys(namespace, prompt, context)
+            value = self.backend.get(key)
+            if value is not None:
+                self._count('hits_exact')
+                return value
+            if self.similarity_threshold:
+                value = self._get_similar(scope, normalize_prompt(prompt))
+                if value is not None:
+                    self._count('hits_similar')
+                    return value
+        except Exception as e:
+            print(f"Response cache read error: {e}")
+            self._count('errors')
+        self._count('misses')
+        return None
+
+    def _get_similar(self, scope, normalized):
+        candidates = self.backend.get(f"{scope}:recent") or []
+        if not candidates:
+            return None
+        query = text_vector(normalized)
+        matrix = np.stack([text_vector(text) for _, text in candidates])
+        scores = matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        return self.backend.get(candidates[best][0])
+
+    def set(self, namespace, prompt, context, value):
+        try:
+            scope, key = self._keys(namespace, prompt, context)
+            self.backend.set(key, value, self.ttl)
+            if self.similarity_threshold:
+                # Список последних запросов контекста - кандидаты для неточного совпадения
+                recent_key = f"{scope}:recent"
+                recent = [entry for entry in (self.backend.get(recent_key) or []) if entry[0] != key]
+                recent.append([key, normalize_prompt(prompt)])
+                self.backend.set(recent_key, recent[-self.max_similar_candidates:], self.ttl)
+            self._count('sets')
+        except Exception as e:
+            print(f"Response cache write error: {e}")
+            self._count('errors')
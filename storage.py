@@ -0,0 +1,369 @@
+"""
+Хранилище изображений вещей.
+
+Оригиналы адресуются по содержимому: ключ originals/<sha256[:2]>/<sha256>.<ext>,
+поэтому одно и то же фото, загруженное повторно (или другим пользователем),
+хранится один раз. Загрузка пишется во временный файл кусками с подсчетом
+хэша на лету - целиком в память файл не читается.
+
+Миниатюры (THUMBNAIL_SIZES, по умолчанию sm:160 и md:480 по длинной стороне)
+строятся в фоновом пуле после сохранения вещи; если миниатюра запрошена
+раньше, чем готова, она строится по запросу.
+
+Бэкенды:
+  LocalStorage  - каталог на диске (STORAGE_LOCAL_ROOT),
+  S3Storage     - S3 или совместимое хранилище (boto3 импортируется только при использовании),
+  MemoryStorage - словарь в памяти, локальная замена для тестов.
+"""
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from image_pipeline import sniff_mime_type
+
+CHUNK_SIZE = 64 * 1024
+
+EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+    'image/bmp': '.bmp',
+    'image/tiff': '.tiff',
+}
+
+
+def parse_thumbnail_sizes(value):
+    """'sm:160,md:480' -> {'sm': 160, 'md': 480}"""
+    sizes = {}
+    for part in value.split(','):
+        if ':' in part:
+            name, edge = part.split(':', 1)
+            sizes[name.strip()] = int(edge)
+    return sizes
+
+
+THUMBNAIL_SIZES = parse_thumbnail_sizes(os.environ.get('THUMBNAIL_SIZES', 'sm:160,md:480'))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+
+
+# --- Бэкенды ---
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def local_path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def put_file(self, key, path):
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Копия рядом с целью и атомарная подмена - параллельный читатель не увидит половину файла
+        tmp_target = f"{target}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, tmp_target)
+        os.replace(tmp_target, target)
+
+    def put_bytes(self, key, data):
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_target = f"{target}.{threading.get_ident()}.tmp"
+        with open(tmp_target, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_target, target)
+
+    def read(self, key):
+        with open(self.local_path(key), 'rb') as f:
+            return f.read()
+
+    def iter_range(self, key, start, stop):
+        """Байты [start, stop) кусками по CHUNK_SIZE."""
+        with open(self.local_path(key), 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+
+class MemoryStorage:
+    """Хранилище в памяти процесса - для тестов и локального запуска."""
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def exists(self, key):
+        return key in self._objects
+
+    def size(self, key):
+        return len(self._objects[key])
+
+    def put_file(self, key, path):
+        with open(path, 'rb') as f:
+            self.put_bytes(key, f.read())
+
+    def put_bytes(self, key, data):
+        with self._lock:
+            self._objects[key] = bytes(data)
+
+    def read(self, key):
+        return self._objects[key]
+
+    def iter_range(self, key, start, stop):
+        data = self._objects[key]
+        for offset in range(start, stop, CHUNK_SIZE):
+            yield data[offset:min(offset + CHUNK_SIZE, stop)]
+
+    def delete(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+
+class S3Storage:
+    """
+    S3 или совместимое хранилище (MinIO, R2 и т.д. - через endpoint_url).
+    Большие файлы upload_file отправляет multipart-загрузкой прямо с диска.
+    """
+
+    def __init__(self, bucket, prefix='', client=None, endpoint_url=None):
+        if client is None:
+            import boto3
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(key))['ContentLength']
+
+    def _extra_args(self, key):
+        mime_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        return {'ContentType': mime_type, 'CacheControl': 'public, max-age=31536000, immutable'}
+
+    def put_file(self, key, path):
+        self.client.upload_file(path, self.bucket, self._key(key), ExtraArgs=self._extra_args(key))
+
+    def put_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data, **self._extra_args(key))
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body'].read()
+
+    def iter_range(self, key, start, stop):
+        if stop <= start:
+            return
+        body = self.client.get_object(Bucket=self.bucket, Key=self._key(key),
+                                      Range=f"bytes={start}-{stop - 1}")['Body']
+        try:
+            yield from body.iter_chunks(CHUNK_SIZE)
+        finally:
+            body.close()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def storage_from_env():
+    """STORAGE_BACKEND: local (по умолчанию), s3 или memory."""
+    kind = os.environ.get('STORAGE_BACKEND', 'local').lower()
+    if kind == 's3':
+        return S3Storage(os.environ['S3_BUCKET'], prefix=os.environ.get('S3_PREFIX', ''),
+                         endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None)
+    if kind == 'memory':
+        return MemoryStorage()
+    return LocalStorage(os.environ.get('STORAGE_LOCAL_ROOT', 'media'))
+
+
+# --- Изображения ---
+
+class Upload:
+    """Загруженный файл: ключ в хранилище, хэш, размер. read() читает локальную копию."""
+
+    def __init__(self, key, sha256, size, mime_type, deduplicated, path):
+        self.key = key
+        self.sha256 = sha256
+        self.size = size
+        self.mime_type = mime_type
+        self.deduplicated = deduplicated # Такой файл уже был в хранилище
+        self.path = path
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def open(self):
+        return open(self.path, 'rb')
+
+
+def original_key(sha256, mime_type):
+    return f"originals/{sha256[:2]}/{sha256}{EXTENSIONS.get(mime_type, '')}"
+
+
+def chat_image_key(sha256, mime_type):
+    """Нормализованное фото из сессии чата (chat_sessions.py); через /media не отдается."""
+    return f"chat/{sha256[:2]}/{sha256}{EXTENSIONS.get(mime_type, '')}"
+
+
+def thumbnail_key(sha256, size_name):
+    return f"thumbs/{size_name}/{sha256[:2]}/{sha256}.jpg"
+
+
+def sha256_from_key(key):
+    return os.path.splitext(os.path.basename(key))[0]
+
+
+class ImageStore:
+    def __init__(self, backend, thumbnail_sizes=None, thumbnail_workers=2, tmp_dir=None):
+        self.backend = backend
+        self.thumbnail_sizes = thumbnail_sizes or THUMBNAIL_SIZES
+        self.tmp_dir = tmp_dir
+        self._executor = ThreadPoolExecutor(max_workers=thumbnail_workers, thread_name_prefix='thumbnails')
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(storage_from_env(), thumbnail_workers=int(os.environ.get('THUMBNAIL_WORKERS', 2)))
+
+    @contextmanager
+    def ingest(self, stream, store=True):
+        """
+        Сохраняет загрузку в хранилище. Внутри блока доступна локальная копия (Upload.read/open),
+        после выхода временный файл удаляется. Файл, который не является изображением, - ValueError.
+        store=False - в хранилище ничего не пишется, пока внутри блока не вызван save(upload).
+        """
+        digest = hashlib.sha256()
+        size = 0
+        head = b''
+        fd, path = tempfile.mkstemp(prefix='upload-', dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if len(head) < CHUNK_SIZE:
+                        head += chunk[:CHUNK_SIZE - len(head)]
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+
+            mime_type = sniff_mime_type(head)
+            if mime_type is None:
+                # Заголовка может не хватить (например, TIFF со смещенными данными) - проверяем файл целиком
+                with open(path, 'rb') as f:
+                    mime_type = sniff_mime_type(f.read())
+            if mime_type is None:
+                raise ValueError("Uploaded file is not a supported image")
+
+            sha256 = digest.hexdigest()
+            key = original_key(sha256, mime_type)
+            upload = Upload(key, sha256, size, mime_type, False, path)
+            if store:
+                self.save(upload)
+            yield upload
+        finally:
+            os.remove(path)
+
+    def save(self, upload):
+        """Пишет оригинал в хранилище, если его там еще нет. True - объект записан этим вызовом."""
+        upload.deduplicated = self.backend.exists(upload.key)
+        if upload.deduplicated:
+            return False
+        self.backend.put_file(upload.key, upload.path)
+        return True
+
+    def thumbnail_keys(self, key):
+        sha256 = sha256_from_key(key)
+        return {name: thumbnail_key(sha256, name) for name in self.thumbnail_sizes}
+
+    def make_thumbnails(self, key, source=None):
+        """Строит недостающие миниатюры оригинала key. source - байты оригинала, если они уже есть."""
+        missing = {name: thumb_key for name, thumb_key in self.thumbnail_keys(key).items()
+                   if not self.backend.exists(thumb_key)}
+        if not missing:
+            return
+        image = Image.open(BytesIO(source if source is not None else self.backend.read(key)))
+        largest = max(self.thumbnail_sizes[name] for name in missing)
+        image.draft('RGB', (largest, largest)) # JPEG сразу декодируется уменьшенным
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        # От большей миниатюры к меньшей: каждая следующая уменьшается из предыдущей
+        for name in sorted(missing, key=lambda name: -self.thumbnail_sizes[name]):
+            edge = self.thumbnail_sizes[name]
+            image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            output = BytesIO()
+            image.save(output, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+            self.backend.put_bytes(missing[name], output.getvalue())
+
+    def schedule_thumbnails(self, keys):
+        """Ставит построение миниатюр в фоновый пул (повторные ключи не дублируются)."""
+        for key in keys:
+            with self._pending_lock:
+                if key in self._pending:
+                    continue
+                self._pending.add(key)
+            self._executor.submit(self._thumbnail_task, key)
+
+    def _thumbnail_task(self, key):
+        try:
+            self.make_thumbnails(key)
+        except Exception as e:
+            print(f"Error generating thumbnails for {key}: {e}")
+        finally:
+            with self._pending_lock:
+                self._pending.discard(key)
+
+    def ensure_thumbnail(self, thumb_key):
+        """Миниатюра, запрошенная раньше фоновой задачи, строится сразу. Возвращает False, если оригинала нет."""
+        if self.backend.exists(thumb_key):
+            return True
+        parts = thumb_key.split('/')
+        if len(parts) != 4 or parts[0] != 'thumbs' or parts[1] not in self.thumbnail_sizes:
+            return False
+        sha256 = sha256_from_key(thumb_key)
+        for extension in set(EXTENSIONS.values()):
+            key = f"originals/{sha256[:2]}/{sha256}{extension}"
+            if self.backend.exists(key):
+                self.make_thumbnails(key)
+                return True
+        return False
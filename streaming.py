@@ -0,0 +1,41 @@
+"""
+Помощники для потоковых ответов: Server-Sent Events и JSON-строки (NDJSON).
+Инкрементальный разбор JSON-массива из потока модели - structured_output.JSONArrayStreamParser.
+"""
+import json
+
+
+def sse_event(data, event=None):
+    """Одно событие SSE. data сериализуется в JSON."""
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def ndjson_line(data, event=None):
+    if event:
+        data = {"event": event, **data}
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+
+def stream_format(request, data):
+    """
+    Определяет формат потока по запросу: 'sse' (Accept: text/event-stream или "stream": "sse"),
+    'ndjson' ("stream": "ndjson" или true) или None - обычный JSON-ответ.
+    """
+    mode = data.get('stream') or request.args.get('stream')
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return 'sse'
+    if mode in ('sse', 'ndjson'):
+        return mode
+    if mode in (True, '1', 'true'):
+        return 'ndjson'
+    return None
+
+
+def stream_headers(fmt):
+    mimetype = 'text/event-stream' if fmt == 'sse' else 'application/x-ndjson'
+    # X-Accel-Buffering: no - чтобы nginx/прокси не копили ответ целиком
+    return mimetype, {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
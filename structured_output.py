@@ -0,0 +1,418 @@
+"""
+Разбор структурированных (JSON) ответов моделей.
+
+Порядок действий для одного ответа (generate_structured):
+1. Запрос к модели - с JSON-режимом (response_mime_type + response_schema),
+   если модель его поддерживает (STRUCTURED_OUTPUT_JSON_MODE=1, по умолчанию).
+2. Строгий json.loads.
+3. Терпимое извлечение: обертка ```json ... ```, текст до и после JSON,
+   висячие запятые, словари в одинарных кавычках (как в примерах наших промптов),
+   True/False/None вместо true/false/null.
+4. Проверка по схеме задачи с мягким приведением типов (строка вместо списка -> [строка]).
+5. Только если ничего не помогло - повторный запрос с промптом исправления
+   (без изображения, только текст ответа; STRUCTURED_OUTPUT_REPAIR=0 отключает).
+
+Счетчики исходов по задачам (strict, tolerant, repaired, failed) - get_stats().
+
+JSONArrayStreamParser - инкрементальный разбор JSON-массива из потока кусков текста.
+"""
+import ast
+import json
+import os
+import re
+import threading
+
+STRUCTURED_OUTPUT_JSON_MODE = os.environ.get('STRUCTURED_OUTPUT_JSON_MODE', '1') == '1'
+STRUCTURED_OUTPUT_REPAIR = os.environ.get('STRUCTURED_OUTPUT_REPAIR', '1') == '1'
+# ast.literal_eval на больших строках медленный - терпимый разбор только для ответов разумного размера
+MAX_TOLERANT_CHARS = 200_000
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+# --- Схемы (подмножество OpenAPI-схем, которое понимает Gemini) ---
+
+GARMENT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'category': {'type': 'string'},
+        'colors': {'type': 'array', 'items': {'type': 'string'}},
+        'style': {'type': 'string'},
+    },
+    'required': ['category', 'colors', 'style'],
+}
+
+APPEARANCE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'skin_tone': {'type': 'string'},
+        'appearance_tone': {'type': 'string'},
+    },
+    'required': ['skin_tone', 'appearance_tone'],
+}
+
+OUTFIT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'outfit_name': {'type': 'string'},
+        'items': {'type': 'array', 'items': {'type': 'string'}},
+        'reason': {'type': 'string'},
+    },
+    'required': ['outfit_name', 'items'],
+}
+
+OUTFITS_SCHEMA = {'type': 'array', 'items': OUTFIT_SCHEMA}
+
+
+def validate(value, schema, path='$'):
+    """Проверяет значение по схеме и возвращает его с мягким приведением типов."""
+    expected = schema.get('type')
+    if expected == 'object':
+        if not isinstance(value, dict):
+            raise StructuredOutputError(f"{path}: expected object, got {type(value).__name__}")
+        missing = [key for key in schema.get('required', []) if value.get(key) in (None, '')]
+        if missing:
+            raise StructuredOutputError(f"{path}: missing {', '.join(missing)}")
+        result = dict(value)
+        for key, subschema in schema.get('properties', {}).items():
+            if key in result and result[key] is not None:
+                result[key] = validate(result[key], subschema, f"{path}.{key}")
+        return result
+    if expected == 'array':
+        if not isinstance(value, list):
+            value = [value] # Один объект/строка вместо списка
+        items = schema.get('items')
+        return [validate(item, items, f"{path}[{i}]") for i, item in enumerate(value)] if items else value
+    if expected == 'string':
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise StructuredOutputError(f"{path}: expected string, got {type(value).__name__}")
+        return str(value)
+    return value
+
+
+def _gemini_schema(schema):
+    # В protos.Schema тип - перечисление (OBJECT, ARRAY, STRING)
+    converted = {}
+    for key, value in schema.items():
+        if key == 'type':
+            converted[key] = value.upper()
+        elif key == 'properties':
+            converted[key] = {name: _gemini_schema(sub) for name, sub in value.items()}
+        elif key == 'items':
+            converted[key] = _gemini_schema(value)
+        else:
+            converted[key] = value
+    return converted
+
+
+def supports_json_mode(model_name):
+    """JSON-режим и response_schema есть у Gemini 1.5 и новее, у gemini-pro (1.0) - нет."""
+    name = model_name.split('/')[-1]
+    return name.startswith('gemini-') and not (name == 'gemini-pro' or name.startswith('gemini-1.0'))
+
+
+def json_generation_config(model_name, schema, base=None):
+    config = dict(base or {})
+    if STRUCTURED_OUTPUT_JSON_MODE and supports_json_mode(model_name):
+        config['response_mime_type'] = 'application/json'
+        if schema is not None:
+            config['response_schema'] = _gemini_schema(schema)
+    return config or None
+
+
+# --- Терпимое извлечение JSON ---
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.S)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_JSON_LITERALS = {'true': 'True', 'false': 'False', 'null': 'None'}
+
+
+def _balanced_span(text, start):
+    """Конец JSON-значения, начинающегося с text[start] ('{' или '['), с учетом строк в любых кавычках."""
+    depth = 0
+    quote = None
+    escape = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if quote:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def _pythonize(fragment):
+    """true/false/null вне строк -> True/False/None, чтобы разобрать фрагмент ast.literal_eval."""
+    out = []
+    quote = None
+    escape = False
+    i = 0
+    while i < len(fragment):
+        char = fragment[i]
+        if quote:
+            out.append(char)
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == quote:
+                quote = None
+            i += 1
+            continue
+        if char in '"\'':
+            quote = char
+        elif char.isalpha():
+            match = re.match(r"[A-Za-z_]+", fragment[i:])
+            word = match.group(0)
+            out.append(_JSON_LITERALS.get(word, word))
+            i += len(word)
+            continue
+        out.append(char)
+        i += 1
+    return ''.join(out)
+
+
+def loads_tolerant(fragment):
+    """json.loads, а при ошибке - исправление висячих запятых и разбор как литерала Python."""
+    try:
+        return json.loads(fragment)
+    except ValueError:
+        pass
+    without_commas = _TRAILING_COMMA.sub(r"\1", fragment)
+    try:
+        return json.loads(without_commas)
+    except ValueError:
+        pass
+    if len(fragment) > MAX_TOLERANT_CHARS:
+        raise StructuredOutputError("Response is too large for tolerant parsing")
+    try:
+        value = ast.literal_eval(_pythonize(without_commas))
+    except (ValueError, SyntaxError, MemoryError, RecursionError) as e:
+        raise StructuredOutputError(f"Not valid JSON: {e}")
+    if not isinstance(value, (dict, list)):
+        raise StructuredOutputError("Response is not a JSON object or array")
+    return json.loads(json.dumps(value)) # Кортежи -> списки, только JSON-совместимые типы
+
+
+def extract_json(text):
+    """Находит и разбирает первое JSON-значение (объект или массив) в ответе модели."""
+    if not text:
+        raise StructuredOutputError("Empty response")
+    candidates = [block for block in _FENCE.findall(text)] + [text]
+    for candidate in candidates:
+        candidate = candidate.strip()
+        for match in re.finditer(r"[\[{]", candidate):
+            end = _balanced_span(candidate, match.start())
+            if end is None:
+                continue
+            try:
+                return loads_tolerant(candidate[match.start():end])
+            except StructuredOutputError:
+                continue
+    raise StructuredOutputError("No JSON value found in response")
+
+
+def parse(text, schema=None):
+    """Возвращает (value, outcome): outcome - 'strict' (json.loads справился сам) или 'tolerant'."""
+    try:
+        value, outcome = json.loads(text), 'strict'
+    except (TypeError, ValueError):
+        value, outcome = extract_json(text), 'tolerant'
+    if schema is not None:
+        value = validate(value, schema)
+    return value, outcome
+
+
+# --- Статистика ---
+
+OUTCOMES = ('strict', 'tolerant', 'repaired', 'failed')
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def record(self, task, outcome):
+        with self._lock:
+            counts = self._counts.setdefault(task, dict.fromkeys(OUTCOMES, 0))
+            counts[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for task, counts in self._counts.items():
+                total = sum(counts.values())
+                result[task] = dict(counts, failure_rate=round(counts['failed'] / total, 4) if total else 0.0)
+            return result
+
+
+_stats = _Stats()
+
+
+def record_outcome(task, outcome):
+    _stats.record(task, outcome)
+
+
+def get_stats():
+    return _stats.snapshot()
+
+
+# --- Запрос к модели ---
+
+REPAIR_PROMPT = (
+    "The text below was supposed to be valid JSON matching this JSON schema:\n{schema}\n"
+    "Rewrite it as valid JSON that matches the schema. Use double quotes. "
+    "Return only the JSON, without markdown and without any explanations.\n\n"
+    "Text:\n{text}"
+)
+
+
+class StructuredResult:
+    def __init__(self, value, text, outcome, error=None):
+        self.value = value # None, если разобрать не удалось
+        self.text = text # Исходный текст ответа модели
+        self.outcome = outcome
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.value is not None
+
+
+def generate_structured(gateway, task, contents, schema, repair=None):
+    """
+    Запрос к модели задачи (prompts.MODEL_TASKS) с разбором ответа по схеме.
+    Ошибки самого вызова модели пробрасываются; ошибка разбора - StructuredResult с value=None.
+    """
+    spec = gateway.registry.spec(task)
+    config = json_generation_config(spec['model'], schema, spec.get('generation_config'))
+    text = gateway.generate_task(task, contents, generation_config=config)
+    try:
+        value, outcome = parse(text, schema)
+        record_outcome(task, outcome)
+        return StructuredResult(value, text, outcome)
+    except StructuredOutputError as e:
+        error = e
+
+    if repair is None:
+        repair = STRUCTURED_OUTPUT_REPAIR
+    if repair:
+        try:
+            repaired_text = gateway.generate_task(task, REPAIR_PROMPT.format(
+                schema=json.dumps(schema), text=text), generation_config=config)
+            value, _ = parse(repaired_text, schema)
+            record_outcome(task, 'repaired')
+            return StructuredResult(value, text, 'repaired')
+        except Exception as e:
+            print(f"Structured output repair for {task} failed: {e}")
+    record_outcome(task, 'failed')
+    return StructuredResult(None, text, 'failed', str(error))
+
+
+# --- Потоковый разбор ---
+
+class JSONArrayStreamParser:
+    """
+    Разбирает JSON-массив объектов, приходящий кусками, и отдает каждый объект,
+    как только закрылась его последняя скобка. Обертка ```json ... ``` и текст
+    до '[' пропускаются; объекты разбираются терпимо (loads_tolerant), а если
+    задана schema - проверяются по ней, и объекты, которые не прошли, пропускаются.
+
+        parser = JSONArrayStreamParser(OUTFIT_SCHEMA)
+        for chunk in chunks:
+            for obj in parser.feed(chunk):
+                ...
+    """
+
+    def __init__(self, schema=None):
+        self.schema = schema
+        self._started = False # Встретили '[' верхнего уровня
+        self._finished = False
+        self._depth = 0 # Глубина вложенности внутри массива
+        self._quote = None # Кавычка открытой строки
+        self._escape = False
+        self._buffer = [] # Символы текущего объекта
+        self.text = [] # Весь полученный текст (для обработки ошибок)
+        self.tolerant = 0 # Объекты, для которых понадобился терпимый разбор
+        self.dropped = 0 # Битые или не прошедшие проверку объекты
+
+    @property
+    def full_text(self):
+        return ''.join(self.text)
+
+    def _load(self, fragment):
+        try:
+            value = json.loads(fragment)
+        except ValueError:
+            try:
+                value = loads_tolerant(fragment)
+                self.tolerant += 1
+            except StructuredOutputError:
+                self.dropped += 1
+                return None
+        if self.schema is not None:
+            try:
+                value = validate(value, self.schema)
+            except StructuredOutputError:
+                self.dropped += 1
+                return None
+        return value
+
+    def feed(self, chunk):
+        self.text.append(chunk)
+        objects = []
+        for char in chunk:
+            if self._finished:
+                break
+            if not self._started:
+                if char == '[':
+                    self._started = True
+                continue
+
+            if self._depth == 0:
+                # Между элементами массива: ждем начала объекта или конца массива
+                if char == '{':
+                    self._depth = 1
+                    self._buffer = [char]
+                elif char == ']':
+                    self._finished = True
+                continue
+
+            self._buffer.append(char)
+            if self._quote:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == self._quote:
+                    self._quote = None
+            elif char in '"\'':
+                self._quote = char
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    value = self._load(''.join(self._buffer))
+                    if value is not None:
+                        objects.append(value)
+                    self._buffer = []
+        return objects
+
+    @property
+    def finished(self):
+        return self._finished
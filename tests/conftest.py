@@ -0,0 +1,76 @@
+"""
+Общие фикстуры: приложение на временной SQLite с заглушками моделей.
+
+Переменные окружения задаются до импорта app - модуль читает конфигурацию при импорте.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+_WORKDIR = tempfile.mkdtemp(prefix='stylesynth-tests-')
+os.environ.update({
+    'MODEL_PROVIDER': 'stub',
+    'DATABASE_URL': f"sqlite:///{os.path.join(_WORKDIR, 'test.db')}",
+    'STORAGE_BACKEND': 'local',
+    'STORAGE_LOCAL_ROOT': os.path.join(_WORKDIR, 'media'),
+    'EMBEDDING_BACKEND': 'histogram',
+    'EMBEDDING_INDEX_PATH': os.path.join(_WORKDIR, 'embeddings', 'index'),
+    'ANALYSIS_CACHE_PATH': '',
+    'RESPONSE_CACHE_BACKEND': 'off',
+    'ADMISSION_BACKEND': 'off',
+    'GARMENT_CLASSIFIER_ENABLED': '0',
+    'QUERY_BUDGET_STRICT': '1',
+    'DB_AUTO_MIGRATE': '1', # Схема создается при create_app
+})
+os.makedirs(os.path.join(_WORKDIR, 'embeddings'), exist_ok=True)
+
+WARDROBE_SIZE = 50 # Достаточно, чтобы N+1 заметно превысил любой бюджет
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app as app_module
+    return app_module
+
+
+@pytest.fixture(scope='session')
+def app(app_module):
+    return app_module.create_app({'TESTING': True})
+
+
+@pytest.fixture(scope='session')
+def seeded(app, app_module):
+    """Пользователь с гардеробом, профилем внешности и сессией чата с несколькими репликами."""
+    from bench.synthetic import wardrobe_rows
+
+    A = app_module
+    with app.app_context():
+        user = A.User(username='budget', email='budget@example.com')
+        A.db.session.add(user)
+        A.db.session.flush()
+        items = [A.WardrobeItem(**row) for row in
+                 wardrobe_rows(user.id, WARDROBE_SIZE, embedding_dim=A.image_embedder.dim)]
+        A.db.session.add_all(items)
+        A.db.session.flush()
+        A.index_item_attributes(items)
+        A.db.session.add(A.AppearanceProfile(user_id=user.id, skin_tone='light', appearance_tone='warm',
+                                             prompt_version='test'))
+        session = A.ChatSession(id='budget' + '0' * 26, user_id=user.id, body_type='стандартный')
+        A.db.session.add(session)
+        for number in range(6):
+            A.db.session.add(A.ChatMessage(session_id=session.id, role='user' if number % 2 == 0 else 'model',
+                                           text=f"message {number}", tokens=3))
+        A.db.session.commit()
+        return {'user_id': user.id, 'item_id': items[0].id, 'deletable_item_id': items[-1].id,
+                'session_id': session.id}
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
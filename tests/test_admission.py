@@ -0,0 +1,86 @@
+"""Контроль допуска (admission.py): память MemoryBackend и слоты провайдеров на вызов."""
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, MemoryBackend, Rejected
+
+
+def test_memory_backend_prunes_full_buckets_and_empty_lease_sets(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    backend = MemoryBackend(sweep_interval=10)
+
+    for client in range(100):
+        assert backend.take(f"chat:ip:10.0.0.{client}", capacity=2, rate=1.0) == (True, 0.0)
+    lease = backend.acquire('provider:gemini', 1, ttl=5)
+    backend.acquire('provider:replicate', 1, ttl=5) # Воркер "упал" и не вернул слот
+    assert backend.size() == (100, 2)
+
+    backend.release('provider:gemini', lease)
+    assert backend.size() == (100, 1)
+
+    clock[0] += 11 # Корзины пополнились, слот replicate истек
+    backend.take('chat:ip:10.0.0.200', capacity=2, rate=1.0)
+    assert backend.size() == (1, 0)
+
+
+def test_memory_backend_keeps_partially_spent_buckets(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    backend = MemoryBackend(sweep_interval=1)
+
+    for _ in range(3):
+        backend.take('batch:user:1', capacity=3, rate=0.01)
+    clock[0] += 2
+    backend.take('batch:user:2', capacity=3, rate=0.01)
+
+    # Пустая корзина пользователя 1 не сброшена очисткой - лимит продолжает действовать
+    allowed, retry_after = backend.take('batch:user:1', capacity=3, rate=0.01)
+    assert not allowed and retry_after > 0
+
+
+def test_memory_backend_evicts_least_recently_used_buckets():
+    backend = MemoryBackend(max_keys=3)
+    for client in ('a', 'b', 'c'):
+        backend.take(client, capacity=5, rate=0.1)
+    backend.take('a', capacity=5, rate=0.1)
+    backend.take('d', capacity=5, rate=0.1)
+
+    assert list(backend._buckets) == ['c', 'a', 'd']
+
+
+def test_provider_slot_is_held_per_call_and_waits_for_a_free_one():
+    controller = AdmissionController(MemoryBackend(), provider_caps={'gemini': 2}, lease_ttl=60)
+    inside = []
+    peak = [0]
+    lock = threading.Lock()
+
+    def call():
+        with controller.provider_slot('gemini', wait=5):
+            with lock:
+                inside.append(1)
+                peak[0] = max(peak[0], len(inside))
+            time.sleep(0.05)
+            with lock:
+                inside.pop()
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 2
+    assert controller.backend.in_use('provider:gemini') == 0
+
+
+def test_provider_slot_rejects_after_wait():
+    controller = AdmissionController(MemoryBackend(), provider_caps={'gemini': 1}, lease_ttl=60)
+    with controller.provider_slot('gemini'):
+        with pytest.raises(Rejected) as rejected:
+            with controller.provider_slot('gemini', wait=0.1):
+                pass
+    assert rejected.value.status == 429
+    assert controller.backend.in_use('provider:gemini') == 0
@@ -0,0 +1,70 @@
+"""Кэш анализа (analysis_cache.py): почти-дубликаты по dHash с учетом цвета и поиском по индексу."""
+import io
+
+from PIL import Image, ImageDraw
+
+from analysis_cache import AnalysisCache, hamming_distance, image_dhash
+
+
+def _garment(color):
+    image = Image.new('RGB', (400, 500), (240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([80, 60, 320, 440], fill=color)
+    draw.rectangle([80, 60, 320, 140], fill=tuple(channel // 2 for channel in color))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def _recompressed(image_bytes, size=(360, 450), quality=60):
+    buffer = io.BytesIO()
+    Image.open(io.BytesIO(image_bytes)).resize(size, Image.Resampling.LANCZOS).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def _cache(tmp_path, **kwargs):
+    return AnalysisCache(str(tmp_path / 'cache.sqlite3'), phash_distance=kwargs.pop('phash_distance', 3), **kwargs)
+
+
+def test_recompressed_copy_is_a_near_duplicate(tmp_path):
+    cache = _cache(tmp_path)
+    original = _garment((200, 30, 30))
+    cache.set('garment:v1', original, '{"colors": ["red"]}')
+
+    assert cache.get('garment:v1', _recompressed(original)) == '{"colors": ["red"]}'
+    assert cache.get('garment:v2', _recompressed(original)) is None
+
+
+def test_same_garment_in_another_color_is_not_a_near_duplicate(tmp_path):
+    cache = _cache(tmp_path)
+    red, blue = _garment((200, 30, 30)), _garment((30, 30, 200))
+    assert hamming_distance(image_dhash(red), image_dhash(blue)) <= 1 # По яркости снимки почти неотличимы
+
+    cache.set('garment:v1', red, '{"colors": ["red"]}')
+
+    assert cache.get('garment:v1', blue) is None
+
+
+def test_near_duplicate_lookup_uses_indexes(tmp_path):
+    cache = _cache(tmp_path)
+    conn = cache._connect()
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + cache._near_duplicate_query(),
+                        ('garment:v1', '000', 1, 2, 3, 4, 64)).fetchall()
+
+    details = [row[-1] for row in plan]
+    assert not any(detail.startswith('SCAN') for detail in details), details
+
+
+def test_old_cache_file_is_upgraded(tmp_path):
+    import sqlite3
+
+    conn = sqlite3.connect(str(tmp_path / 'cache.sqlite3'))
+    conn.execute('CREATE TABLE analysis_cache (namespace TEXT NOT NULL, sha256 TEXT NOT NULL, phash TEXT,'
+                 ' result TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL,'
+                 ' PRIMARY KEY (namespace, sha256))')
+    conn.close()
+
+    cache = _cache(tmp_path)
+    image = _garment((30, 120, 40))
+    cache.set('garment:v1', image, '{}')
+    assert cache.get('garment:v1', image) == '{}'
@@ -0,0 +1,68 @@
+"""Сессии чата: окно истории и сводка ранних реплик."""
+from chat_sessions import message_tokens
+
+
+def _session_with_messages(A, session_id, count, text):
+    session = A.ChatSession(id=session_id, body_type='стандартный')
+    A.db.session.add(session)
+    messages = [A.ChatMessage(session_id=session_id, role='user' if number % 2 == 0 else 'model',
+                              text=text, tokens=message_tokens(text)) for number in range(count)]
+    A.db.session.add_all(messages)
+    A.db.session.commit()
+    return [message.id for message in messages]
+
+
+def test_summary_starts_from_summarized_through_when_history_is_capped(app, app_module, client, monkeypatch):
+    A = app_module
+    monkeypatch.setattr(A, 'CHAT_SESSION_MAX_MESSAGES', 20)
+    with app.app_context():
+        # 120 реплик по ~100 токенов: прочитаны только последние 20, они целиком помещаются в окно
+        ids = _session_with_messages(A, 'capped' + '0' * 26, 120, 'x' * 400)
+
+    response = client.post(f"/chat/sessions/{'capped' + '0' * 26}/messages", json={'message': 'Hello'})
+    assert response.status_code == 200
+    assert response.json['context']['summarized']
+
+    with app.app_context():
+        session = A.db.session.get(A.ChatSession, 'capped' + '0' * 26)
+        # Сводка - самых старых реплик подряд, а не всего, что старше прочитанного окна
+        assert session.summarized_through == ids[19]
+
+    client.post(f"/chat/sessions/{'capped' + '0' * 26}/messages", json={'message': 'Again'})
+    with app.app_context():
+        assert A.db.session.get(A.ChatSession, 'capped' + '0' * 26).summarized_through == ids[39]
+
+
+def test_stable_history_prefix_is_cached_and_reused(app, app_module, client, monkeypatch):
+    import chat_sessions
+
+    A = app_module
+    created = []
+    monkeypatch.setattr(chat_sessions, 'CHAT_CONTEXT_CACHE_MIN_TOKENS', 250)
+    monkeypatch.setattr(A, 'CHAT_CONTEXT_CACHE_ENABLED', True)
+    monkeypatch.setattr(A.model_gateway, 'create_context_cache',
+                        lambda task, contents, ttl: created.append(contents) or f"cachedContents/{len(created)}")
+    session_id = 'cached' + '0' * 26
+    with app.app_context():
+        ids = _session_with_messages(A, session_id, 6, 'y' * 400)
+
+    first = client.post(f"/chat/sessions/{session_id}/messages", json={'message': 'Hello'}).json['context']
+    # Вступление и 6 реплик (~600 токенов) - в кэш, в запросе только текущая реплика
+    assert first['context_cache'] and first['window_messages'] == 6
+    assert len(created) == 1 and len(created[0]) == 2 + 6
+    with app.app_context():
+        assert A.db.session.get(A.ChatSession, session_id).context_cache_through == ids[-1]
+
+    second = client.post(f"/chat/sessions/{session_id}/messages", json={'message': 'And shoes?'}).json['context']
+    # Кэш переиспользован: в окне только пара реплик после закэшированных
+    assert second['context_cache'] and second['window_messages'] == 2
+    assert second['cached_tokens'] == first['cached_tokens']
+    assert len(created) == 1
+
+
+def test_context_cache_is_skipped_when_model_minimum_is_unreachable(monkeypatch):
+    import chat_sessions
+
+    assert chat_sessions.context_cache_min_tokens('gemini-1.5-flash') == 32768
+    assert not chat_sessions.context_cache_reachable('gemini-1.5-flash')
+    assert chat_sessions.context_cache_reachable('models/gemini-2.5-flash')
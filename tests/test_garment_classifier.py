@@ -0,0 +1,138 @@
+"""Локальный классификатор вещей (garment_classifier.py) и его проверка на размеченных фото."""
+import csv
+import io
+import os
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import garment_classifier
+from bench import classifier_eval
+from garment_classifier import COLOR_PALETTE, Classification, GarmentClassifier
+
+# Цвета фото-фикстур: белый на светлом фоне неотличим от фона и не проверяется
+FIXTURE_COLORS = ('black', 'grey', 'beige', 'brown', 'red', 'burgundy', 'pink', 'orange', 'yellow',
+                  'green', 'olive', 'blue', 'navy', 'purple')
+
+
+def _fixture_image(color, seed):
+    """Вещь основного цвета с мелкой деталью другого цвета на светлом фоне, JPEG с шумом."""
+    rng = np.random.default_rng(seed)
+    image = Image.new('RGB', (400, 500), (238, 236, 232))
+    draw = ImageDraw.Draw(image)
+    left, top = rng.uniform(60, 110), rng.uniform(50, 90)
+    draw.rectangle([left, top, 400 - left, 500 - top], fill=COLOR_PALETTE[color])
+    draw.rectangle([180, 200, 220, 230], fill=(245, 245, 245)) # Пуговица/логотип - меньше COLOR_MIN_SHARE
+    noise = rng.integers(-10, 10, (500, 400, 3), dtype=np.int16)
+    pixels = np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+@pytest.fixture(scope='module')
+def color_fixtures(tmp_path_factory):
+    """Каталог в формате bench.classifier_eval: фото + labels.csv."""
+    directory = tmp_path_factory.mktemp('garments')
+    with open(directory / classifier_eval.LABELS_FILE, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'category', 'colors'])
+        for seed, color in enumerate(FIXTURE_COLORS * 3):
+            name = f"{seed:03d}-{color}.jpg"
+            (directory / name).write_bytes(_fixture_image(color, seed))
+            writer.writerow([name, '', color])
+    return str(directory)
+
+
+def test_dominant_colors_on_labelled_fixtures(color_fixtures):
+    labels = classifier_eval.load_labels(color_fixtures)
+    results, _ = classifier_eval.classify_files([path for path, _, _ in labels])
+    samples = [(category, colors, result) for (_, category, colors), result in zip(labels, results)]
+
+    assert all('error' not in result for result in results)
+    assert classifier_eval.color_accuracy(samples) >= 0.95
+    # Основной цвет - первым, фон не попадает в список
+    assert all(result['colors'][0] == colors[0] for _, colors, result in samples)
+
+
+def test_evaluate_counts_only_allowed_confident_predictions():
+    samples = [
+        ('jeans', [], {'category': 'jeans', 'confidence': 0.95, 'colors': []}),
+        ('jeans', [], {'category': 'jeans', 'confidence': 0.7, 'colors': []}),
+        ('shirt', [], {'category': 'sneakers', 'confidence': 0.85, 'colors': []}),  # Ошибка выше 0.8
+        ('shirt', [], {'category': 'suit', 'confidence': 0.99, 'colors': []}),      # Категория не разрешена
+        ('bag', [], {'error': 'OSError: broken'}),
+    ]
+    categories = ('jeans', 'sneakers', 'bag')
+    reports = [classifier_eval.evaluate(samples, threshold, categories) for threshold in (0.6, 0.8, 0.9)]
+
+    assert [(r['hits'], r['accuracy']) for r in reports] == [(3, 0.6667), (2, 0.5), (1, 1.0)]
+    assert reports[0]['hit_rate'] == 0.6
+    assert classifier_eval.recommend_threshold(reports, 0.95) == 0.9
+    assert classifier_eval.recommend_threshold(reports[:2], 0.95) is None
+    assert not classifier_eval.passes(reports[1], 0.95)
+
+
+def test_classification_needs_allowed_category_and_has_no_guessed_style():
+    assert not Classification('suit', ['navy'], 0.99, 0.8).confident
+    assert not Classification('jeans', ['blue'], 0.5, 0.8).confident
+    hit = Classification('jeans', ['blue'], 0.9, 0.8)
+    assert hit.confident
+    assert hit.to_analysis()['style'] is None
+    assert garment_classifier.parse_categories(' jeans, bag ,') == ('jeans', 'bag')
+    assert garment_classifier.parse_categories('') == garment_classifier.DEFAULT_LOCAL_CATEGORIES
+
+
+def test_classifier_is_disabled_by_default(monkeypatch):
+    monkeypatch.delenv('GARMENT_CLASSIFIER_ENABLED', raising=False)
+    assert GarmentClassifier.from_env() is None
+
+
+class _BrokenExecutor:
+    def __init__(self):
+        self.shutdown_calls = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool('worker died'))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shutdown_calls.append((wait, cancel_futures))
+
+
+def test_broken_pool_is_shut_down_before_replacement():
+    classifier = GarmentClassifier()
+    broken = _BrokenExecutor()
+    classifier._executor = broken
+    classifier._slots.acquire()
+    waiter = Future()
+
+    classifier._run_batch([(b'image', waiter)])
+
+    assert isinstance(waiter.exception(timeout=1), BrokenProcessPool)
+    assert broken.shutdown_calls == [(False, True)]
+    assert classifier._executor is None
+    assert classifier._slots.acquire(blocking=False) # Слот батча возвращен
+
+
+@pytest.mark.skipif(not os.environ.get('GARMENT_CLASSIFIER_FIXTURES'),
+                    reason="GARMENT_CLASSIFIER_FIXTURES (labelled photos for bench.classifier_eval) is not set")
+def test_category_accuracy_at_configured_threshold():
+    """Размеченные реальные фото: при рабочем пороге точность категории не ниже 95%."""
+    directory = os.environ['GARMENT_CLASSIFIER_FIXTURES']
+    labels = classifier_eval.load_labels(directory)
+    results, model_error = classifier_eval.classify_files([path for path, _, _ in labels])
+    if model_error:
+        pytest.skip(f"Category model unavailable: {model_error}")
+    samples = [(category, colors, result) for (_, category, colors), result in zip(labels, results)]
+    threshold = float(os.environ.get('GARMENT_CLASSIFIER_THRESHOLD', 0.8))
+    categories = garment_classifier.parse_categories(os.environ.get('GARMENT_CLASSIFIER_CATEGORIES', ''))
+
+    report = classifier_eval.evaluate(samples, threshold, categories)
+
+    assert report['hits'] > 0
+    assert report['accuracy'] >= 0.95
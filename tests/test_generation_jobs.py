@@ -0,0 +1,118 @@
+"""Очередь генерации (jobs.py): дедупликация, зависшие задачи, счетчик max_pending."""
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from jobs import JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, GenerationJobRunner, prompt_hash
+
+
+@pytest.fixture
+def runner(app, app_module):
+    release = threading.Event()
+
+    def generate(prompt):
+        release.wait(5)
+        return f"https://example.com/{prompt_hash(prompt)[:8]}.png"
+
+    runner = GenerationJobRunner(app, app_module.db, app_module.GenerationJob, generate,
+                                 max_workers=2, max_pending=3, stale_after=60)
+    runner.release = release
+    with app.app_context():
+        yield runner
+    release.set()
+    runner._executor.shutdown(wait=True)
+
+
+def _job(app_module, prompt, status, age_seconds, started=False):
+    now = datetime.utcnow()
+    job = app_module.GenerationJob(
+        id=prompt_hash(prompt + str(age_seconds))[:32], prompt=prompt, prompt_hash=prompt_hash(prompt),
+        status=status, created_at=now - timedelta(seconds=age_seconds),
+        started_at=now - timedelta(seconds=age_seconds) if started else None)
+    app_module.db.session.add(job)
+    app_module.db.session.commit()
+    return job.id
+
+
+def test_concurrent_duplicate_returns_existing_job(runner, app_module, monkeypatch):
+    first, created = runner.submit('red dress race')
+    assert created
+    # Гонка: проверка "уже в работе" у второго запроса прошла раньше, чем первый вставил задачу
+    lookups = iter([None])
+    original = runner._in_flight
+    monkeypatch.setattr(runner, '_in_flight', lambda key: next(lookups, None) or original(key))
+    second, created = runner.submit('red  dress race')
+    assert not created and second.id == first.id
+    assert runner._pending == 1
+
+
+def test_stale_in_flight_job_is_failed_when_read(runner, app_module):
+    queued_id = _job(app_module, 'stale queued', JOB_QUEUED, 120)
+    running_id = _job(app_module, 'stale running', JOB_RUNNING, 120, started=True)
+    fresh_id = _job(app_module, 'fresh running', JOB_RUNNING, 5, started=True)
+    assert runner.get(queued_id).status == JOB_FAILED
+    assert runner.get(running_id).status == JOB_FAILED
+    assert runner.get(fresh_id).status == JOB_RUNNING
+    # Тот же промпт можно поставить заново: зависшая задача больше не держит уникальный индекс
+    job, created = runner.submit('stale queued')
+    assert created and job.id != queued_id
+
+
+def test_failed_insert_or_submit_releases_pending_slot(runner, app_module, monkeypatch):
+    def broken_submit(*args, **kwargs):
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+    monkeypatch.setattr(runner._executor, 'submit', broken_submit)
+    for number in range(5):
+        with pytest.raises(RuntimeError):
+            runner.submit(f"never scheduled {number}")
+    assert runner._pending == 0
+    statuses = {job.status for job in app_module.GenerationJob.query.filter(
+        app_module.GenerationJob.prompt.like('never scheduled%'))}
+    assert statuses == {JOB_FAILED}
+
+
+def test_job_runs_to_completion(runner):
+    job, _ = runner.submit('green coat render')
+    runner.release.set()
+    job = runner.wait(job.id, timeout=5, poll_interval=0.05)
+    assert job.status == JOB_SUCCEEDED and job.result_url
+    assert runner._pending == 0
+
+
+def test_wait_wakes_on_transition_without_holding_a_connection(runner, app_module):
+    from query_budget import count_queries
+
+    job, _ = runner.submit('blue scarf render')
+    threading.Timer(0.2, runner.release.set).start()
+    started = time.monotonic()
+    with count_queries(app_module.db.engine) as counter:
+        job = runner.wait(job.id, timeout=10, poll_interval=30)
+
+    assert job.status == JOB_SUCCEEDED
+    assert time.monotonic() - started < 2 # Разбудил переход задачи, а не опрос раз в 30s
+    assert counter.count <= 20 # Опрос раз в 0.5s дал бы сотни запросов за долгую задачу
+    assert runner.db.engine.pool.checkedout() == 0
+
+
+@pytest.mark.parametrize('timeout', ['soon', None, 'nan', [1]])
+def test_generate_wait_rejects_bad_timeout(client, timeout):
+    response = client.post('/generate', json={'prompt': 'bad timeout', 'wait': True, 'timeout': timeout})
+    assert response.status_code == 400
+
+
+def test_generate_wait_is_capped_server_side(app, app_module, client, monkeypatch):
+    runner = app.extensions['generation_jobs']
+    waits = []
+
+    def fake_wait(job_id, timeout, **kwargs):
+        waits.append(timeout)
+        return runner.get(job_id)
+
+    monkeypatch.setattr(runner, 'wait', fake_wait)
+    response = client.post('/generate', json={'prompt': 'capped wait', 'wait': True, 'timeout': 3600})
+
+    assert response.status_code in (200, 202)
+    assert waits == [app_module.GENERATION_MAX_WAIT]
@@ -0,0 +1,36 @@
+"""Метрики (metrics.py): доступ к /metrics и запись запросов по шаблону маршрута."""
+import pytest
+
+import metrics
+
+
+def test_metrics_are_hidden_without_token(client, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', '')
+    monkeypatch.setattr(metrics, 'METRICS_PUBLIC', False)
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics/slow').status_code == 404
+
+    monkeypatch.setattr(metrics, 'METRICS_PUBLIC', True)
+    assert client.get('/metrics').status_code == 200
+
+
+@pytest.mark.parametrize('path', ['/metrics', '/metrics/slow'])
+def test_metrics_require_the_bearer_token(client, monkeypatch, path):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'scrape-secret')
+    monkeypatch.setattr(metrics, 'METRICS_PUBLIC', True) # Токен важнее флага
+
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get(path, headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
+
+
+def test_slow_requests_record_the_route_template(client, seeded, monkeypatch):
+    monkeypatch.setattr(metrics, 'SLOW_REQUEST_MS', 0.000001)
+    monkeypatch.setattr(metrics, '_slow_requests', metrics.deque(maxlen=5))
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'scrape-secret')
+
+    client.get(f"/api/wardrobe/list/{seeded['user_id']}").close()
+    samples = client.get('/metrics/slow', headers={'Authorization': 'Bearer scrape-secret'}).get_json()['requests']
+
+    assert [sample['route'] for sample in samples] == ['/api/wardrobe/list/<int:user_id>']
+    assert 'path' not in samples[0]
@@ -0,0 +1,29 @@
+"""Проверка схемы при запуске (migrations.py): отстающая схема - 503, а не ошибки SQL."""
+import os
+
+import migrations
+
+
+def test_requests_get_503_until_migrations_are_applied(app_module, tmp_path, monkeypatch):
+    monkeypatch.delenv('DB_AUTO_MIGRATE')
+    database_url = f"sqlite:///{os.path.join(tmp_path, 'behind.db')}"
+    application = app_module.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': database_url,
+                                         'SQLALCHEMY_ENGINE_OPTIONS': {}})
+    client = application.test_client()
+
+    response = client.get('/api/wardrobe/list/999')
+    assert response.status_code == 503
+    assert response.get_json()['pending_migrations'] == [number for number, _ in migrations.revisions()]
+
+    with application.app_context():
+        migrations.upgrade(app_module.db.engine, log=lambda message: None)
+    monkeypatch.setattr(migrations, 'SCHEMA_RECHECK_SECONDS', 0.0)
+    assert client.get('/api/wardrobe/list/999').get_json() == {"error": "User not found"} # Обычный ответ маршрута
+
+
+def test_auto_upgrade_applies_pending_revisions(app_module, tmp_path):
+    database_url = f"sqlite:///{os.path.join(tmp_path, 'auto.db')}"
+    application = app_module.create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': database_url,
+                                         'SQLALCHEMY_ENGINE_OPTIONS': {}})
+    with application.app_context():
+        assert migrations.pending_revisions(app_module.db.engine) == []
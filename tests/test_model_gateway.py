@@ -0,0 +1,160 @@
+"""Шлюз моделей (model_gateway.py): таймауты попыток и общий срок вместе с повторами."""
+import threading
+import time
+
+import pytest
+
+from model_gateway import ModelGateway, ModelTimeoutError
+
+
+class _HangingProvider:
+    """Первые hangs вызовов висят, пока тест не завершится; потом отвечают сразу."""
+    name = 'gemini'
+
+    def __init__(self, hangs):
+        self.hangs = hangs
+        self.calls = 0
+        self.release = threading.Event()
+
+    def _maybe_hang(self):
+        self.calls += 1
+        if self.calls <= self.hangs:
+            self.release.wait(5)
+
+    def generate(self, model_name, contents, **kwargs):
+        self._maybe_hang()
+        return 'ok'
+
+    def generate_stream(self, model_name, contents, **kwargs):
+        self._maybe_hang()
+        yield 'o'
+        yield 'k'
+
+    def is_retryable(self, exc):
+        return True
+
+
+@pytest.fixture
+def gateway_for():
+    gateways = []
+
+    def build(provider, **kwargs):
+        gateway = ModelGateway([provider], limits={'gemini': 4}, backoff_base=0.01, failure_threshold=100, **kwargs)
+        gateways.append((gateway, provider))
+        return gateway
+
+    yield build
+    for gateway, provider in gateways:
+        provider.release.set()
+        for executor in gateway._executors.values():
+            executor.shutdown(wait=True)
+
+
+def test_stream_without_timeout_waits_for_the_answer(gateway_for):
+    gateway = gateway_for(_HangingProvider(hangs=0)) # Ни timeouts, ни total_timeouts
+
+    assert ''.join(gateway.stream('gemini', 'generate_stream', 'model', 'hi')) == 'ok'
+    assert gateway.call('gemini', 'generate', 'model', 'hi') == 'ok'
+
+
+@pytest.mark.parametrize('method', ['call', 'stream'])
+def test_retries_stop_at_the_total_deadline(gateway_for, method):
+    provider = _HangingProvider(hangs=100)
+    gateway = gateway_for(provider, timeouts={'gemini': 0.2}, total_timeouts={'gemini': 0.5}, max_retries=10)
+
+    started = time.monotonic()
+    with pytest.raises(ModelTimeoutError):
+        if method == 'call':
+            gateway.call('gemini', 'generate', 'model', 'hi')
+        else:
+            list(gateway.stream('gemini', 'generate_stream', 'model', 'hi'))
+
+    assert time.monotonic() - started < 0.8 # Без общего срока - до 11 попыток по 0.2s
+    assert provider.calls <= 3
+
+
+def test_retry_succeeds_within_the_total_deadline(gateway_for):
+    provider = _HangingProvider(hangs=0)
+    stream = provider.generate_stream
+
+    def flaky_stream(model_name, contents, **kwargs):
+        if provider.calls == 0:
+            provider.calls += 1
+            raise ConnectionError('reset by peer')
+        return stream(model_name, contents, **kwargs)
+
+    provider.generate_stream = flaky_stream
+    gateway = gateway_for(provider, timeouts={'gemini': 0.1}, total_timeouts={'gemini': 2}, max_retries=2)
+
+    assert ''.join(gateway.stream('gemini', 'generate_stream', 'model', 'hi')) == 'ok'
+    assert provider.calls == 2
+
+
+class _BadInput(ValueError):
+    pass
+
+
+class _RejectingProvider(_HangingProvider):
+    """Отвечает ошибкой запроса, которую повторять бессмысленно."""
+
+    def __init__(self):
+        super().__init__(hangs=0)
+
+    def generate(self, model_name, contents, **kwargs):
+        raise _BadInput('bad request')
+
+    def generate_stream(self, model_name, contents, **kwargs):
+        raise _BadInput('bad request')
+        yield
+
+    def is_retryable(self, exc):
+        return not isinstance(exc, _BadInput)
+
+
+@pytest.mark.parametrize('method', ['call', 'stream'])
+def test_non_retryable_error_leaves_half_open_breaker_alone(gateway_for, method):
+    gateway = gateway_for(_RejectingProvider())
+    breaker = gateway._breakers['gemini']
+    breaker.reset_timeout = 0.05
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.state == 'half-open'
+
+    with pytest.raises(_BadInput):
+        if method == 'call':
+            gateway.call('gemini', 'generate', 'model', 'hi')
+        else:
+            list(gateway.stream('gemini', 'generate_stream', 'model', 'hi'))
+
+    # Счетчик ошибок не сброшен, а пробный вызов снова доступен
+    assert breaker.state == 'half-open'
+    assert breaker._failures == breaker.failure_threshold
+    assert breaker.allow()
+
+
+@pytest.mark.parametrize('method', ['call', 'stream'])
+def test_hanging_provider_does_not_fill_the_pool(gateway_for, method):
+    provider = _HangingProvider(hangs=1000)
+    gateway = gateway_for(provider, timeouts={'gemini': 0.05}, total_timeouts={'gemini': 5}, max_retries=5)
+
+    errors = []
+    for _ in range(8):
+        try:
+            if method == 'call':
+                gateway.call('gemini', 'generate', 'model', 'hi')
+            else:
+                list(gateway.stream('gemini', 'generate_stream', 'model', 'hi'))
+        except Exception as e:
+            errors.append(type(e).__name__)
+        stats = gateway.stats()['gemini']
+        assert stats['abandoned'] + stats['queued'] <= 4 # Не больше размера пула
+
+    # Зависшая попытка не повторяется; когда пул занят брошенными вызовами - отказ сразу
+    assert provider.calls == 4
+    assert errors[:4] == ['ModelTimeoutError'] * 4
+    assert set(errors[4:]) == {'ModelOverloadedError'}
+
+    provider.release.set()
+    time.sleep(0.1)
+    assert gateway.stats()['gemini']['abandoned'] == 0
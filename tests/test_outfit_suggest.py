@@ -0,0 +1,23 @@
+"""Подбор образов (/api/outfit/suggest): локальный режим без вызова модели."""
+import pytest
+
+
+def _suggest_offline(client, user_id, **fields):
+    return client.post(f"/api/outfit/suggest/{user_id}", json={'event': 'office', 'offline': True, **fields})
+
+
+@pytest.mark.parametrize('count', ['three', None, [2], {}])
+def test_offline_count_must_be_an_integer(client, seeded, count):
+    response = _suggest_offline(client, seeded['user_id'], count=count)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('count, expected', [(-5, 1), (0, 1), (2, 2), (10 ** 6, None)])
+def test_offline_count_is_clamped(app_module, client, seeded, count, expected):
+    response = _suggest_offline(client, seeded['user_id'], count=count)
+
+    assert response.status_code == 200
+    outfits = response.get_json()['suggested_outfits']
+    assert 1 <= len(outfits) <= app_module.OUTFIT_CANDIDATES
+    if expected is not None:
+        assert len(outfits) == expected
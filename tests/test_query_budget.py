@@ -0,0 +1,127 @@
+"""
+Бюджеты SQL-запросов (@max_queries) всех маршрутов на SQLite в строгом режиме:
+N+1 в любом из них - падение теста. Потоковые ответы читаются до конца и закрываются,
+чтобы учесть запросы генератора тела.
+"""
+import pytest
+from flask import Flask, Response, stream_with_context
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+
+import query_budget
+from query_budget import QueryBudgetExceeded
+
+# endpoint -> [(описание, вызов(client, ids))]
+CASES = {
+    'main.list_wardrobe_items': [
+        ('list', lambda c, ids: c.get(f"/api/wardrobe/list/{ids['user_id']}")),
+        ('list filtered', lambda c, ids: c.get(f"/api/wardrobe/list/{ids['user_id']}?category=shirt,jeans&color=blue")),
+        ('list page 2', lambda c, ids: c.get(f"/api/wardrobe/list/{ids['user_id']}?limit=5&cursor=5")),
+        ('list empty user', lambda c, ids: c.get('/api/wardrobe/list/999999')),
+    ],
+    'main.delete_wardrobe_item': [
+        ('delete item', lambda c, ids: c.delete(f"/api/wardrobe/item/{ids['deletable_item_id']}")),
+        ('delete missing item', lambda c, ids: c.delete('/api/wardrobe/item/999999')),
+    ],
+    'main.similar_wardrobe_items': [
+        ('similar', lambda c, ids: c.get(f"/api/wardrobe/similar/{ids['item_id']}")),
+    ],
+    'main.suggest_outfit': [
+        ('suggest', lambda c, ids: c.post(f"/api/outfit/suggest/{ids['user_id']}", json={'event': 'office'})),
+        ('suggest offline', lambda c, ids: c.post(f"/api/outfit/suggest/{ids['user_id']}",
+                                                  json={'event': 'office', 'offline': True})),
+        ('suggest sse', lambda c, ids: c.post(f"/api/outfit/suggest/{ids['user_id']}",
+                                              json={'event': 'party', 'stream': 'sse'})),
+        ('suggest ndjson', lambda c, ids: c.post(f"/api/outfit/suggest/{ids['user_id']}",
+                                                 json={'event': 'dinner', 'stream': 'ndjson'})),
+    ],
+    'main.chat': [
+        ('chat', lambda c, ids: c.post('/chat', json={'message': 'What should I wear?'})),
+        ('chat sse', lambda c, ids: c.post('/chat', json={'message': 'And shoes?', 'stream': 'sse'})),
+    ],
+    'main.get_chat_session': [
+        ('chat session', lambda c, ids: c.get(f"/chat/sessions/{ids['session_id']}")),
+    ],
+    'main.get_user_appearance': [
+        ('appearance', lambda c, ids: c.get(f"/api/user/appearance/{ids['user_id']}")),
+        ('appearance history', lambda c, ids: c.get(f"/api/user/appearance/{ids['user_id']}?history=1")),
+    ],
+}
+
+
+def _budgeted_endpoints(app):
+    return {endpoint for endpoint, view in app.view_functions.items()
+            if getattr(view, '_query_budget', None) is not None}
+
+
+def test_every_budgeted_route_is_covered(app):
+    assert _budgeted_endpoints(app) == set(CASES)
+
+
+@pytest.mark.parametrize('endpoint,name,call', [
+    (endpoint, name, call) for endpoint, cases in CASES.items() for name, call in cases
+], ids=[name for cases in CASES.values() for name, _ in cases])
+def test_route_stays_within_query_budget(app, client, seeded, endpoint, name, call):
+    budget = app.view_functions[endpoint]._query_budget
+    response = call(client, seeded)
+    try:
+        assert response.status_code < 500, response.get_data(as_text=True) # 404 пустого пользователя - тоже путь
+        if response.is_streamed:
+            response.get_data() # Запросы генератора; превышение - QueryBudgetExceeded из close()
+        else:
+            assert int(response.headers['X-Query-Count']) <= budget
+    finally:
+        response.close()
+
+
+# --- Сам механизм бюджета ---
+
+@pytest.fixture
+def budget_app(tmp_path):
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'budget.db'}"
+    db = SQLAlchemy(app)
+
+    @app.route('/plain')
+    @query_budget.query_budget(1)
+    def plain():
+        for _ in range(3):
+            db.session.execute(text('SELECT 1'))
+        return 'ok'
+
+    @app.route('/streamed')
+    @query_budget.query_budget(1)
+    def streamed():
+        def generate():
+            for _ in range(3):
+                db.session.execute(text('SELECT 1'))
+                yield 'chunk\n'
+        return Response(stream_with_context(generate()))
+
+    @app.route('/within')
+    @query_budget.query_budget(1)
+    def within():
+        db.session.execute(text('SELECT 1'))
+        return 'ok'
+
+    with app.app_context():
+        query_budget.init_app(app, db.engine, strict=True)
+    return app
+
+
+def test_strict_budget_fails_regular_response(budget_app):
+    with pytest.raises(QueryBudgetExceeded):
+        budget_app.test_client().get('/plain')
+
+
+def test_strict_budget_counts_queries_made_while_streaming(budget_app):
+    response = budget_app.test_client().get('/streamed')
+    assert response.get_data(as_text=True) == 'chunk\n' * 3
+    with pytest.raises(QueryBudgetExceeded, match='3 queries, budget 1'):
+        response.close()
+
+
+def test_query_count_header(budget_app):
+    response = budget_app.test_client().get('/within')
+    assert response.headers['X-Query-Count'] == '1'
@@ -0,0 +1,54 @@
+"""Индекс похожих вещей (embeddings.VectorIndex): удаление и сверка с БД."""
+import numpy as np
+
+from bench.synthetic import wardrobe_rows
+from embeddings import VectorIndex
+
+
+def _unit(dim, seed):
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).astype(np.float16)
+
+
+def test_removed_items_are_not_found(tmp_path):
+    index = VectorIndex(str(tmp_path / 'index'), 8, 'test')
+    for item_id in (1, 2, 3):
+        index.add(item_id, 7, _unit(8, item_id))
+
+    index.remove(2)
+
+    assert index.item_ids() == {1, 3}
+    assert 2 not in dict(index.search(_unit(8, 2), 7, k=10))
+
+
+def test_index_is_rebuilt_when_it_disagrees_with_the_database(app, app_module, seeded, tmp_path):
+    A = app_module
+    index = VectorIndex(str(tmp_path / 'index'), A.image_embedder.dim, A.image_embedder.name)
+    with app.app_context():
+        A._sync_similarity_index(index)
+        expected = index.item_ids()
+        assert seeded['item_id'] in expected
+
+        index.add(10 ** 9, seeded['user_id'], _unit(A.image_embedder.dim, 0)) # Вещи нет в БД
+        index.remove(seeded['item_id'])                                           # Вещь есть в БД
+        A._sync_similarity_index(index)
+
+    assert index.item_ids() == expected
+
+
+def test_deleting_an_item_removes_it_from_the_index(app, app_module, client, seeded):
+    A = app_module
+    with app.app_context():
+        item = A.WardrobeItem(**wardrobe_rows(seeded['user_id'], 1, seed=7, embedding_dim=A.image_embedder.dim)[0])
+        A.db.session.add(item)
+        A.db.session.commit()
+        A.index_item_embeddings([item])
+        item_id = item.id
+        assert item_id in A.get_similarity_index().item_ids()
+
+    response = client.delete(f"/api/wardrobe/item/{item_id}")
+
+    assert response.status_code == 200
+    with app.app_context():
+        assert item_id not in A.get_similarity_index().item_ids()
+        assert A.db.session.get(A.WardrobeItem, item_id) is None
@@ -0,0 +1,78 @@
+"""Загрузка вещи (/api/wardrobe/add): анализ по уменьшенной копии, оригинал - только вместе со строкой."""
+import hashlib
+import io
+import json
+
+import pytest
+from PIL import Image
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from image_pipeline import IMAGE_MAX_EDGE
+from storage import original_key
+
+
+def _photo(width=3000, height=2000, color=(30, 60, 160)):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def _key(data):
+    return original_key(hashlib.sha256(data).hexdigest(), 'image/jpeg')
+
+
+def _post(client, user_id, data):
+    return client.post(f"/api/wardrobe/add/{user_id}", data={'image': (io.BytesIO(data), 'photo.jpg')},
+                       content_type='multipart/form-data')
+
+
+def test_analysis_gets_a_downscaled_copy(app_module, client, seeded, monkeypatch):
+    A = app_module
+    seen = []
+    monkeypatch.setattr(A, 'analyze_garment', lambda image_bytes: seen.append(image_bytes) or None)
+    data = _photo()
+
+    response = _post(client, seeded['user_id'], data)
+
+    assert response.status_code == 201
+    assert max(Image.open(io.BytesIO(seen[0])).size) <= IMAGE_MAX_EDGE
+    assert A.image_store.backend.exists(_key(data))
+
+
+@pytest.mark.parametrize('failing', ['analyze_garment', 'index_item_attributes'])
+def test_failed_item_leaves_no_original_behind(app_module, client, seeded, monkeypatch, failing):
+    A = app_module
+
+    def broken(*args, **kwargs):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(A, failing, broken)
+    data = _photo(color=(200, 20 + len(failing), 20))
+
+    response = _post(client, seeded['user_id'], data)
+
+    assert response.status_code == 500
+    assert not A.image_store.backend.exists(_key(data))
+
+
+def _post_chunked(app, user_id, data):
+    """Тело без Content-Length, как при Transfer-Encoding: chunked за gunicorn. Возвращает (статус, JSON)."""
+    environ = EnvironBuilder(path=f"/api/wardrobe/add/{user_id}", method='POST',
+                             data={'image': (io.BytesIO(data), 'photo.jpg')}).get_environ()
+    del environ['CONTENT_LENGTH'] # Тестовый клиент всегда проставляет длину - вызываем WSGI напрямую
+    environ['wsgi.input_terminated'] = True
+    body, status, _ = run_wsgi_app(app, environ, buffered=True)
+    return int(status.split()[0]), json.loads(b''.join(body))
+
+
+def test_chunked_upload_is_held_to_the_upload_limit(app, app_module, seeded, monkeypatch):
+    A = app_module
+    small, large = _photo(200, 200), _photo(color=(120, 120, 40))
+    monkeypatch.setattr(A.admission, 'max_upload_bytes', len(small) + 1024)
+
+    status, body = _post_chunked(app, seeded['user_id'], large)
+    assert status == 413 and 'maximum' in body['error']
+    assert not A.image_store.backend.exists(_key(large))
+
+    status, body = _post_chunked(app, seeded['user_id'], small)
+    assert status == 201